@@ -19,9 +19,36 @@ copy /Y python\setup.py package
 copy /Y python\config.py package\zorilla
 copy /Y python\example.py package\zorilla
 copy /Y python\backtrace.py package\zorilla
+copy /Y python\async_bench.py package\zorilla
+copy /Y python\sync_bench.py package\zorilla
+copy /Y python\log_query.py package\zorilla
+copy /Y python\bench.py package\zorilla
+copy /Y python\ssh_broker.py package\zorilla
+copy /Y python\fleet_bench.py package\zorilla
 copy /Y python\host.py package\zorilla
 copy /Y python\serial_expect.py package\zorilla
 copy /Y python\ssh_expect.py package\zorilla
+copy /Y python\ssh_pool.py package\zorilla
+copy /Y python\matcher.py package\zorilla
+copy /Y python\async_expect.py package\zorilla
+copy /Y python\host_group.py package\zorilla
+copy /Y python\probe.py package\zorilla
+copy /Y python\shell_session.py package\zorilla
+copy /Y python\output_capture.py package\zorilla
+copy /Y python\local_server.py package\zorilla
+copy /Y python\transfer.py package\zorilla
+copy /Y python\sync.py package\zorilla
+copy /Y python\tar_stream.py package\zorilla
+copy /Y python\gdbtrace.py package\zorilla
+copy /Y python\deadline.py package\zorilla
+copy /Y python\serial_manager.py package\zorilla
+copy /Y python\log_store.py package\zorilla
+copy /Y python\transcript.py package\zorilla
+copy /Y python\fake_serial.py package\zorilla
+copy /Y python\metrics.py package\zorilla
+copy /Y python\broker.py package\zorilla
+copy /Y python\process_group.py package\zorilla
+copy /Y python\result_cache.py package\zorilla
 copy /Y config\default.cfg package\zorilla\data
 rem python\dos2unix.py package\calient\data\echo_server.py
 
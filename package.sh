@@ -20,9 +20,36 @@ cp -av python/README.rst package
 cp -av python/config.py package/zorilla
 cp -av python/example.py package/zorilla
 cp -av python/backtrace.py package/zorilla
+cp -av python/async_bench.py package/zorilla
+cp -av python/sync_bench.py package/zorilla
+cp -av python/log_query.py package/zorilla
+cp -av python/bench.py package/zorilla
+cp -av python/ssh_broker.py package/zorilla
+cp -av python/fleet_bench.py package/zorilla
 cp -av python/host.py package/zorilla
 cp -av python/serial_expect.py package/zorilla
 cp -av python/ssh_expect.py package/zorilla
+cp -av python/ssh_pool.py package/zorilla
+cp -av python/matcher.py package/zorilla
+cp -av python/async_expect.py package/zorilla
+cp -av python/host_group.py package/zorilla
+cp -av python/probe.py package/zorilla
+cp -av python/shell_session.py package/zorilla
+cp -av python/output_capture.py package/zorilla
+cp -av python/local_server.py package/zorilla
+cp -av python/transfer.py package/zorilla
+cp -av python/sync.py package/zorilla
+cp -av python/tar_stream.py package/zorilla
+cp -av python/gdbtrace.py package/zorilla
+cp -av python/deadline.py package/zorilla
+cp -av python/serial_manager.py package/zorilla
+cp -av python/log_store.py package/zorilla
+cp -av python/transcript.py package/zorilla
+cp -av python/fake_serial.py package/zorilla
+cp -av python/metrics.py package/zorilla
+cp -av python/broker.py package/zorilla
+cp -av python/process_group.py package/zorilla
+cp -av python/result_cache.py package/zorilla
 cp -av python/default.cfg package/zorilla/data
 #cp -av python/dos2unix.py package/zorilla/data/echo_server.py
 
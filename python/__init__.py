@@ -1,17 +1,39 @@
 import sys
+import types
+import importlib
 
 __author__ = "Michael Deacon <mdeacon@zorillaeng.com>"
 __license__ = "GNU Lesser General Public License (LGPL)"
 
-from zorilla.host import Host
-from zorilla.ssh_expect import SSHExpect
-from zorilla.serial_expect import SerialExpect
+# Public names and the modules they come from. They are imported on first
+# use, so importing zorilla.config or zorilla.serial_expect does not load
+# paramiko and the rest of the SSH stack.
+_lazy = {'Host': 'zorilla.host',
+         'SSHExpect': 'zorilla.ssh_expect',
+         'SerialExpect': 'zorilla.serial_expect'}
 
 __all__ = ['Host',
            'SSHExpect',
            'SerialExpect']
 
-
-
-
-
+class LazyModule(types.ModuleType):
+    """The package module, importing the public names when first used
+    """
+    def __getattr__(self, name):
+        if name not in _lazy:
+            raise AttributeError("'module' object has no attribute '%s'" %
+                                 name)
+        value = getattr(importlib.import_module(_lazy[name]), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__.keys()) | set(_lazy.keys()))
+
+# The original module is kept referenced, as Python 2 clears the globals
+# of a module when it is collected
+_module = sys.modules[__name__]
+_lazy_module = LazyModule(__name__)
+_lazy_module.__dict__.update(_module.__dict__)
+_lazy_module._module = _module
+sys.modules[__name__] = _lazy_module
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#
+# Compare threaded SSHExpect with AsyncSSHExpect across many sessions
+#
+#    Each mode runs in its own process so peak RSS is measured separately
+#    Each session opens a shell, waits for the prompt, runs a command and
+#    waits for the prompt again
+#
+# mdeacon@zorillaeng.com
+
+import sys
+import time
+import logging
+import signal
+import threading
+import traceback
+import multiprocessing
+from zorilla.config import init_config, init_logging
+from zorilla.ssh_expect import SSHExpect
+from zorilla.async_expect import ExpectLoop, AsyncSSHExpect, Return
+
+logger = logging.getLogger()
+
+def sig_handler(signal, frame):
+    logger.error('Ctrl-c pressed...')
+    sys.exit()
+
+def peak_rss_kb():
+    """Peak resident set size of this process in KB
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def session_targets(args):
+    targets = [t.strip() for t in args.targets.split(',') if t.strip()]
+    return [targets[i % len(targets)] for i in range(int(args.sessions))]
+
+def run_threaded(args):
+    """One OS thread per session, each blocking in SSHExpect
+    """
+    errors = []
+
+    def session(target):
+        try:
+            sexp = SSHExpect(target, args.username, args.password,
+                             timeout=float(args.timeout))
+            sexp.send_recv('\n', [args.prompt], timeout=float(args.timeout))
+            sexp.send_recv(args.command + '\n', [args.prompt],
+                           timeout=float(args.timeout))
+            sexp.close()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=session, args=(t,))
+               for t in session_targets(args)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return len(errors)
+
+def run_async(args):
+    """All sessions multiplexed on one ExpectLoop
+    """
+    loop = ExpectLoop(workers=int(args.workers))
+
+    def session(target):
+        sexp = yield AsyncSSHExpect.open(loop, target, args.username,
+                                         args.password)
+        yield sexp.send_recv('\n', [args.prompt], timeout=float(args.timeout))
+        idx, output = yield sexp.send_recv(args.command + '\n', [args.prompt],
+                                           timeout=float(args.timeout))
+        sexp.close()
+        raise Return(idx)
+
+    tasks = [loop.spawn(session(t)) for t in session_targets(args)]
+    loop.run_until_complete(tasks)
+    loop.close()
+    return len([t for t in tasks if t.exception() is not None])
+
+def run_mode(mode, args, results):
+    start = time.time()
+    if mode == 'threaded':
+        errors = run_threaded(args)
+    else:
+        errors = run_async(args)
+    elapsed = time.time() - start
+    results.put({'mode': mode,
+                 'sessions': int(args.sessions),
+                 'errors': errors,
+                 'elapsed': elapsed,
+                 'sessions_per_sec': int(args.sessions) / elapsed,
+                 'peak_rss_kb': peak_rss_kb()})
+
+def bench(args):
+    results = multiprocessing.Queue()
+    for mode in ['threaded', 'async']:
+        p = multiprocessing.Process(target=run_mode, args=(mode, args, results))
+        p.start()
+        r = results.get()
+        p.join()
+        logger.error('%-8s sessions %u errors %u elapsed %.2f s '
+                     '%.1f sessions/s peak RSS %u KB', r['mode'],
+                     r['sessions'], r['errors'], r['elapsed'],
+                     r['sessions_per_sec'], r['peak_rss_kb'])
+
+def main(argv=None):
+    # Do argv default this way, as doing it in the functional
+    # declaration sets it at compile time.
+    if argv is None:
+        argv = sys.argv
+
+    # Default configuration
+    defaults = {'ip_eth0':'192.168.2.68',
+                'username':'root',
+                'password':'',
+                'loglevel':'ERROR',
+                'report':''}
+
+    # Initialize configuration
+    # This is common to all test utilities
+    parser, remaining_argv = init_config(defaults)
+
+    # Custom parameters
+    parser.add_argument("-a", "--ip_eth0", help="IP address for eth0")
+    parser.add_argument("-u", "--username", help="username")
+    parser.add_argument("-p", "--password", help="password")
+    parser.add_argument("-t", "--targets",
+                        help="comma separated targets, defaults to ip_eth0")
+    parser.add_argument("-n", "--sessions", default='100',
+                        help="number of sessions spread over the targets")
+    parser.add_argument("-w", "--workers", default='16',
+                        help="connect threads used by the async loop")
+    parser.add_argument("--command", default='uname -a',
+                        help="command run in each session")
+    parser.add_argument("--prompt", default='~]$', help="shell prompt")
+    parser.add_argument("--timeout", default='30', help="per call timeout")
+    args = parser.parse_args(remaining_argv)
+    if not args.targets:
+        args.targets = args.ip_eth0
+
+    # Set up logging
+    # This is common to all test utilities
+    init_logging(argv, args, logger)
+
+    # Install Ctrl-C handling
+    signal.signal(signal.SIGINT, sig_handler)
+
+    try:
+        bench(args)
+    except Exception as e:
+        logger.error('main: Exception: %r', e)
+        logger.error('Traceback:\n%s', traceback.format_exc())
+        return -1
+
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+#
+# Event driven expect-like behaviour over many SSH channels from one thread
+#
+# mdeacon@zorillaeng.com
+#
+
+import socket
+import select
+import threading
+import heapq
+import math
+import time
+import logging
+import Queue
+from collections import deque
+import paramiko
+from paramiko import SSHClient
+from zorilla.matcher import expect_matcher
+from zorilla.ssh_expect import SSHExpectException, SSHExpectTimeout
+from zorilla.deadline import Deadline
+
+logger = logging.getLogger(__name__)
+
+class Return(Exception):
+    """Raise from a task generator to return a value
+    """
+    def __init__(self, value=None):
+        self.value = value
+
+class ExpectFuture(object):
+    """Result of an operation that completes later on the loop
+    Task generators yield futures and are resumed with their result.
+    """
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise SSHExpectException('result: future is not done')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, fn):
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        self._finish(None, exception)
+
+    def _finish(self, result, exception):
+        if self._done:
+            return
+        self._done = True
+        self._result = result
+        self._exception = exception
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+class Task(ExpectFuture):
+    """Drive a generator that yields futures
+    """
+    def __init__(self, loop, gen):
+        ExpectFuture.__init__(self)
+        self.loop = loop
+        self.gen = gen
+        loop.call_soon(self._step, None, None)
+
+    def _step(self, value, exc):
+        try:
+            if exc is not None:
+                fut = self.gen.throw(exc)
+            else:
+                fut = self.gen.send(value)
+        except StopIteration:
+            self.set_result(None)
+        except Return as r:
+            self.set_result(r.value)
+        except Exception as e:
+            self.set_exception(e)
+        else:
+            if not isinstance(fut, ExpectFuture):
+                self.loop.call_soon(self._step, None, SSHExpectException(
+                    'task yielded %r, expected a future' % (fut,)))
+                return
+            fut.add_done_callback(self._wakeup)
+
+    def _wakeup(self, fut):
+        self.loop.call_soon(self._step, fut._result, fut._exception)
+
+class TimerHandle(object):
+    def __init__(self, when, fn, args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+def make_waker():
+    """Return a (read, write) socket pair used to wake the loop
+    """
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    # Windows has no socketpair, connect over loopback instead
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.bind(('127.0.0.1', 0))
+    lsock.listen(1)
+    wsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    wsock.connect(lsock.getsockname())
+    rsock, _ = lsock.accept()
+    lsock.close()
+    return rsock, wsock
+
+class ExpectLoop(object):
+    """Single threaded event loop multiplexing SSH channels
+    Blocking work such as connect and authentication runs on a small
+    thread pool and is handed back to the loop as a future.
+    e.g.:
+    def board(loop, target):
+        sexp = yield AsyncSSHExpect.open(loop, target, 'root', '')
+        yield sexp.send_recv('\\n', ['~]$'])
+        idx, output = yield sexp.send_recv('uptime\\n', ['~]$'], timeout=5)
+        sexp.close()
+        raise Return(output)
+    loop = ExpectLoop()
+    tasks = [loop.spawn(board(loop, t)) for t in targets]
+    loop.run_until_complete(tasks)
+    """
+    def __init__(self, workers=16):
+        self.workers = workers
+        self.readers = {}
+        self.ready = deque()
+        self.timers = []
+        self.lock = threading.Lock()
+        self.threadsafe = deque()
+        self.executor = None
+        self.work = None
+        self.waker_r, self.waker_w = make_waker()
+        self.waker_r.setblocking(0)
+        if hasattr(select, 'poll'):
+            self.poller = select.poll()
+            self.poller.register(self.waker_r.fileno(), select.POLLIN)
+        else:
+            self.poller = None
+
+    def call_soon(self, fn, *args):
+        self.ready.append((fn, args))
+
+    def call_soon_threadsafe(self, fn, *args):
+        with self.lock:
+            self.threadsafe.append((fn, args))
+        try:
+            self.waker_w.send(b'x')
+        except socket.error:
+            pass
+
+    def call_later(self, delay, fn, *args):
+        handle = TimerHandle(time.time() + delay, fn, args)
+        heapq.heappush(self.timers, handle)
+        return handle
+
+    def add_reader(self, fd, fn):
+        self.readers[fd] = fn
+        if self.poller is not None:
+            self.poller.register(fd, select.POLLIN)
+
+    def remove_reader(self, fd):
+        if self.readers.pop(fd, None) is not None and self.poller is not None:
+            self.poller.unregister(fd)
+
+    def spawn(self, gen):
+        """Run a task generator on the loop
+        """
+        return Task(self, gen)
+
+    def run_in_executor(self, fn, *args):
+        """Run a blocking call on the thread pool
+        """
+        if self.executor is None:
+            self.work = Queue.Queue()
+            self.executor = []
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker,
+                                     name='expect-worker-%u' % i)
+                t.daemon = True
+                t.start()
+                self.executor.append(t)
+        fut = ExpectFuture()
+        self.work.put((fn, args, fut))
+        return fut
+
+    def _worker(self):
+        while True:
+            item = self.work.get()
+            if item is None:
+                return
+            fn, args, fut = item
+            try:
+                result = fn(*args)
+            except Exception as e:
+                self.call_soon_threadsafe(fut.set_exception, e)
+            else:
+                self.call_soon_threadsafe(fut.set_result, result)
+
+    def run_until_complete(self, futures, timeout=None):
+        """Run the loop until every future is done
+        Returns the list of futures
+        """
+        if isinstance(futures, ExpectFuture):
+            futures = [futures]
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not all([f.done() for f in futures]):
+            if deadline is not None and time.time() > deadline:
+                raise SSHExpectException('run_until_complete: timed out')
+            self._run_once(deadline)
+        return futures
+
+    def _run_once(self, deadline=None):
+        # Work out how long we may block
+        if self.ready:
+            wait = 0
+        elif self.timers:
+            wait = max(0, self.timers[0].when - time.time())
+        else:
+            wait = 1.0
+        if deadline is not None:
+            wait = min(wait, max(0, deadline - time.time()))
+        for fd in self._poll(wait):
+            if fd == self.waker_r.fileno():
+                try:
+                    self.waker_r.recv(4096)
+                except socket.error:
+                    pass
+                continue
+            fn = self.readers.get(fd)
+            if fn is not None:
+                self.ready.append((fn, ()))
+        with self.lock:
+            while self.threadsafe:
+                self.ready.append(self.threadsafe.popleft())
+        now = time.time()
+        while self.timers and self.timers[0].when <= now:
+            handle = heapq.heappop(self.timers)
+            if not handle.cancelled:
+                self.ready.append((handle.fn, handle.args))
+        # Only run what is ready now, callbacks may queue more
+        for i in range(len(self.ready)):
+            fn, args = self.ready.popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error('_run_once: callback %r Exception: %r', fn, e)
+
+    def _poll(self, wait):
+        if self.poller is not None:
+            return [fd for fd, event in
+                    self.poller.poll(int(math.ceil(wait * 1000)))]
+        fds = list(self.readers.keys()) + [self.waker_r.fileno()]
+        r, w, x = select.select(fds, [], [], wait)
+        return r
+
+    def close(self):
+        """Stop the thread pool and release the waker
+        """
+        if self.executor is not None:
+            for t in self.executor:
+                self.work.put(None)
+            self.executor = None
+        self.waker_r.close()
+        self.waker_w.close()
+
+class AsyncSSHExpect(object):
+    """Expect-like behaviour over SSH driven by an ExpectLoop
+    send, expect and send_recv return futures for a task to yield.
+    """
+    # Seconds between attempts to send into a full window
+    send_retry = 0.01
+
+    def __init__(self, loop, target, username, password, max_buffer=None):
+        self.loop = loop
+        self.target = target
+        self.username = username
+        self.password = password
+        self.max_buffer = max_buffer
+        self.client = None
+        self.channel = None
+        self.backlog = []
+        # [data left, size, future] of each send not yet on the wire
+        self.outgoing = deque()
+        self.flusher = None
+        self.eof = False
+        self.pending = None
+        self.timer = None
+        self.match = None
+
+    @classmethod
+    def open(cls, loop, target, username, password, max_buffer=None):
+        """Connect and return a future for the new session
+        """
+        sexp = cls(loop, target, username, password, max_buffer)
+        fut = ExpectFuture()
+
+        def connected(f):
+            if f.exception() is not None:
+                fut.set_exception(f.exception())
+                return
+            sexp.attach(f.result())
+            fut.set_result(sexp)
+        loop.run_in_executor(sexp._connect).add_done_callback(connected)
+        return fut
+
+    def _connect(self):
+        # Runs on an executor thread
+        client = SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.load_system_host_keys()
+        client.connect(self.target, username=self.username,
+                       password=self.password)
+        self.client = client
+        return client.invoke_shell()
+
+    def attach(self, channel):
+        """Start servicing an open shell channel from the loop
+        """
+        self.channel = channel
+        self.channel.setblocking(0)
+        self.loop.add_reader(self.channel.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        while self.channel.recv_ready():
+            try:
+                data = self.channel.recv(4096)
+            except socket.timeout:
+                break
+            if len(data) == 0:
+                break
+            logger.debug('recv: %s got resp: [%s]', self.target, data)
+            if self.pending is not None:
+                self._feed(data)
+            else:
+                self.backlog.append(data)
+        if (self.channel.closed or self.channel.eof_received) and \
+           not self.channel.recv_ready():
+            self.eof = True
+            self.loop.remove_reader(self.channel.fileno())
+            if self.pending is not None:
+                self._fail(SSHExpectException('recv: no match'))
+
+    def _feed(self, data):
+        fut, matcher, resp, deadline = self.pending
+        deadline.touch()
+        i = matcher.feed(data)
+        if i >= 0:
+            logger.debug('recv: %s match resp: [%s]', self.target, resp[i])
+            self._finish()
+            self.match = matcher.match
+            fut.set_result((i, matcher.output))
+
+    def _finish(self):
+        """Clear the pending expect, its timer and cancel callback
+        """
+        fut, matcher, resp, deadline = self.pending
+        self.pending = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if deadline.cancel is not None:
+            deadline.cancel.remove_callback(self._cancelled)
+        return fut, matcher
+
+    def _fail(self, exception):
+        fut, matcher = self._finish()
+        logger.error(matcher.output)
+        fut.set_exception(exception)
+
+    def send(self, s):
+        """Queue s on the channel, return a future for when it has all gone
+        Whatever the remote window has no room for is sent as it opens up,
+        so the loop never blocks on a slow reader.
+        """
+        logger.debug('send: %s [%s]', self.target, s)
+        fut = ExpectFuture()
+        self.outgoing.append([s, len(s), fut])
+        if self.flusher is None:
+            self._flush()
+        return fut
+
+    def _flush(self):
+        """Send queued data while the channel has window for it
+        """
+        self.flusher = None
+        while self.outgoing:
+            item = self.outgoing[0]
+            data, size, fut = item
+            try:
+                if not self.channel.send_ready():
+                    break
+                n = self.channel.send(data)
+                if n == 0:
+                    raise SSHExpectException('send: %s channel closed' %
+                                             self.target)
+            except socket.timeout:
+                break
+            except Exception as e:
+                self.outgoing.popleft()
+                fut.set_exception(e)
+                continue
+            item[0] = data[n:]
+            if not item[0]:
+                self.outgoing.popleft()
+                fut.set_result(size)
+        if self.outgoing:
+            # paramiko has no writable event, look again shortly
+            self.flusher = self.loop.call_later(self.send_retry, self._flush)
+
+    def expect(self, resp=[], timeout=10, inactivity=None, cancel=None):
+        """Return a future for (index, output) of the matched response
+        resp is a list of literals and compiled regexes, or a PatternSet, the
+        ExpectMatch is left in match once the future is done
+        timeout is an absolute deadline for this call and inactivity the
+        longest gap between pieces of output, in seconds. cancel is a
+        CancelToken that may be cancelled from any thread. The future fails
+        with SSHExpectTimeout, carrying the partial output.
+        """
+        if self.pending is not None:
+            raise SSHExpectException('expect: already waiting on %s' %
+                                     self.target)
+        fut = ExpectFuture()
+        deadline = Deadline(timeout, inactivity, cancel)
+        self.match = None
+        self.pending = (fut, expect_matcher(resp, self.max_buffer), resp,
+                        deadline)
+        self._arm()
+        if deadline.cancel is not None:
+            deadline.cancel.add_callback(self._cancelled)
+        backlog, self.backlog = self.backlog, []
+        for data in backlog:
+            if self.pending is None:
+                # Matched already, keep the rest for the next expect
+                self.backlog.append(data)
+            else:
+                self._feed(data)
+        if self.pending is not None and self.eof:
+            self._fail(SSHExpectException('recv: no match'))
+        return fut
+
+    def _arm(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        remaining = self.pending[3].remaining()
+        if remaining is not None:
+            self.timer = self.loop.call_later(remaining, self._check_deadline)
+
+    def _cancelled(self):
+        # Runs on the cancelling thread
+        self.loop.call_soon_threadsafe(self._check_deadline)
+
+    def _check_deadline(self):
+        if self.pending is None:
+            return
+        matcher, deadline = self.pending[1], self.pending[3]
+        reason = deadline.expired()
+        if reason is None:
+            # Output arrived since the timer was set, wait for the rest
+            self._arm()
+            return
+        self._fail(SSHExpectTimeout('recv: %s' % deadline.describe(reason),
+                                    matcher.output, reason))
+
+    def send_recv(self, cmd, resp=[], timeout=10, inactivity=None,
+                  cancel=None):
+        """Combine send and expect in a single call
+        """
+        sent = self.send(cmd)
+        if sent.exception() is not None:
+            return sent
+        fut = self.expect(resp, timeout, inactivity, cancel)
+
+        def send_failed(f):
+            if (f.exception() is not None and self.pending is not None and
+                self.pending[0] is fut):
+                self._fail(f.exception())
+        sent.add_done_callback(send_failed)
+        return fut
+
+    def close(self):
+        """Close the channel and SSH client
+        """
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        while self.outgoing:
+            self.outgoing.popleft()[2].set_exception(
+                SSHExpectException('send: %s closed' % self.target))
+        if self.channel is not None:
+            self.loop.remove_reader(self.channel.fileno())
+            self.channel.close()
+        if self.client is not None:
+            self.client.close()
@@ -10,22 +10,31 @@
 #       Print backtrace
 #       Detach thread
 #
+#    With --batch gdb attaches once per process instead, all thread
+#    statuses are read in one command and the parsed threads are also
+#    written as JSON next to the log
+#
+#    With --samples N one gdb samples all thread stacks N times instead,
+#    writing folded stacks for flame graphs and logging the hottest
+#    functions
+#
+#    With --targets the processes are captured on every host at once,
+#    under one deadline, and identical stacks are grouped across hosts
+#
+#    The per thread mode can --record its session and --replay it offline
+#
 # mdeacon@zorillaeng.com
 
-import subprocess
-import traceback
 import sys
-import argparse
-import ConfigParser
-from os import path, access, R_OK
 import os
+import json
 import traceback
 import logging
-import paramiko
 import signal
-from logging.handlers import RotatingFileHandler
-from zorilla.config import init_config, init_logging
+from zorilla.config import init_config, init_logging, get_log_path
 from zorilla.ssh_expect import SSHExpect
+from zorilla.host import Host
+from zorilla.gdbtrace import GdbTracer, SamplingProfiler, MultiCapture
 
 logger = logging.getLogger()
 
@@ -34,7 +43,11 @@ def sig_handler(signal, frame):
     sys.exit()
 
 def backtrace(args):
-    sexp = SSHExpect(args.ip_eth0, args.username, args.password)
+    if args.replay:
+        sexp = SSHExpect.replay(args.replay)
+    else:
+        sexp = SSHExpect(args.ip_eth0, args.username, args.password,
+                         record=args.record)
     resp = ['~]$']
     gdb_resp = ['(gdb)']
     sexp.send_recv('\n', resp)
@@ -60,7 +73,82 @@ def backtrace(args):
         sexp.send_recv('quit\n', resp)
     
     sexp.close()
-    
+
+def output_pathname(args, pathname, extension):
+    """pathname if given, otherwise next to the text log
+    """
+    if pathname:
+        return pathname
+    return os.path.join(get_log_path(),
+                        os.path.splitext(args.report)[0] + extension)
+
+def backtrace_batch(args):
+    """Attach gdb once per process and back trace all threads together
+    """
+    host = Host(args.ip_eth0, args.username, args.password)
+    tracer = GdbTracer(host, args.gdb)
+    records = tracer.capture(args.pathname, full=args.full)
+    separator = '=' * 35
+    for record in records:
+        logger.error('%stid: %u%s' % (separator, record.tid, separator))
+        logger.error('pid %u name %s state %s', record.pid, record.name,
+                     record.state)
+        for frame in record.frames:
+            location = frame['library'] or ''
+            if frame['file']:
+                location = '%s:%s' % (frame['file'], frame['line'])
+            logger.error('#%-3u %s (%s) %s', frame['level'],
+                         frame['function'], frame['args'], location)
+            for line in frame['locals']:
+                logger.error('        %s', line)
+    pathname = output_pathname(args, args.json, '.json')
+    with open(pathname, 'w') as f:
+        json.dump([record.to_dict() for record in records], f, indent=2)
+    logger.error('%u threads written to %s', len(records), pathname)
+
+def profile(args):
+    """Sample every thread's stack and report where the time goes
+    """
+    host = Host(args.ip_eth0, args.username, args.password)
+    pids = GdbTracer(host, args.gdb).pids(args.pathname)
+    if args.pid:
+        pids = [int(args.pid)]
+    if not pids:
+        logger.error('%s is not running', args.pathname)
+        return
+    if len(pids) > 1:
+        logger.error('%s has pids %r, sampling %u', args.pathname, pids,
+                     pids[0])
+    budget = None
+    if args.budget:
+        budget = float(args.budget)
+    profiler = SamplingProfiler(host, pids[0], int(args.samples),
+                                float(args.interval), float(args.max_pause),
+                                budget, args.gdb)
+    result = profiler.run()
+    for line in result.summary(int(args.top)):
+        logger.error(line)
+    pathname = output_pathname(args, args.folded, '.folded')
+    with open(pathname, 'w') as f:
+        for line in result.folded():
+            f.write(line + '\n')
+    logger.error('Folded stacks written to %s', pathname)
+
+def backtrace_multi(args):
+    """Capture comma separated processes on comma separated hosts together
+    """
+    targets = [t.strip() for t in args.targets.split(',') if t.strip()]
+    pathnames = [p.strip() for p in args.pathname.split(',') if p.strip()]
+    multi = MultiCapture(targets, pathnames, args.username, args.password,
+                         float(args.deadline), args.full, args.gdb)
+    report = multi.run()
+    for line in report.lines():
+        logger.error(line)
+    pathname = output_pathname(args, args.json, '.json')
+    with open(pathname, 'w') as f:
+        json.dump(report.to_dict(), f, indent=2)
+    logger.error('%u captures written to %s', len(report.captures), pathname)
+
 def main(argv=None):
     # Do argv default this way, as doing it in the functional
     # declaration sets it at compile time.
@@ -87,7 +175,33 @@ def main(argv=None):
     parser.add_argument("-a", "--ip_eth0", help="IP address for eth0")
     parser.add_argument("-u", "--username", help="username")
     parser.add_argument("-p", "--password", help="password")
-    parser.add_argument("pathname", help="Full pathname of binary") 
+    parser.add_argument("-b", "--batch", action='store_true',
+                        help="attach once per process, write JSON records")
+    parser.add_argument("--full", action='store_true',
+                        help="bt full, include local variables")
+    parser.add_argument("--json", help="JSON output pathname")
+    parser.add_argument("--gdb", default='/usr/bin/gdb', help="gdb pathname")
+    parser.add_argument("-s", "--samples",
+                        help="sample all thread stacks this many times")
+    parser.add_argument("--interval", default='0.5',
+                        help="seconds between samples")
+    parser.add_argument("--max_pause", default='1.0',
+                        help="longest a sample may keep the process stopped")
+    parser.add_argument("--budget",
+                        help="total seconds the process may be stopped")
+    parser.add_argument("--top", default='20', help="hottest functions shown")
+    parser.add_argument("--folded", help="folded stacks output pathname")
+    parser.add_argument("--pid", help="process to sample")
+    parser.add_argument("-t", "--targets",
+                        help="comma separated hosts to capture at once")
+    parser.add_argument("--deadline", default='30',
+                        help="overall seconds allowed with --targets")
+    parser.add_argument("--record", help="write the session to this "
+                        "transcript")
+    parser.add_argument("--replay", help="replay a transcript written with "
+                        "--record instead of connecting")
+    parser.add_argument("pathname", help="Full pathname of binary, "
+                        "comma separated with --targets") 
     args = parser.parse_args(remaining_argv)
 
     # Set up logging
@@ -98,7 +212,14 @@ def main(argv=None):
     signal.signal(signal.SIGINT, sig_handler)
 
     try:
-        backtrace(args)
+        if args.targets:
+            backtrace_multi(args)
+        elif args.samples:
+            profile(args)
+        elif args.batch:
+            backtrace_batch(args)
+        else:
+            backtrace(args)
     except Exception as e:
         logger.error('main: Exception: %r', e)
         logger.error('Traceback:\n%s', traceback.format_exc())
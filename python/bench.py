@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+#
+# Benchmark suite run against local SSH and serial stand-ins
+#
+#    A local SSH/SFTP server and pty serial consoles stand in for targets,
+#    with optional latency, bandwidth and output rate shaping. Results are
+#    written as JSON. Given a baseline, results that got worse by more than
+#    the threshold are flagged and the exit status is 1. The startup
+#    benchmark times a fresh interpreter importing the scripts.
+#
+# mdeacon@zorillaeng.com
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import logging
+import platform
+import signal
+import tempfile
+import threading
+import traceback
+import subprocess
+from zorilla.config import init_config, init_logging, get_log_path
+from zorilla.host import Host
+from zorilla.ssh_pool import SSHConnectionPool
+from zorilla.ssh_expect import SSHExpect
+from zorilla.serial_expect import SerialExpect
+from zorilla.output_capture import OutputCapture
+from zorilla.local_server import LocalSSHServer
+from zorilla.fake_serial import FakeSerialDevice
+from zorilla.transcript import Transcript, RECV
+
+logger = logging.getLogger()
+
+def sig_handler(signal, frame):
+    logger.error('Ctrl-c pressed...')
+    sys.exit()
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v.strip()]
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+class Results(object):
+    """Named measurements and whether higher is better for each
+    """
+    def __init__(self, meta):
+        self.meta = meta
+        self.values = {}
+
+    def add(self, name, value, unit, higher_is_better):
+        self.values[name] = {'value': value, 'unit': unit,
+                             'higher_is_better': higher_is_better}
+        logger.error('%-44s %12.3f %s', name, value, unit)
+
+    def to_dict(self):
+        return {'meta': self.meta, 'results': self.values}
+
+def compare(results, baseline, threshold):
+    """Log each result against the baseline
+    Returns the names that got worse by more than threshold percent
+    """
+    regressions = []
+    logger.error('%-44s %12s %12s %8s', 'benchmark', 'baseline', 'now',
+                 'change')
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        value = results[name]['value']
+        base = baseline[name]['value']
+        if not base:
+            continue
+        change = 100.0 * (value - base) / base
+        worse = -change if results[name]['higher_is_better'] else change
+        flag = ''
+        if worse > threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        logger.error('%-44s %12.3f %12.3f %+7.1f%% %s', name, base, value,
+                     change, flag)
+    return regressions
+
+def bench_sshcmd(host, results, count):
+    """Round trip of a trivial command on a pooled connection
+    """
+    host.sshcmd('true')
+    times = []
+    for i in range(count):
+        start = time.time()
+        host.sshcmd('true')
+        times.append(time.time() - start)
+    results.add('sshcmd_latency_median', 1000 * median(times), 'ms', False)
+    results.add('sshcmd_latency_p95', 1000 * percentile(times, 95), 'ms',
+                False)
+
+def bench_command(host, results, size):
+    """Streaming throughput of Host.command
+    """
+    capture = OutputCapture(spool=False)
+    start = time.time()
+    host.command('head -c %u /dev/zero | tr "\\0" "x" | fold -w 79' % size,
+                 capture=capture, echo=False)
+    elapsed = time.time() - start
+    results.add('command_throughput', capture.total / elapsed / 1048576.0,
+                'MB/s', True)
+
+def bench_scp(host, results, size, work_dir):
+    """scpfileto and scpfile of one file
+    """
+    local = os.path.join(work_dir, 'bench.bin')
+    with open(local, 'wb') as f:
+        f.write(os.urandom(size))
+    remote_dir = os.path.join(work_dir, 'remote')
+    os.makedirs(remote_dir)
+    start = time.time()
+    host.scpfileto(local, remote_dir + '/bench.bin')
+    results.add('scpfileto_throughput',
+                size / (time.time() - start) / 1048576.0, 'MB/s', True)
+    back = os.path.join(work_dir, 'back')
+    os.makedirs(back)
+    start = time.time()
+    host.scpfile(remote_dir + '/bench.bin', back)
+    results.add('scpfile_throughput',
+                size / (time.time() - start) / 1048576.0, 'MB/s', True)
+
+def output_transcript(size, prompt):
+    """A transcript of size bytes of output in 4 KB chunks, then the prompt
+    """
+    line = 'x' * 78 + '\r\n'
+    text = (line * (size // len(line) + 1))[:size] + prompt
+    events = [(0.0, RECV, text[i:i + 4096])
+              for i in range(0, len(text), 4096)]
+    return Transcript({'target': 'bench'}, events)
+
+def decoys(count):
+    """Patterns that never match, so every one is searched for
+    """
+    return ['no match %03u' % i for i in range(count)]
+
+def bench_recv(results, sizes, pattern_counts, prompt):
+    """Matching cost of SSHExpect.recv and SerialExpect.recv on replayed
+    output, per KB of output
+    """
+    for size in sizes:
+        transcript = output_transcript(size, prompt)
+        for count in pattern_counts:
+            patterns = decoys(count - 1) + [prompt.strip()]
+            for name, replay in (('ssh', SSHExpect.replay),
+                                 ('serial', SerialExpect.replay)):
+                runs = max(1, 4194304 // size)
+                start = time.time()
+                for i in range(runs):
+                    sexp = replay(transcript)
+                    sexp.recv(patterns)
+                    sexp.close()
+                elapsed = (time.time() - start) / runs
+                results.add('%s_recv_%ukb_%upat' % (name, size // 1024, count),
+                            1e6 * elapsed / (size / 1024.0), 'us/KB', False)
+
+def bench_serial(results, rate, size, prompt):
+    """Time for SerialExpect to match the prompt after size bytes of
+    console output from a pty, at the console output rate
+    """
+    device = FakeSerialDevice(prompt=prompt, rate=rate).start()
+    try:
+        sexp = SerialExpect(device.device)
+        sexp.send_recv('\n', [prompt.strip()])
+        start = time.time()
+        sexp.send_recv('out %u\n' % size, [prompt.strip()], timeout=600)
+        elapsed = time.time() - start
+        sexp.close()
+    finally:
+        device.stop()
+    results.add('serial_console_throughput', size / elapsed / 1024.0, 'KB/s',
+                True)
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def bench_ssh_up(results, delay, latency, bandwidth):
+    """How long after the server starts listening ssh_up notices
+    """
+    port = free_port()
+    server = LocalSSHServer(port=port, latency=latency, bandwidth=bandwidth)
+    started = {}
+
+    def start():
+        server.start()
+        started['time'] = time.time()
+
+    timer = threading.Timer(delay, start)
+    timer.start()
+    try:
+        host = Host('127.0.0.1', 'root', '', port=port)
+        host.ssh_up(retries=int(delay) // 5 + 4)
+        detected = time.time()
+    finally:
+        timer.join()
+        server.stop()
+    results.add('ssh_up_detection', 1000 * (detected - started['time']), 'ms',
+                False)
+
+IMPORT_PROBE = '''
+import sys, time
+start = time.time()
+import %s
+sys.stdout.write('%%r %%u\\n' %% (time.time() - start, len(sys.modules)))
+'''
+
+def importtime_top(stderr, count):
+    """The modules with the most cumulative time from -X importtime output
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        imports.append((int(fields[1]), fields[2].strip()))
+    return sorted(imports, reverse=True)[:count]
+
+def bench_startup(results, scripts, runs):
+    """Time for a fresh interpreter to start and import each script
+    With -X importtime, from Python 3.7, the slowest imports are logged
+    """
+    importtime = sys.version_info >= (3, 7)
+    for script in scripts:
+        module = 'zorilla.%s' % script
+        command = [sys.executable]
+        if importtime:
+            command += ['-X', 'importtime']
+        command += ['-c', IMPORT_PROBE % module]
+        totals = []
+        imports = []
+        for i in range(runs):
+            start = time.time()
+            process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            out, err = process.communicate()
+            totals.append(time.time() - start)
+            if process.returncode != 0:
+                raise RuntimeError('bench_startup: %s failed: %s' %
+                                   (module, err.strip()))
+            seconds, modules = out.split()
+            imports.append(float(seconds))
+        results.add('startup_%s' % script, 1000 * median(totals), 'ms', False)
+        results.add('startup_%s_import' % script, 1000 * median(imports),
+                    'ms', False)
+        results.add('startup_%s_modules' % script, int(modules), 'modules',
+                    False)
+        if importtime:
+            for us, name in importtime_top(err.decode(), 10):
+                logger.error('    %10.1f ms %s', us / 1000.0, name)
+
+def bench(args):
+    latency = float(args.latency) / 1000.0
+    bandwidth = None
+    if args.bandwidth:
+        bandwidth = int(float(args.bandwidth) * 1024)
+    rate = None
+    if args.rate:
+        rate = int(args.rate)
+    prompt = '[root@localhost ~]$ '
+    meta = {'time': time.time(), 'platform': platform.platform(),
+            'python': platform.python_version(), 'latency_ms': args.latency,
+            'bandwidth_kb_s': args.bandwidth, 'serial_rate': args.rate}
+    results = Results(meta)
+    only = None
+    if args.only:
+        only = set(args.only.split(','))
+
+    def wanted(name):
+        return only is None or name in only
+
+    server = LocalSSHServer(latency=latency, bandwidth=bandwidth,
+                            prompt=prompt).start()
+    work_dir = tempfile.mkdtemp(prefix='bench')
+    pool = SSHConnectionPool()
+    try:
+        host = Host('127.0.0.1', 'root', '', pool=pool, port=server.port)
+        host.progress_cb = lambda filename, size, sent, stats=None: None
+        if wanted('sshcmd'):
+            bench_sshcmd(host, results, int(args.count))
+        if wanted('command'):
+            bench_command(host, results, int(args.size))
+        if wanted('scp'):
+            bench_scp(host, results, int(args.size), work_dir)
+    finally:
+        pool.close_all()
+        server.stop()
+        shutil.rmtree(work_dir, True)
+    if wanted('recv'):
+        bench_recv(results, int_list(args.outputs), int_list(args.patterns),
+                   prompt)
+    if wanted('serial'):
+        bench_serial(results, rate, int(args.serial_size), prompt)
+    if wanted('ssh_up'):
+        bench_ssh_up(results, float(args.up_delay), latency, bandwidth)
+    if wanted('startup'):
+        bench_startup(results, args.startup.split(','),
+                      int(args.startup_runs))
+
+    pathname = args.json
+    if not pathname:
+        pathname = os.path.join(get_log_path(),
+                                os.path.splitext(args.report)[0] + '.json')
+    with open(pathname, 'w') as f:
+        json.dump(results.to_dict(), f, indent=2, sort_keys=True)
+    logger.error('Results written to %s', pathname)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results.values, baseline, float(args.threshold))
+        if regressions:
+            logger.error('%u regressions over %s%%: %s', len(regressions),
+                         args.threshold, ', '.join(regressions))
+            return 1
+    return 0
+
+def main(argv=None):
+    # Do argv default this way, as doing it in the functional
+    # declaration sets it at compile time.
+    if argv is None:
+        argv = sys.argv
+
+    # Default configuration
+    defaults = {'loglevel':'ERROR',
+                'report':''}
+
+    # Initialize configuration
+    # This is common to all test utilities
+    parser, remaining_argv = init_config(defaults)
+
+    # Custom parameters
+    parser.add_argument("--latency", default='0',
+                        help="one way SSH latency in ms")
+    parser.add_argument("--bandwidth", help="SSH bandwidth in KB/s each way")
+    parser.add_argument("--rate", help="serial console output bytes/s")
+    parser.add_argument("-n", "--count", default='50',
+                        help="sshcmd round trips")
+    parser.add_argument("-s", "--size", default='16777216',
+                        help="bytes for command and scp throughput")
+    parser.add_argument("--outputs", default='4096,65536,1048576',
+                        help="output sizes for recv matching")
+    parser.add_argument("--patterns", default='1,8,64',
+                        help="pattern counts for recv matching")
+    parser.add_argument("--serial_size", default='262144',
+                        help="bytes of serial console output")
+    parser.add_argument("--up_delay", default='2',
+                        help="seconds before the server comes up for ssh_up")
+    parser.add_argument("--startup", default='example,backtrace',
+                        help="scripts to time the startup of")
+    parser.add_argument("--startup_runs", default='10',
+                        help="interpreter starts per script")
+    parser.add_argument("--only", help="comma separated subset of sshcmd, "
+                        "command, scp, recv, serial, ssh_up, startup")
+    parser.add_argument("--json", help="results pathname")
+    parser.add_argument("-b", "--baseline", help="results to compare with")
+    parser.add_argument("--threshold", default='10',
+                        help="percent worse that counts as a regression")
+    args = parser.parse_args(remaining_argv)
+
+    # Set up logging
+    # This is common to all test utilities
+    init_logging(argv, args, logger)
+
+    # Install Ctrl-C handling
+    signal.signal(signal.SIGINT, sig_handler)
+
+    try:
+        return bench(args)
+    except Exception as e:
+        logger.error('main: Exception: %r', e)
+        logger.error('Traceback:\n%s', traceback.format_exc())
+        return -1
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,808 @@
+#!/usr/bin/env python
+#
+# Local broker sharing authenticated SSH transports between processes
+#
+#    Like an OpenSSH ControlMaster, the broker holds one authenticated
+#    transport per target and opens exec, shell and SFTP channels on it for
+#    client processes over a Unix domain socket, streaming the data back.
+#    Host and SSHExpect use it when it is running, so short lived scripts
+#    do not each pay for the key exchange and authentication.
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import json
+import time
+import errno
+import socket
+import select
+import struct
+import logging
+import threading
+import paramiko
+from paramiko import SSHClient
+from paramiko.channel import ChannelFile, ChannelStderrFile
+
+logger = logging.getLogger(__name__)
+
+# Frame header: kind, payload length
+FRAME = struct.Struct('>cI')
+# Broker to client
+OUT = b'o'
+ERR = b'e'
+EOF = b'f'
+STATUS = b'x'
+# Client to broker
+DATA = b'd'
+SHUTDOWN = b'w'
+RESIZE = b'r'
+# Either way
+CLOSE = b'c'
+
+MAX_FRAME = 65536
+# Output buffered by a client channel before the broker is held back
+MAX_BUFFERED = 4194304
+
+class BrokerException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+def get_broker_path():
+    """The broker socket, ZORILLA_BROKER if set, None if that is 'off'
+    """
+    path = os.environ.get('ZORILLA_BROKER')
+    if path == 'off':
+        return None
+    if not path:
+        path = os.path.join(os.path.expanduser('~'), '.zorilla',
+                            'broker.sock')
+    return path
+
+def send_frame(sock, kind, data=b''):
+    for i in range(0, max(1, len(data)), MAX_FRAME):
+        chunk = data[i:i + MAX_FRAME]
+        sock.sendall(FRAME.pack(kind, len(chunk)) + chunk)
+
+def recv_line(sock):
+    """Read a newline terminated line, return it and any bytes after it
+    """
+    data = b''
+    while b'\n' not in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise BrokerException('recv_line: connection closed')
+        data += chunk
+    line, rest = data.split(b'\n', 1)
+    return line, rest
+
+class FrameReader(object):
+    """Split a byte stream into (kind, payload) frames
+    """
+    def __init__(self):
+        self.data = b''
+
+    def feed(self, data):
+        self.data += data
+        frames = []
+        pos = 0
+        while pos + FRAME.size <= len(self.data):
+            kind, size = FRAME.unpack_from(self.data, pos)
+            if pos + FRAME.size + size > len(self.data):
+                break
+            start = pos + FRAME.size
+            frames.append((kind, self.data[start:start + size]))
+            pos = start + size
+        self.data = self.data[pos:]
+        return frames
+
+def broker_request(path, request):
+    """Connect to the broker and make a request
+    Returns the socket, the reply and any bytes that followed it. Raises
+    socket.error when no broker is listening and BrokerException when the
+    broker refuses the request.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(request) + '\n')
+        line, rest = recv_line(sock)
+        reply = json.loads(line)
+    except Exception:
+        sock.close()
+        raise
+    if 'error' in reply:
+        sock.close()
+        raise BrokerException(reply['error'])
+    return sock, reply, rest
+
+class BrokerChannel(object):
+    """Stand in for a paramiko Channel, relayed by the broker
+    Output is read into buffers by a thread. fileno() is readable while
+    there is output, so the channel can be passed to select like a
+    paramiko Channel.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.sock = None
+        self.pty = None
+        self.timeout = None
+        self.out = bytearray()
+        self.err = bytearray()
+        self.status = None
+        self.eof_received = False
+        self.closed = False
+        self.cond = threading.Condition()
+        self.send_lock = threading.Lock()
+        self.pipe = None
+        self.pipe_set = False
+        self.thread = None
+
+    def get_transport(self):
+        return self.client.transport
+
+    def get_name(self):
+        return 'broker:%s' % self.client.target
+
+    def get_pty(self, term='vt100', width=80, height=24, width_pixels=0,
+                height_pixels=0):
+        self.pty = [term, width, height]
+
+    def exec_command(self, command):
+        self.open({'kind': 'exec', 'command': command})
+
+    def invoke_shell(self):
+        self.open({'kind': 'shell'})
+
+    def invoke_subsystem(self, subsystem):
+        self.open({'kind': 'subsystem', 'subsystem': subsystem})
+
+    def open(self, request):
+        if self.sock is not None:
+            raise BrokerException('open: channel already in use')
+        request.update(self.client.target_request())
+        request['pty'] = self.pty
+        self.sock, reply, rest = broker_request(self.client.path, request)
+        self.thread = threading.Thread(target=self.run, args=(rest,),
+                                       name='broker-channel')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, rest):
+        reader = FrameReader()
+        data = rest
+        try:
+            while True:
+                for kind, payload in reader.feed(data):
+                    self.received(kind, payload)
+                data = self.sock.recv(MAX_FRAME)
+                if not data:
+                    break
+        except (socket.error, AttributeError):
+            pass
+        with self.cond:
+            self.eof_received = True
+            self.closed = True
+            self.update_pipe()
+            self.cond.notify_all()
+
+    def received(self, kind, payload):
+        with self.cond:
+            if kind == OUT:
+                self.out += payload
+            elif kind == ERR:
+                self.err += payload
+            elif kind == EOF:
+                self.eof_received = True
+            elif kind == STATUS:
+                self.status = struct.unpack('>i', payload)[0]
+            elif kind == CLOSE:
+                self.eof_received = True
+                self.closed = True
+            self.update_pipe()
+            self.cond.notify_all()
+            # Hold the broker back until the output is read
+            while (len(self.out) + len(self.err) > MAX_BUFFERED and
+                   self.sock is not None):
+                self.cond.wait(1.0)
+
+    def update_pipe(self):
+        """Keep the pipe readable while there is anything to read
+        """
+        if self.pipe is None:
+            return
+        ready = bool(self.out or self.err or self.eof_received or
+                     self.status is not None)
+        if ready and not self.pipe_set:
+            os.write(self.pipe[1], b'*')
+            self.pipe_set = True
+        elif not ready and self.pipe_set:
+            os.read(self.pipe[0], 1)
+            self.pipe_set = False
+
+    def fileno(self):
+        with self.cond:
+            if self.pipe is None:
+                self.pipe = os.pipe()
+                self.update_pipe()
+            return self.pipe[0]
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def setblocking(self, blocking):
+        self.timeout = None if blocking else 0.0
+
+    def read_buffer(self, name, nbytes):
+        with self.cond:
+            deadline = None
+            if self.timeout is not None:
+                deadline = time.time() + self.timeout
+            while not (getattr(self, name) or self.eof_received or
+                       self.closed):
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise socket.timeout()
+                self.cond.wait(remaining)
+            buf = getattr(self, name)
+            data = bytes(buf[:nbytes])
+            del buf[:nbytes]
+            self.update_pipe()
+            self.cond.notify_all()
+            return data
+
+    def recv(self, nbytes):
+        return self.read_buffer('out', nbytes)
+
+    def recv_stderr(self, nbytes):
+        return self.read_buffer('err', nbytes)
+
+    def recv_ready(self):
+        return len(self.out) > 0
+
+    def recv_stderr_ready(self):
+        return len(self.err) > 0
+
+    def exit_status_ready(self):
+        return self.closed or self.status is not None
+
+    def recv_exit_status(self):
+        with self.cond:
+            while self.status is None and not self.closed:
+                self.cond.wait(1.0)
+            if self.status is None:
+                return -1
+            return self.status
+
+    def send(self, s):
+        if self.closed or self.sock is None:
+            raise socket.error('Socket is closed')
+        with self.send_lock:
+            send_frame(self.sock, DATA, s)
+        return len(s)
+
+    def sendall(self, s):
+        self.send(s)
+
+    def shutdown_write(self):
+        with self.send_lock:
+            send_frame(self.sock, SHUTDOWN)
+
+    def resize_pty(self, width=80, height=24, width_pixels=0,
+                   height_pixels=0):
+        with self.send_lock:
+            send_frame(self.sock, RESIZE, struct.pack('>II', width, height))
+
+    def makefile(self, *params):
+        return ChannelFile(*([self] + list(params)))
+
+    def makefile_stderr(self, *params):
+        return ChannelStderrFile(*([self] + list(params)))
+
+    def close(self):
+        with self.cond:
+            sock, self.sock = self.sock, None
+            self.closed = True
+            self.cond.notify_all()
+        if sock is not None:
+            try:
+                with self.send_lock:
+                    send_frame(sock, CLOSE)
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.pipe is not None:
+            for fd in self.pipe:
+                os.close(fd)
+            self.pipe = None
+
+class BrokerTransport(object):
+    """Stand in for a paramiko Transport, opening channels via the broker
+    """
+    def __init__(self, client):
+        self.client = client
+        self.active = True
+
+    def open_session(self, window_size=None, max_packet_size=None,
+                     timeout=None):
+        if not self.active:
+            raise BrokerException('open_session: transport is closed')
+        return BrokerChannel(self.client)
+
+    def is_active(self):
+        return self.active
+
+    def is_authenticated(self):
+        return self.active
+
+    def send_ignore(self, byte_count=None):
+        self.client.request('connect')
+
+    def getpeername(self):
+        return (self.client.target, self.client.port)
+
+    def close(self):
+        self.active = False
+
+class BrokerClient(object):
+    """Stand in for a paramiko SSHClient whose transport is in the broker
+    e.g.:
+    client = broker.connect('10.0.0.1', 22, 'root', password)
+    if client is None:
+        # No broker running, connect directly
+    channel = client.get_transport().open_session()
+    channel.exec_command('uptime')
+    """
+    def __init__(self, path, target, port=22, username='root', password='',
+                 timeout=None):
+        self.path = path
+        self.target = target
+        self.port = port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.transport = BrokerTransport(self)
+
+    def target_request(self):
+        return {'target': self.target, 'port': self.port,
+                'username': self.username, 'password': self.password,
+                'timeout': self.timeout}
+
+    def request(self, kind):
+        """Make a request that needs no channel and return the reply
+        """
+        request = self.target_request()
+        request['kind'] = kind
+        sock, reply, rest = broker_request(self.path, request)
+        sock.close()
+        return reply
+
+    def get_transport(self):
+        return self.transport
+
+    def invoke_shell(self, term='vt100', width=80, height=24, width_pixels=0,
+                     height_pixels=0, environment=None):
+        channel = self.transport.open_session()
+        channel.get_pty(term, width, height)
+        channel.invoke_shell()
+        return channel
+
+    def exec_command(self, command, bufsize=-1, timeout=None, get_pty=False,
+                     environment=None):
+        channel = self.transport.open_session()
+        if get_pty:
+            channel.get_pty()
+        channel.settimeout(timeout)
+        channel.exec_command(command)
+        return (channel.makefile('wb', bufsize), channel.makefile('r', bufsize),
+                channel.makefile_stderr('r', bufsize))
+
+    def open_sftp(self):
+        return paramiko.SFTPClient.from_transport(self.transport)
+
+    def close(self):
+        self.transport.close()
+
+def connect(target, port=22, username='root', password='', timeout=None,
+            path=None):
+    """A BrokerClient when a broker is listening, None otherwise
+    The broker connects and authenticates to the target if it has not
+    already. Raises BrokerException if that fails.
+    """
+    if path is None:
+        path = get_broker_path()
+    if path is None or not os.path.exists(path):
+        return None
+    client = BrokerClient(path, target, port, username, password, timeout)
+    try:
+        client.request('connect')
+    except socket.error as e:
+        logger.debug('connect: no broker on %s: %r', path, e)
+        return None
+    return client
+
+class SharedConnection(object):
+    """An authenticated SSH client held by the broker for one target
+    """
+    # Connections unused for probe_after seconds are probed before use
+    probe_after = 30
+    # Seconds allowed to open a channel, unless the request gives a timeout
+    open_timeout = 30
+    # Channels open at once, more wait for one to close. sshd refuses more
+    # than MaxSessions, 10 by default.
+    max_channels = 10
+
+    def __init__(self, key):
+        self.key = key
+        self.client = None
+        self.lock = threading.Lock()
+        self.users = 0
+        self.last_used = time.time()
+        self.handshakes = 0
+        self.channels = 0
+        self.open_channels = 0
+        self.slots = threading.Condition()
+
+    def is_alive(self, probe=False):
+        """Check the transport is up
+        When probe is set, push an SSH_MSG_IGNORE to detect a dead peer
+        """
+        if self.client is None:
+            return False
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        if probe:
+            try:
+                transport.send_ignore()
+            except Exception as e:
+                logger.debug('is_alive: %s send_ignore: %r', self.key, e)
+                return False
+        return True
+
+    def connect(self, request):
+        """Connect and authenticate unless already done
+        Concurrent requests for the target wait for one handshake.
+        """
+        with self.lock:
+            idle = time.time() - self.last_used
+            if self.is_alive(probe=idle > self.probe_after):
+                return
+            self.close()
+            client = SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.load_system_host_keys()
+            client.connect(request['target'], port=request.get('port', 22),
+                           username=request.get('username'),
+                           password=request.get('password'),
+                           timeout=request.get('timeout'))
+            self.client = client
+            self.handshakes += 1
+            logger.error('connect: %s@%s:%s authenticated', self.key[2],
+                         self.key[0], self.key[1])
+
+    def open(self, request):
+        """Open a channel for an exec, shell or subsystem request
+        Waits up to the open timeout for one of max_channels. If the open
+        fails the connection is only closed when it timed out or the peer
+        no longer answers a probe, a target that went away without a reset
+        is connected again by the next request. Pass the channel to finish
+        when done with it.
+        """
+        kind = request['kind']
+        if kind not in ('exec', 'shell', 'subsystem'):
+            raise BrokerException('open: unknown request %r' % kind)
+        timeout = request.get('timeout') or self.open_timeout
+        self.take_slot(timeout)
+        with self.lock:
+            client = self.client
+        if client is None:
+            self.give_slot()
+            raise BrokerException('open: %s@%s:%s is not connected' %
+                                  (self.key[2], self.key[0], self.key[1]))
+        start = time.time()
+        channel = None
+        try:
+            channel = client.get_transport().open_session(timeout=timeout)
+            if request.get('pty'):
+                term, width, height = request['pty']
+                channel.get_pty(term, width, height)
+            if kind == 'exec':
+                channel.exec_command(request['command'])
+            elif kind == 'shell':
+                channel.invoke_shell()
+            else:
+                channel.invoke_subsystem(request['subsystem'])
+        except Exception as e:
+            if channel is not None:
+                channel.close()
+            self.give_slot()
+            timed_out = time.time() - start >= timeout
+            with self.lock:
+                if self.client is client and (timed_out or
+                                              not self.is_alive(probe=True)):
+                    logger.error('open: %s@%s:%s %r, closing the connection',
+                                 self.key[2], self.key[0], self.key[1], e)
+                    self.close()
+                else:
+                    logger.error('open: %s@%s:%s %r', self.key[2],
+                                 self.key[0], self.key[1], e)
+            raise
+        self.channels += 1
+        return channel
+
+    def finish(self, channel):
+        """Close a channel from open and free its slot
+        """
+        try:
+            channel.close()
+        finally:
+            self.give_slot()
+
+    def take_slot(self, timeout):
+        end = time.time() + timeout
+        with self.slots:
+            while self.open_channels >= self.max_channels:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    raise BrokerException('open: %s@%s:%s has %u channels '
+                                          'open' % (self.key[2], self.key[0],
+                                                    self.key[1],
+                                                    self.open_channels))
+                self.slots.wait(remaining)
+            self.open_channels += 1
+
+    def give_slot(self):
+        with self.slots:
+            self.open_channels -= 1
+            self.slots.notify()
+
+    def close(self):
+        if self.client is not None:
+            try:
+                self.client.close()
+            except Exception as e:
+                logger.debug('close: %s Exception: %r', self.key, e)
+            self.client = None
+
+class SSHBroker(object):
+    """Serve channels on shared SSH connections over a Unix domain socket
+    Connections with no open channels for idle_timeout seconds are closed.
+    With exit_idle the broker stops after that many seconds without any.
+    e.g.:
+    broker = SSHBroker(idle_timeout=300)
+    broker.serve()
+    """
+    def __init__(self, path=None, idle_timeout=300, exit_idle=None):
+        if path is None:
+            path = get_broker_path()
+        if path is None:
+            raise BrokerException('__init__: broker is turned off')
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.exit_idle = exit_idle
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.sock = None
+        self.thread = None
+        self.running = False
+        self.handlers = 0
+        self.last_active = time.time()
+
+    def listen(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                raise BrokerException('listen: a broker is already '
+                                      'listening on %s' % self.path)
+            except socket.error:
+                os.unlink(self.path)
+            finally:
+                probe.close()
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(128)
+        self.running = True
+
+    def start(self):
+        """Serve from a thread
+        """
+        self.listen()
+        self.thread = threading.Thread(target=self.serve, name='ssh-broker')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def serve(self):
+        if self.sock is None:
+            self.listen()
+        logger.error('serve: listening on %s', self.path)
+        try:
+            while self.running:
+                try:
+                    ready, _, _ = select.select([self.sock], [], [], 1.0)
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if ready:
+                    sock, _ = self.sock.accept()
+                    with self.lock:
+                        self.handlers += 1
+                    handler = threading.Thread(target=self.handle,
+                                               args=(sock,),
+                                               name='broker-handler')
+                    handler.daemon = True
+                    handler.start()
+                self.reap()
+        finally:
+            self.close()
+
+    def reap(self):
+        """Close idle connections, stop when idle for exit_idle
+        """
+        now = time.time()
+        with self.lock:
+            for key, conn in self.connections.items():
+                if conn.users == 0 and now - conn.last_used > self.idle_timeout:
+                    logger.error('reap: closing idle %s@%s:%s', key[2], key[0],
+                                 key[1])
+                    conn.close()
+                    del self.connections[key]
+            if self.connections or self.handlers:
+                self.last_active = now
+            elif (self.exit_idle is not None and
+                  now - self.last_active > self.exit_idle):
+                logger.error('reap: idle for %ss, exiting', self.exit_idle)
+                self.running = False
+
+    def acquire(self, request):
+        key = (request['target'], request.get('port', 22),
+               request.get('username'), request.get('password'))
+        with self.lock:
+            conn = self.connections.get(key)
+            if conn is None:
+                conn = SharedConnection(key)
+                self.connections[key] = conn
+            conn.users += 1
+        return conn
+
+    def release(self, conn):
+        with self.lock:
+            conn.users -= 1
+            conn.last_used = time.time()
+
+    def status(self):
+        with self.lock:
+            return [{'target': key[0], 'port': key[1], 'username': key[2],
+                     'users': conn.users, 'handshakes': conn.handshakes,
+                     'channels': conn.channels,
+                     'open': conn.open_channels,
+                     'idle': time.time() - conn.last_used}
+                    for key, conn in self.connections.items()]
+
+    def handle(self, sock):
+        conn = None
+        replied = False
+        try:
+            line, rest = recv_line(sock)
+            request = json.loads(line)
+            kind = request.get('kind')
+            if kind == 'status':
+                sock.sendall(json.dumps({'connections': self.status(),
+                                         'pid': os.getpid()}) + '\n')
+                return
+            if kind == 'stop':
+                self.running = False
+                sock.sendall(json.dumps({'stopping': True}) + '\n')
+                return
+            conn = self.acquire(request)
+            conn.connect(request)
+            if kind == 'connect':
+                sock.sendall(json.dumps({'connected': True}) + '\n')
+                return
+            channel = conn.open(request)
+            try:
+                sock.sendall(json.dumps({'opened': kind}) + '\n')
+                replied = True
+                self.relay(sock, channel, rest)
+            finally:
+                conn.finish(channel)
+        except Exception as e:
+            logger.debug('handle: Exception: %r', e)
+            if not replied:
+                try:
+                    sock.sendall(json.dumps({'error': str(e) or repr(e)}) +
+                                 '\n')
+                except socket.error:
+                    pass
+        finally:
+            sock.close()
+            if conn is not None:
+                self.release(conn)
+            with self.lock:
+                self.handlers -= 1
+
+    def relay(self, sock, channel, rest):
+        """Relay a channel to a client until either closes it
+        """
+        reader = FrameReader()
+        frames = reader.feed(rest)
+        eof_sent = False
+        status_sent = False
+        while True:
+            for kind, payload in frames:
+                if kind == DATA:
+                    channel.sendall(payload)
+                elif kind == SHUTDOWN:
+                    channel.shutdown_write()
+                elif kind == RESIZE:
+                    channel.resize_pty(*struct.unpack('>II', payload))
+                elif kind == CLOSE:
+                    return
+            while channel.recv_ready():
+                send_frame(sock, OUT, channel.recv(MAX_FRAME))
+            while channel.recv_stderr_ready():
+                send_frame(sock, ERR, channel.recv_stderr(MAX_FRAME))
+            if not (channel.recv_ready() or channel.recv_stderr_ready()):
+                if channel.eof_received and not eof_sent:
+                    send_frame(sock, EOF)
+                    eof_sent = True
+                if channel.exit_status_ready() and not status_sent:
+                    send_frame(sock, STATUS,
+                               struct.pack('>i', channel.recv_exit_status()))
+                    status_sent = True
+                if channel.closed:
+                    send_frame(sock, CLOSE)
+                    return
+            # After EOF the channel stays readable, so only poll it
+            if eof_sent:
+                ready, _, _ = select.select([sock], [], [], 0.1)
+            else:
+                ready, _, _ = select.select([sock, channel], [], [], 1.0)
+            frames = []
+            if sock in ready:
+                data = sock.recv(MAX_FRAME)
+                if not data:
+                    return
+                frames = reader.feed(data)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.running = False
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        with self.lock:
+            for conn in self.connections.values():
+                conn.close()
+            self.connections = {}
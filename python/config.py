@@ -11,13 +11,12 @@ from os import path, access, R_OK
 import os
 import sys
 import time
-import paramiko
-import platform
-import glob2
+import atexit
 import shutil
 import logging
 import logging.handlers
 from logging.handlers import RotatingFileHandler
+from zorilla import metrics
 
 def get_data_path():
     """Return the package 'data' path
@@ -92,6 +91,8 @@ def init_config(in_defaults, section = 'Defaults'):
     parser.add_argument("-l", "--loglevel", help="set log level",
                         choices=['DEBUG','INFO','WARNING','ERROR','CRITICAL'])
     parser.add_argument("-r", "--report", help="report filename")
+    parser.add_argument("--metrics", help="record latency metrics, written "
+                        "to this Prometheus text file at exit")
 
     # Caller can now add custom arguments
     return parser, remaining_argv
@@ -124,8 +125,36 @@ def init_logging(argv, args, logger):
 
     logger.setLevel(args.loglevel)
 
-    # Assign log for paramiko events
-    paramiko.util.log_to_file(os.path.join(log_path, 'paramiko.log'))
-    logging.getLogger("paramiko").setLevel(args.loglevel)
+    # Assign log for paramiko events, as paramiko.util.log_to_file does
+    # without importing paramiko
+    paramiko_logger = logging.getLogger("paramiko")
+    if not paramiko_logger.handlers:
+        paramiko_fh = logging.FileHandler(os.path.join(log_path,
+                                                       'paramiko.log'))
+        paramiko_fh.setFormatter(logging.Formatter(
+            '%(levelname)-.3s [%(asctime)s.%(msecs)03d] thr=%(thread)d '
+            '%(name)s: %(message)s', '%Y%m%d-%H:%M:%S'))
+        paramiko_logger.addHandler(paramiko_fh)
+    paramiko_logger.setLevel(args.loglevel)
+
+    # Latency metrics are summarized in the report at exit
+    pathname = getattr(args, 'metrics', None)
+    if pathname:
+        metrics.enable()
+    atexit.register(write_metrics, logger, pathname)
 
     return args.report
+
+def write_metrics(logger, pathname=None):
+    """Log a summary of the metrics recorded, if any, and write them to
+    pathname in the Prometheus text format
+    """
+    lines = metrics.registry.summary()
+    if not lines:
+        return
+    logger.error('Metrics:')
+    for line in lines:
+        logger.error(line)
+    if pathname:
+        metrics.registry.write_textfile(pathname)
+        logger.error('Metrics written to %s', pathname)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# Deadlines, inactivity timeouts and cancellation for blocking waits
+#
+#    A Deadline bounds one wait overall and, optionally, between pieces of
+#    output. A CancelToken ends it early from another thread. Callers read
+#    in slices of wait() and stop when expired() gives a reason.
+#
+# mdeacon@zorillaeng.com
+#
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+CANCELLED = 'cancelled'
+DEADLINE = 'deadline'
+INACTIVITY = 'inactivity'
+
+class ExpectTimeout(Exception):
+    """A wait ended by its deadline, inactivity timeout or cancellation
+    output is what had been received when it ended, reason is one of
+    'deadline', 'inactivity' or 'cancelled'
+    """
+    def __init__(self, value, output='', reason=DEADLINE):
+        self.value = value
+        self.output = output
+        self.reason = reason
+
+    def __str__(self):
+        return repr(self.value)
+
+class CancelToken(object):
+    """Cancel waits from another thread
+    Callbacks run once, on the cancelling thread.
+    e.g.:
+    token = CancelToken()
+    threading.Timer(60, token.cancel).start()
+    sexp.send_recv('make\n', ['~]$'], timeout=3600, cancel=token)
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.reason = None
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self, reason=CANCELLED):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.reason = reason
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception as e:
+                logger.error('cancel: callback Exception: %r', e)
+
+    def add_callback(self, fn):
+        """Call fn on cancel, at once if already cancelled
+        """
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(fn)
+                return
+        fn()
+
+    def remove_callback(self, fn):
+        with self.lock:
+            if fn in self.callbacks:
+                self.callbacks.remove(fn)
+
+    def wait(self, timeout=None):
+        """Block until cancelled or timeout, True if cancelled
+        """
+        self.event.wait(timeout)
+        return self.event.is_set()
+
+_local = threading.local()
+
+def current_cancel():
+    """The CancelToken of the innermost cancel_scope on this thread
+    """
+    return getattr(_local, 'cancel', None)
+
+@contextmanager
+def cancel_scope(token):
+    """Make token the default for Deadlines created on this thread
+    """
+    previous = current_cancel()
+    _local.cancel = token
+    try:
+        yield token
+    finally:
+        _local.cancel = previous
+
+class Deadline(object):
+    """Limits for one wait, all in seconds, None for no limit
+    timeout is the overall limit, inactivity the longest gap between
+    pieces of output. Without a cancel token the cancel_scope of the
+    calling thread, if any, is used.
+    e.g.:
+    deadline = Deadline(30, inactivity=5)
+    while not deadline.expired():
+        data = read(deadline.wait())
+        if data:
+            deadline.touch()
+    """
+    # Longest single block while a cancel token is watched
+    poll = 0.25
+
+    def __init__(self, timeout=None, inactivity=None, cancel=None):
+        self.start = time.time()
+        self.last = self.start
+        self.timeout = timeout
+        self.inactivity = inactivity
+        if cancel is None:
+            cancel = current_cancel()
+        self.cancel = cancel
+
+    def touch(self):
+        """Output arrived, restart the inactivity timeout
+        """
+        self.last = time.time()
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def remaining(self):
+        """Seconds until the overall or inactivity limit, None if neither
+        """
+        now = time.time()
+        limits = []
+        if self.timeout is not None:
+            limits.append(self.start + self.timeout - now)
+        if self.inactivity is not None:
+            limits.append(self.last + self.inactivity - now)
+        if not limits:
+            return None
+        return max(0.0, min(limits))
+
+    def wait(self):
+        """Seconds to block for the next read
+        Short enough to notice a cancel, never 0 so a read still polls
+        """
+        wait = self.remaining()
+        if self.cancel is not None:
+            wait = self.poll if wait is None else min(wait, self.poll)
+        if wait is not None:
+            wait = max(wait, 0.001)
+        return wait
+
+    def expired(self):
+        """The reason the wait is over, None while it may go on
+        """
+        if self.cancel is not None and self.cancel.cancelled:
+            return CANCELLED
+        now = time.time()
+        if self.timeout is not None and now >= self.start + self.timeout:
+            return DEADLINE
+        if self.inactivity is not None and now >= self.last + self.inactivity:
+            return INACTIVITY
+        return None
+
+    def describe(self, reason):
+        if reason == CANCELLED:
+            return 'cancelled after %.1f s' % self.elapsed()
+        if reason == INACTIVITY:
+            return 'no output for %.1f s' % self.inactivity
+        return 'timed out after %.1f s' % self.elapsed()
+
+    def __repr__(self):
+        return 'Deadline(timeout %r inactivity %r remaining %r)' % (
+            self.timeout, self.inactivity, self.remaining())
@@ -2,26 +2,19 @@
 #
 # Example demonstrating use of SSHExpect and SerialExpect
 #
+#    With --record the sessions are written to transcripts, with --replay
+#    they are served from them and no host or serial port is needed
+#
 # mdeacon@zorillaeng.com
 #
 
-import argparse
-import ConfigParser
-from os import path, access, R_OK
-import os
 import sys
-import time
-import paramiko
-import platform
-import glob2
-import shutil
 import logging
 import signal
 import traceback
 from zorilla.config import init_config, init_logging
 from zorilla.ssh_expect import SSHExpect
 from zorilla.serial_expect import SerialExpect
-from zorilla.host import Host
 
 logger = logging.getLogger()
 
@@ -29,12 +22,23 @@ def sig_handler(signal, frame):
     logger.error('Ctrl-c pressed...')
     sys.exit()
 
+def transcript_pathname(prefix, kind):
+    """Transcript of one kind of session for a --record or --replay prefix
+    """
+    if not prefix:
+        return None
+    return '%s-%s.ztr' % (prefix, kind)
+
 def serial_expect_example(args):
     """Connect to a Linux host over RS-232
     List files at the root directory
     """
     logger.error('serial_example...')
-    sexp = SerialExpect(args.serial_port, args.baud_rate)
+    if args.replay:
+        sexp = SerialExpect.replay(transcript_pathname(args.replay, 'serial'))
+    else:
+        sexp = SerialExpect(args.serial_port, args.baud_rate,
+                            record=transcript_pathname(args.record, 'serial'))
     idx, output = sexp.send_recv('\n', ['login:', '~]$'])
     if idx == 0:
         idx, output = sexp.send_recv(args.username + '\n', ['Password', '~]$'])
@@ -48,7 +52,11 @@ def ssh_expect_example(args):
     List files at the root directory
     """
     logger.error('ssh_example...')
-    sexp = SSHExpect(args.ip_eth0, args.username, args.password)
+    if args.replay:
+        sexp = SSHExpect.replay(transcript_pathname(args.replay, 'ssh'))
+    else:
+        sexp = SSHExpect(args.ip_eth0, args.username, args.password,
+                         record=transcript_pathname(args.record, 'ssh'))
     sexp.send_recv(args.password + '\n', ['~]$'])
     sexp.send_recv('/bin/ls -l /\n', ['~]$'])
     sexp.close()
@@ -85,6 +93,10 @@ def main(argv=None):
     parser.add_argument("-a", "--ip_eth0", help="IP address for eth0")
     parser.add_argument("-u", "--username", help="Username")
     parser.add_argument("-p", "--password", help="Password")
+    parser.add_argument("--record", help="write transcripts to "
+                        "<RECORD>-ssh.ztr and <RECORD>-serial.ztr")
+    parser.add_argument("--replay", help="replay transcripts written with "
+                        "--record RECORD")
     args = parser.parse_args(remaining_argv)
 
     # Set up logging
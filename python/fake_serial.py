@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Serial console stand-in on a pty
+#
+#    The device end is a pty slave that SerialExpect or SerialManager open
+#    like a USB serial port. Lines sent to it are answered, followed by a
+#    prompt, at a limited output rate.
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import time
+import errno
+import select
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+def default_respond(line):
+    """'out N' prints N bytes of text, 'echo ...' prints the rest of the
+    line, anything else prints nothing
+    """
+    words = line.split(None, 1)
+    if not words:
+        return ''
+    if words[0] == 'out' and len(words) > 1:
+        size = int(words[1])
+        text = ('%s\r\n' % ('x' * 62)) * (size // 64 + 1)
+        return text[:size]
+    if words[0] == 'echo':
+        return (words[1] if len(words) > 1 else '') + '\r\n'
+    return ''
+
+class FakeSerialDevice(object):
+    """A console on a pty
+    respond(line) returns the output for each line received. rate limits
+    the output to bytes per second, e.g. 11520 for 115200 baud.
+    e.g.:
+    dev = FakeSerialDevice(rate=11520).start()
+    sexp = SerialExpect(dev.device)
+    sexp.send_recv('out 4096\n', ['~]$'])
+    dev.stop()
+    """
+    def __init__(self, prompt='[root@localhost ~]$ ', rate=None, respond=None,
+                 echo=False):
+        self.prompt = prompt
+        self.rate = rate
+        self.respond = respond or default_respond
+        self.echo = echo
+        self.master = None
+        self.slave = None
+        self.device = None
+        self.thread = None
+        self.running = False
+        self.written = 0
+
+    def start(self):
+        self.master, self.slave = os.openpty()
+        self.device = os.ttyname(self.slave)
+        self.running = True
+        self.thread = threading.Thread(target=self.run,
+                                       name='fake-serial-%s' % self.device)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def write(self, data):
+        """Write to the console at the output rate
+        """
+        chunk = 4096
+        if self.rate:
+            # Small enough that pacing stays smooth
+            chunk = max(1, min(chunk, self.rate // 20))
+        start = time.time()
+        sent = 0
+        while sent < len(data) and self.running:
+            n = os.write(self.master, data[sent:sent + chunk])
+            sent += n
+            if self.rate:
+                pause = start + float(sent) / self.rate - time.time()
+                if pause > 0:
+                    time.sleep(pause)
+        self.written += sent
+
+    def run(self):
+        line = ''
+        while self.running:
+            try:
+                ready, _, _ = select.select([self.master], [], [], 0.2)
+                if not ready:
+                    continue
+                data = os.read(self.master, 4096)
+            except (OSError, select.error) as e:
+                if getattr(e, 'errno', None) == errno.EINTR:
+                    continue
+                break
+            if len(data) == 0:
+                break
+            if self.echo:
+                self.write(data)
+            line = (line + data).replace('\r\n', '\n')
+            while '\n' in line or '\r' in line:
+                n = min([i for i in (line.find('\n'), line.find('\r'))
+                         if i >= 0])
+                command, line = line[:n], line[n + 1:]
+                self.write(self.respond(command.strip()) + self.prompt)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.master = self.slave = None
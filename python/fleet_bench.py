@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#
+# Scaling of ProcessHostGroup from 1 to N worker processes
+#
+#    Local SSH servers run in their own processes, each listening on all
+#    loopback addresses so every target is a different host to the pool.
+#    For each worker count one run connects to every target, with the key
+#    exchange that costs, and a second run reuses the connections.
+#    HostGroup with threads only is run last for comparison.
+#
+# mdeacon@zorillaeng.com
+
+import sys
+import time
+import logging
+import signal
+import traceback
+import multiprocessing
+from zorilla.config import init_config, init_logging
+from zorilla.host import Host
+from zorilla.host_group import HostGroup
+from zorilla.ssh_pool import SSHConnectionPool
+from zorilla.local_server import LocalSSHServer
+from zorilla.process_group import ProcessHostGroup
+
+logger = logging.getLogger()
+
+def sig_handler(signal, frame):
+    logger.error('Ctrl-c pressed...')
+    sys.exit()
+
+def serve(ports, stop):
+    """Run a local SSH server until stop is set
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server = LocalSSHServer(address='0.0.0.0').start()
+    ports.put(server.port)
+    stop.wait()
+    server.stop()
+
+def worker_counts(maximum):
+    """1, 2, 4 ... up to and including maximum
+    """
+    counts = []
+    n = 1
+    while n < maximum:
+        counts.append(n)
+        n *= 2
+    counts.append(maximum)
+    return counts
+
+def make_hosts(count, ports, pool):
+    """Hosts on 127.0.0.2 and up, spread over the server ports
+    """
+    return [Host('127.0.%u.%u' % (i // 250, 2 + i % 250),
+                 'root', '', pool=pool, port=ports[i % len(ports)])
+            for i in range(count)]
+
+def timed(group, command):
+    start = time.time()
+    results = group.sshcmd(command)
+    elapsed = time.time() - start
+    return elapsed, len(results.failed())
+
+def report(name, hosts, cold, warm, base):
+    logger.error('%-12s cold %7.2f s %7.1f hosts/s %5.2fx  '
+                 'warm %7.2f s %7.1f hosts/s %5.2fx  failed %u/%u',
+                 name, cold[0], hosts / cold[0], base[0] / cold[0],
+                 warm[0], hosts / warm[0], base[1] / warm[0], cold[1],
+                 warm[1])
+
+def bench(args):
+    hosts = int(args.hosts)
+    threads = int(args.threads)
+    maximum = int(args.max_workers or multiprocessing.cpu_count())
+    stop = multiprocessing.Event()
+    ports = multiprocessing.Queue()
+    servers = []
+    for i in range(int(args.servers or multiprocessing.cpu_count())):
+        p = multiprocessing.Process(target=serve, args=(ports, stop))
+        p.daemon = True
+        p.start()
+        servers.append(p)
+    try:
+        server_ports = [ports.get(timeout=30) for p in servers]
+        logger.error('%u hosts, %u servers, %u threads per worker, %s',
+                     hosts, len(servers), threads, args.command)
+        base = None
+        for count in worker_counts(maximum):
+            group = ProcessHostGroup(make_hosts(hosts, server_ports,
+                                                SSHConnectionPool()),
+                                     processes=count, workers=threads,
+                                     timeout=float(args.timeout))
+            try:
+                cold = timed(group, args.command)
+                warm = timed(group, args.command)
+            finally:
+                group.close()
+            if base is None:
+                base = (cold[0], warm[0])
+            report('%u workers' % count, hosts, cold, warm, base)
+        # Threads last, so no workers are forked with its connections open
+        pool = SSHConnectionPool()
+        group = HostGroup(make_hosts(hosts, server_ports, pool),
+                          workers=threads, timeout=float(args.timeout))
+        try:
+            cold = timed(group, args.command)
+            warm = timed(group, args.command)
+        finally:
+            pool.close_all()
+        report('threads', hosts, cold, warm, base)
+    finally:
+        stop.set()
+        for p in servers:
+            p.join(5)
+
+def main(argv=None):
+    # Do argv default this way, as doing it in the functional
+    # declaration sets it at compile time.
+    if argv is None:
+        argv = sys.argv
+
+    # Default configuration
+    defaults = {'loglevel':'ERROR',
+                'report':''}
+
+    # Initialize configuration
+    # This is common to all test utilities
+    parser, remaining_argv = init_config(defaults)
+
+    # Custom parameters
+    parser.add_argument("-n", "--hosts", default='200',
+                        help="number of local targets")
+    parser.add_argument("-w", "--max_workers",
+                        help="most worker processes, defaults to the CPUs")
+    parser.add_argument("--threads", default='16',
+                        help="threads in each worker")
+    parser.add_argument("--servers",
+                        help="SSH server processes, defaults to the CPUs")
+    parser.add_argument("--command", default='true',
+                        help="command run on each host")
+    parser.add_argument("--timeout", default='120', help="per host timeout")
+    args = parser.parse_args(remaining_argv)
+
+    # Set up logging
+    # This is common to all test utilities
+    init_logging(argv, args, logger)
+
+    # Install Ctrl-C handling
+    signal.signal(signal.SIGINT, sig_handler)
+
+    try:
+        bench(args)
+    except Exception as e:
+        logger.error('main: Exception: %r', e)
+        logger.error('Traceback:\n%s', traceback.format_exc())
+        return -1
+
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,714 @@
+#!/usr/bin/env python
+#
+# Batched thread backtraces of remote processes
+#
+#    gdb attaches once per process and runs thread apply all bt
+#    /proc/<tid>/status of every thread is read in one remote command
+#    Output is parsed into per thread records
+#    A sampling profiler keeps one gdb running and attaches, back traces
+#    and detaches at an interval, aggregating identical stacks
+#
+# mdeacon@zorillaeng.com
+#
+
+import re
+import uuid
+import time
+import pipes
+import select
+import logging
+import threading
+from zorilla.host import Host
+
+logger = logging.getLogger(__name__)
+
+# Thread 2 (Thread 0x7f2b4f7fe700 (LWP 1235) "worker"):
+THREAD = re.compile(r'^Thread (\d+) \(.*?(?:LWP|process) (\d+)')
+# #1  0x00007f2b5 in poll (fds=0x1, nfds=1) at poll.c:29
+# #2  0x0000000000401136 in ?? () from /lib/libc.so.6
+FRAME = re.compile(r'^#(\d+)\s+(?:(0x[0-9a-fA-F]+) in )?(.+?) \((.*)\)'
+                   r'(?: at (.+):(\d+))?(?: from (.+?))?\s*$')
+# Marks the start of each task's status in the batched cat
+STATUS = '==> '
+
+class GdbTraceException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+class ThreadRecord(object):
+    """One thread's identity, scheduler state and stack
+    """
+    def __init__(self, pid, tid, name=None, state=None, frames=None,
+                 status=None):
+        self.pid = pid
+        self.tid = tid
+        self.name = name
+        self.state = state
+        self.frames = frames or []
+        self.status = status or {}
+
+    def stack(self):
+        """Function names from the innermost frame out
+        """
+        return [frame['function'] for frame in self.frames]
+
+    def to_dict(self):
+        return {'pid': self.pid, 'tid': self.tid, 'name': self.name,
+                'state': self.state, 'frames': self.frames,
+                'status': self.status}
+
+    def __repr__(self):
+        return 'ThreadRecord(%u %s %s %u frames)' % (self.tid, self.name,
+                                                     self.state,
+                                                     len(self.frames))
+
+def parse_frame(line):
+    """Return a frame dict for a gdb backtrace line, None if it is not one
+    """
+    m = FRAME.match(line)
+    if m is None:
+        return None
+    level, address, function, args, source, lineno, library = m.groups()
+    return {'level': int(level), 'address': address, 'function': function,
+            'args': args, 'file': source,
+            'line': int(lineno) if lineno else None, 'library': library,
+            'locals': []}
+
+def parse_backtrace(output):
+    """Parse thread apply all bt output into {tid: [frames]}
+    Lines under a frame from bt full are kept in the frame's locals
+    """
+    threads = {}
+    frames = None
+    for line in output.splitlines():
+        m = THREAD.match(line)
+        if m is not None:
+            frames = threads.setdefault(int(m.group(2)), [])
+            continue
+        if frames is None:
+            continue
+        frame = parse_frame(line)
+        if frame is not None:
+            frames.append(frame)
+        elif line.startswith(' ') and len(frames) and line.strip():
+            frames[-1]['locals'].append(line.strip())
+    return threads
+
+def parse_status(output):
+    """Parse the batched status output into {tid: {field: value}}
+    """
+    tasks = {}
+    status = None
+    for line in output.splitlines():
+        if line.startswith(STATUS):
+            try:
+                tid = int(line[len(STATUS):].rstrip('/').split('/')[-1])
+            except ValueError:
+                status = None
+                continue
+            status = tasks.setdefault(tid, {})
+            continue
+        if status is None or ':' not in line:
+            continue
+        key, value = line.split(':', 1)
+        status[key.strip()] = value.strip()
+    return tasks
+
+def parse_time(output, default):
+    """Seconds since the epoch from the first line of date +%s.%N output
+    busybox date has no %N, whole seconds are used then
+    """
+    first = (output.splitlines() or [''])[0].strip()
+    try:
+        return float(first)
+    except ValueError:
+        pass
+    try:
+        return float(first.split('.')[0])
+    except ValueError:
+        return default
+
+class GdbTracer(object):
+    """Collect every thread's backtrace with one gdb per process
+    Runs through a Host, so the commands share its pooled connection.
+    e.g.:
+    tracer = GdbTracer(host)
+    records = tracer.capture('/usr/sbin/daemon', full=True)
+    for record in records:
+        logger.error('%r %s', record, ' < '.join(record.stack()))
+    """
+    def __init__(self, host, gdb='/usr/bin/gdb'):
+        self.host = host
+        self.gdb = gdb
+        # Raw gdb output of the last capture, by pid
+        self.output = {}
+
+    def run(self, command):
+        rc, output, error = self.host.sshcmd(command)
+        return rc, ''.join(output), ''.join(error)
+
+    def find(self, pathnames):
+        """Process ids of every running instance of each pathname, from one
+        ps. Returns {pathname: [pids]}
+        """
+        rc, output, error = self.run('/bin/ps -eLf')
+        found = dict([(pathname, []) for pathname in pathnames])
+        for line in output.splitlines():
+            tokens = line.split()
+            if len(tokens) < 10:
+                continue
+            try:
+                pid = int(tokens[1])
+            except ValueError:
+                continue
+            for pathname in pathnames:
+                if pathname in line and pid not in found[pathname]:
+                    found[pathname].append(pid)
+        logger.debug('find: %r', found)
+        return found
+
+    def pids(self, pathname):
+        """Process ids of every running instance of pathname
+        """
+        return self.find([pathname])[pathname]
+
+    def clock_offset(self):
+        """Seconds the host's clock is ahead of ours
+        Taken against the midpoint of the round trip
+        """
+        start = time.time()
+        rc, output, error = self.run('date +%s.%N')
+        end = time.time()
+        return parse_time(output, end) - (start + end) / 2
+
+    def statuses(self, pids):
+        """/proc status of every thread of the given processes, read in one
+        remote command. Returns {tid: {field: value}}
+        """
+        tasks = ' '.join(['/proc/%u/task/*' % pid for pid in pids])
+        command = ('for t in %s; do echo "%s$t"; cat $t/status; done '
+                   '2>/dev/null' % (tasks, STATUS))
+        rc, output, error = self.run(command)
+        return parse_status(output)
+
+    def gdb_command(self, pid, commands):
+        """gdb in batch mode attached to pid, detaching when done
+        """
+        options = ['set pagination off', 'set width 0', 'set confirm off',
+                   'set print thread-events off'] + commands
+        return '%s -batch -nx -p %u %s 2>&1' % (
+            self.gdb, pid, ' '.join(['-ex %s' % pipes.quote(o)
+                                     for o in options]))
+
+    def backtraces(self, pid, full=False):
+        """Attach once and return ({tid: [frames]}, raw gdb output)
+        """
+        bt = 'thread apply all bt full' if full else 'thread apply all bt'
+        rc, output, error = self.run(self.gdb_command(pid, [bt]))
+        threads = parse_backtrace(output)
+        if not threads:
+            raise GdbTraceException('backtraces: pid %u: %s' %
+                                    (pid, output.strip()[-512:]))
+        return threads, output
+
+    def snapshot(self, pid, full=False):
+        """Timestamp, statuses and backtraces of one process in a single
+        remote command. Returns (host time, [ThreadRecord])
+        """
+        bt = 'thread apply all bt full' if full else 'thread apply all bt'
+        command = ('date +%%s.%%N; for t in /proc/%u/task/*; do echo "%s$t"; '
+                   'cat $t/status; done 2>/dev/null; echo "%sgdb"; %s' %
+                   (pid, STATUS, STATUS, self.gdb_command(pid, [bt])))
+        start = time.time()
+        rc, output, error = self.run(command)
+        timestamp = parse_time(output, start)
+        statuses = parse_status(output)
+        threads = parse_backtrace(output)
+        if not threads:
+            raise GdbTraceException('snapshot: pid %u: %s' %
+                                    (pid, output.strip()[-512:]))
+        records = []
+        for tid in sorted(set(threads.keys()) | set(statuses.keys())):
+            status = statuses.get(tid, {})
+            records.append(ThreadRecord(pid, tid, status.get('Name'),
+                                        status.get('State'),
+                                        threads.get(tid, []), status))
+        return timestamp, records
+
+    def capture(self, pathname, full=False, pids=None):
+        """Return ThreadRecords for every thread of every instance of
+        pathname, or of the given pids
+        """
+        if pids is None:
+            pids = self.pids(pathname)
+        if not pids:
+            raise GdbTraceException('capture: %s is not running' % pathname)
+        # Read status before gdb stops the threads
+        statuses = self.statuses(pids)
+        records = []
+        self.output = {}
+        for pid in pids:
+            threads, self.output[pid] = self.backtraces(pid, full)
+            tids = set(threads.keys())
+            tids.update([tid for tid in statuses if
+                         statuses[tid].get('Tgid') == str(pid)])
+            for tid in sorted(tids):
+                status = statuses.get(tid, {})
+                records.append(ThreadRecord(pid, tid, status.get('Name'),
+                                            status.get('State'),
+                                            threads.get(tid, []), status))
+        return records
+
+class GdbSession(object):
+    """Interactive gdb kept running on one SSH channel
+    Symbols loaded by the first attach stay loaded for the next ones.
+    A pty lets a long command be cut short with Ctrl-C.
+    e.g.:
+    session = GdbSession(host)
+    session.command('attach 1234')
+    output = session.command('thread apply all bt', max_time=0.5)
+    session.command('detach')
+    session.close()
+    """
+    def __init__(self, host, gdb='/usr/bin/gdb', timeout=60):
+        """timeout is the default limit in seconds for each command
+        """
+        self.host = host
+        self.timeout = timeout
+        self.prompt = '(zgdb-%s) ' % uuid.uuid4().hex[:8]
+        self.interrupted = False
+        self.buffer = ''
+        options = ['set prompt %s' % self.prompt, 'set editing off',
+                   'set pagination off', 'set height 0', 'set width 0',
+                   'set confirm off', 'set print thread-events off']
+        self.client = host.ssh_connect()
+        try:
+            self.channel = self.client.get_transport().open_session()
+            self.channel.get_pty(term='dumb', width=1024)
+            self.channel.exec_command('%s -q -nx %s' % (
+                gdb, ' '.join(['-iex %s' % pipes.quote(o) for o in options])))
+            self.read(time.time() + self.timeout)
+        except Exception:
+            self.close()
+            raise
+
+    def read(self, deadline, interrupt_at=None):
+        """Read up to the next prompt, sending Ctrl-C at interrupt_at
+        """
+        self.interrupted = False
+        while True:
+            i = self.buffer.find(self.prompt)
+            if i >= 0:
+                output = self.buffer[:i]
+                self.buffer = self.buffer[i + len(self.prompt):]
+                return output.replace('\r', '')
+            now = time.time()
+            if now >= deadline:
+                raise GdbTraceException('read: timed out')
+            if self.channel.exit_status_ready() and not self.channel.recv_ready():
+                raise GdbTraceException('read: gdb exited: %s' %
+                                        self.buffer.strip()[-512:])
+            wait = deadline - now
+            if interrupt_at is not None and not self.interrupted:
+                if now >= interrupt_at:
+                    self.channel.sendall('\x03')
+                    self.interrupted = True
+                    continue
+                wait = min(wait, interrupt_at - now)
+            r, w, x = select.select([self.channel], [], [], min(wait, 1.0))
+            if r:
+                data = self.channel.recv(65536)
+                if len(data) == 0:
+                    raise GdbTraceException('read: channel closed')
+                self.buffer += data
+
+    def command(self, command, timeout=None, max_time=None):
+        """Run a gdb command and return its output
+        After max_time seconds the command is interrupted and interrupted
+        is set, the output so far is returned
+        """
+        if timeout is None:
+            timeout = self.timeout
+        now = time.time()
+        self.channel.sendall(command + '\n')
+        interrupt_at = None
+        if max_time is not None:
+            interrupt_at = now + max_time
+        output = self.read(now + timeout, interrupt_at)
+        # The pty echoes the command
+        if output.startswith(command):
+            output = output[len(command):].lstrip('\n')
+        return output
+
+    def close(self):
+        """Quit gdb, detaching from anything still attached
+        """
+        channel = getattr(self, 'channel', None)
+        if channel is not None:
+            try:
+                channel.sendall('quit\n')
+            except Exception as e:
+                logger.debug('close: Exception: %r', e)
+            channel.close()
+            self.channel = None
+        if self.client is not None:
+            self.host.ssh_close(self.client)
+            self.client = None
+
+class StackProfile(object):
+    """Identical stacks of many samples counted together
+    Stacks run from the outermost frame in, rooted at the thread name.
+    """
+    def __init__(self):
+        self.stacks = {}
+        self.samples = 0
+        self.truncated = 0
+        self.pauses = []
+
+    def add(self, threads, names):
+        """Add one sample, {tid: [frames]} and {tid: thread name}
+        """
+        self.samples += 1
+        for tid, frames in threads.items():
+            stack = tuple([names.get(tid, str(tid))] +
+                          [f['function'] for f in reversed(frames)])
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def folded(self):
+        """Lines of folded stacks for flamegraph.pl
+        """
+        return ['%s %u' % (';'.join(stack), count) for stack, count in
+                sorted(self.stacks.items())]
+
+    def top(self, n=20):
+        """The n hottest functions as (function, self, total) sample counts
+        self counts the innermost frame only, total every stack it is in
+        """
+        leaf = {}
+        total = {}
+        for stack, count in self.stacks.items():
+            frames = stack[1:]
+            if not frames:
+                continue
+            leaf[frames[-1]] = leaf.get(frames[-1], 0) + count
+            for function in set(frames):
+                total[function] = total.get(function, 0) + count
+        hot = sorted(total.keys(), key=lambda f: (-leaf.get(f, 0), -total[f]))
+        return [(f, leaf.get(f, 0), total[f]) for f in hot[:n]]
+
+    def summary(self, n=20):
+        """Text lines for the top n functions
+        """
+        stacks = sum(self.stacks.values())
+        lines = ['%u samples, %u thread stacks, %u truncated, '
+                 'pause max %.3f s mean %.3f s' %
+                 (self.samples, stacks, self.truncated,
+                  max(self.pauses or [0]),
+                  sum(self.pauses) / max(1, len(self.pauses)))]
+        lines.append('%7s %7s  %s' % ('self%', 'total%', 'function'))
+        for function, leaf, total in self.top(n):
+            lines.append('%6.1f%% %6.1f%%  %s' %
+                         (100.0 * leaf / max(1, stacks),
+                          100.0 * total / max(1, stacks), function))
+        return lines
+
+class SamplingProfiler(object):
+    """Poor man's profiler: stacks of every thread sampled at an interval
+    The process is stopped only while attached. A back trace running
+    longer than max_pause is cut short and the sample left out.
+    Sampling stops after samples samples or once the process has been
+    stopped for budget seconds in total.
+    e.g.:
+    profiler = SamplingProfiler(host, 1234, samples=200, interval=0.1,
+                                max_pause=0.5, budget=10)
+    profile = profiler.run()
+    open('daemon.folded', 'w').write('\n'.join(profile.folded()))
+    """
+    # Consecutive truncated samples before giving up
+    max_truncated = 3
+
+    def __init__(self, host, pid, samples=100, interval=0.5, max_pause=1.0,
+                 budget=None, gdb='/usr/bin/gdb'):
+        self.host = host
+        self.pid = pid
+        self.samples = samples
+        self.interval = interval
+        self.max_pause = max_pause
+        self.budget = budget
+        self.gdb = gdb
+
+    def thread_names(self):
+        tracer = GdbTracer(self.host, self.gdb)
+        statuses = tracer.statuses([self.pid])
+        return dict([(tid, status.get('Name', str(tid)))
+                     for tid, status in statuses.items()])
+
+    def sample(self, session):
+        """Attach, back trace every thread and detach
+        Returns ({tid: [frames]}, seconds stopped, truncated)
+        """
+        start = time.time()
+        output = session.command('attach %u' % self.pid)
+        if 'ptrace:' in output or 'Could not attach' in output:
+            raise GdbTraceException('sample: %s' % output.strip())
+        try:
+            output = session.command('thread apply all bt',
+                                     max_time=self.max_pause)
+            truncated = session.interrupted
+        finally:
+            session.command('detach')
+        return parse_backtrace(output), time.time() - start, truncated
+
+    def run(self):
+        """Sample until done and return the StackProfile
+        """
+        profile = StackProfile()
+        names = self.thread_names()
+        session = GdbSession(self.host, self.gdb)
+        stopped = 0.0
+        truncated_run = 0
+        try:
+            for n in range(self.samples):
+                start = time.time()
+                threads, pause, truncated = self.sample(session)
+                profile.pauses.append(pause)
+                stopped += pause
+                if truncated:
+                    profile.truncated += 1
+                    truncated_run += 1
+                    logger.error('run: sample %u cut short after %.3f s',
+                                 n, pause)
+                    if truncated_run >= self.max_truncated:
+                        logger.error('run: %u samples in a row cut short, '
+                                     'stopping', truncated_run)
+                        break
+                else:
+                    truncated_run = 0
+                    profile.add(threads, names)
+                if self.budget is not None and stopped + pause > self.budget:
+                    logger.error('run: pause budget of %.1f s spent after '
+                                 '%u samples', self.budget, n + 1)
+                    break
+                time.sleep(max(0, self.interval - (time.time() - start)))
+        finally:
+            session.close()
+        logger.debug('run: %u samples, stopped %.3f s', profile.samples,
+                     stopped)
+        return profile
+
+class ProcessCapture(object):
+    """Threads of one process on one host, captured at timestamp
+    timestamp is on our clock, corrected by the host's clock offset
+    """
+    def __init__(self, target, pathname, pid):
+        self.target = target
+        self.pathname = pathname
+        self.pid = pid
+        self.timestamp = None
+        self.duration = None
+        self.records = []
+        self.error = None
+        self.timed_out = False
+
+    @property
+    def ok(self):
+        return self.error is None and not self.timed_out
+
+    def to_dict(self):
+        return {'target': self.target, 'pathname': self.pathname,
+                'pid': self.pid, 'timestamp': self.timestamp,
+                'duration': self.duration, 'error': self.error,
+                'timed_out': self.timed_out,
+                'threads': [r.to_dict() for r in self.records]}
+
+    def __repr__(self):
+        state = '%u threads' % len(self.records)
+        if self.timed_out:
+            state = 'timed out'
+        elif self.error is not None:
+            state = 'error %s' % self.error
+        return 'ProcessCapture(%s %s %r %s)' % (self.target, self.pathname,
+                                               self.pid, state)
+
+class CaptureReport(object):
+    """Captures from many hosts, with identical stacks grouped together
+    """
+    def __init__(self, captures):
+        self.captures = captures
+
+    def succeeded(self):
+        return [c for c in self.captures if c.ok]
+
+    def failed(self):
+        return [c for c in self.captures if not c.ok]
+
+    def skew(self):
+        """Seconds between the first and last snapshot taken
+        """
+        times = [c.timestamp for c in self.succeeded()
+                 if c.timestamp is not None]
+        if not times:
+            return None
+        return max(times) - min(times)
+
+    def groups(self):
+        """[(stack, [(target, pid, tid, name)])], most common stack first
+        A stack is the function names from the innermost frame out
+        """
+        groups = {}
+        for capture in self.succeeded():
+            for record in capture.records:
+                groups.setdefault(tuple(record.stack()), []).append(
+                    (capture.target, capture.pid, record.tid, record.name))
+        return sorted(groups.items(), key=lambda g: (-len(g[1]), g[0]))
+
+    def lines(self):
+        """Text report of the grouped stacks
+        """
+        skew = self.skew()
+        lines = ['%u captures, %u failed, snapshot skew %s' %
+                 (len(self.captures), len(self.failed()),
+                  '%.3f s' % skew if skew is not None else 'unknown')]
+        for capture in self.failed():
+            lines.append('failed: %r' % capture)
+        for stack, threads in self.groups():
+            targets = sorted(set([t[0] for t in threads]))
+            lines.append('=' * 70)
+            lines.append('%u threads on %u hosts: %s' %
+                         (len(threads), len(targets), ' '.join(targets)))
+            for function in stack:
+                lines.append('    %s' % function)
+        return lines
+
+    def to_dict(self):
+        return {'skew': self.skew(),
+                'captures': [c.to_dict() for c in self.captures],
+                'groups': [{'stack': list(stack), 'threads': threads}
+                           for stack, threads in self.groups()]}
+
+class MultiCapture(object):
+    """Back trace the same processes on many hosts at the same moment
+    Hosts are prepared first: connected, clock offsets measured and
+    processes found. Then every process is traced on its own channel,
+    all starting at one agreed instant. Whatever has not finished by the
+    deadline is reported as timed out.
+    e.g.:
+    multi = MultiCapture(['10.0.0.1', '10.0.0.2'], ['/usr/sbin/daemon'],
+                         deadline=30)
+    report = multi.run()
+    for line in report.lines():
+        logger.error(line)
+    """
+    # Seconds between preparing the hosts and the agreed start
+    lead = 0.2
+
+    def __init__(self, targets, pathnames, username='root', password='',
+                 deadline=30, full=False, gdb='/usr/bin/gdb', workers=64):
+        """targets are addresses or Host instances. deadline is the overall
+        limit in seconds.
+        """
+        self.hosts = []
+        for target in targets:
+            if not isinstance(target, Host):
+                target = Host(target, username, password)
+            self.hosts.append(target)
+        self.pathnames = pathnames
+        self.deadline = deadline
+        self.full = full
+        self.gdb = gdb
+        self.workers = workers
+
+    def parallel(self, jobs, fn, deadline):
+        """Call fn(job) for every job on up to workers threads
+        Returns {index: (value, exception)} for the jobs done by deadline.
+        No job is started after the deadline, one running then is left to
+        finish on its own.
+        """
+        done = {}
+        pending = list(enumerate(jobs))
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not pending or time.time() >= deadline:
+                        return
+                    index, job = pending.pop(0)
+                try:
+                    done[index] = (fn(job), None)
+                except Exception as e:
+                    done[index] = (None, e)
+
+        threads = []
+        for i in range(min(self.workers, len(jobs))):
+            t = threading.Thread(target=worker, name='capture-%u' % i)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join(max(0, deadline - time.time()))
+        with lock:
+            # Late workers must not attach to and pause any more processes
+            del pending[:]
+        return dict(done)
+
+    def run(self):
+        """Capture everything and return a CaptureReport
+        """
+        deadline = time.time() + self.deadline
+
+        def prepare(host):
+            tracer = GdbTracer(host, self.gdb)
+            return tracer.clock_offset(), tracer.find(self.pathnames)
+
+        prepared = self.parallel(self.hosts, prepare, deadline)
+        captures = []
+        jobs = []
+        for index, host in enumerate(self.hosts):
+            value, error = prepared.get(index, (None, None))
+            if value is None:
+                for pathname in self.pathnames:
+                    capture = ProcessCapture(host.target, pathname, None)
+                    if error is None:
+                        capture.timed_out = True
+                    else:
+                        capture.error = repr(error)
+                    captures.append(capture)
+                continue
+            offset, found = value
+            for pathname in self.pathnames:
+                if not found[pathname]:
+                    capture = ProcessCapture(host.target, pathname, None)
+                    capture.error = 'not running'
+                    captures.append(capture)
+                for pid in found[pathname]:
+                    capture = ProcessCapture(host.target, pathname, pid)
+                    captures.append(capture)
+                    jobs.append((host, offset, capture))
+        start_at = time.time() + self.lead
+
+        def snapshot(job):
+            # Returns its results, a job still running at the deadline
+            # must not touch the captures in the report
+            host, offset, capture = job
+            time.sleep(max(0, start_at - time.time()))
+            start = time.time()
+            timestamp, records = GdbTracer(
+                host, self.gdb).snapshot(capture.pid, self.full)
+            return timestamp - offset, records, time.time() - start
+
+        done = self.parallel(jobs, snapshot, deadline)
+        for index, (host, offset, capture) in enumerate(jobs):
+            if index not in done:
+                capture.timed_out = True
+            elif done[index][1] is not None:
+                capture.error = repr(done[index][1])
+            else:
+                (capture.timestamp, capture.records,
+                 capture.duration) = done[index][0]
+        report = CaptureReport(captures)
+        logger.debug('run: %u captures skew %r', len(captures), report.skew())
+        return report
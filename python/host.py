@@ -12,10 +12,21 @@ import logging
 import traceback
 import paramiko
 import time
+from contextlib import contextmanager
 from paramiko import SSHClient
 from scp import SCPClient
-from progressbar import ProgressBar
+from progressbar import ProgressBar, Percentage, Bar
 import stat
+from zorilla.ssh_pool import default_pool
+from zorilla.probe import PortProber
+from zorilla.shell_session import ShellSession
+from zorilla.output_capture import ChannelStream
+from zorilla.transfer import ChunkedTransfer, StatsWidget
+from zorilla.sync import DirSync
+from zorilla.tar_stream import TarStream
+from zorilla.deadline import current_cancel, ExpectTimeout, CANCELLED
+from zorilla import metrics
+from zorilla import broker
 
 logger = logging.getLogger(__name__)
 
@@ -29,20 +40,77 @@ class HostException(Exception):
     def __repr__(self):
         return str(self.parameter)
 
+def output_bytes(output):
+    """Size of sshcmd output, a list of lines or an OutputCapture
+    """
+    if hasattr(output, 'total'):
+        return output.total
+    return sum([len(line) for line in output])
+
 class Host(object):
     """Generic IP host
     """
-    def __init__(self, target, username = 'root', password = ''):
+    # ssh_connect retry policy, in attempts and seconds between them
+    connect_retries = 5
+    connect_sleep = 10
+    # Seconds allowed for the TCP connect and SSH banner, None for default
+    connect_timeout = None
+    # Seconds allowed for each command in the persistent shell session,
+    # None for no limit as with sshcmd
+    session_timeout = None
+    # Seconds allowed for each reachability probe connect
+    probe_timeout = 2.0
+    # Chunked transfers: SFTP channels, bytes per chunk and resume attempts
+    transfer_channels = 4
+    transfer_chunk_size = 8388608
+    transfer_retries = 3
+    # LogStore capturing command and sshcmd output, None for none
+    log_store = None
+    # Use the connection of a running SSH broker, if there is one
+    use_broker = True
+    # ResultCache for cached_sshcmd, None for none
+    result_cache = None
+    # Prints an id that changes each time the host boots
+    boot_id_command = ('cat /proc/sys/kernel/random/boot_id 2>/dev/null || '
+                       'sysctl -n kern.boottime 2>/dev/null')
+
+    def __init__(self, target, username = 'root', password = '', pool = None,
+                 use_pool = True, persistent = False, port = 22):
+        """Connections are shared through the default SSH connection pool
+        unless use_pool is False or another pool is given.
+        With persistent set, sshcmd runs commands in one long lived shell.
+        """
         logger.debug('__init__: username %s password %s', username, 
                      password)
         self.target = target
+        self.port = port
         self.username = username
         self.password = password
+        if pool is None and use_pool:
+            pool = default_pool
+        self.pool = pool
+        self.persistent = persistent
+        self.session = None
+        self.session_client = None
+        # The host's boot id has been checked against result_cache
+        self.boot_checked = False
 
-    def progress_cb(self, filename, size, sent):
-        if sent == 0:
-            self.progress_bar = ProgressBar(maxval=size)
+    def pool_key(self):
+        """Key identifying this host's connection in the pool
+        """
+        return (self.target, self.port, self.username)
+
+    def progress_cb(self, filename, size, sent, stats=None):
+        """Draw transfer progress, with rate and ETA when stats are given
+        A resumed transfer starts part way through
+        """
+        if sent == 0 or not hasattr(self, 'progress_bar'):
+            widgets = None
+            if stats is not None:
+                widgets = [Percentage(), ' ', Bar(), ' ', StatsWidget(stats)]
+            self.progress_bar = ProgressBar(widgets=widgets, maxval=size)
             self.progress_bar.start()
+            self.progress_bar.update(sent)
         elif size == sent:
             self.progress_bar.finish()
             del(self.progress_bar)
@@ -54,6 +122,7 @@ class Host(object):
         """
         logger.debug('probe_port: ip %s port %u', self.target, port)
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.probe_timeout)
         try:
             rc = sock.connect_ex((self.target, port))
         except Exception as e:
@@ -65,34 +134,91 @@ class Host(object):
             return 0
         return -1
 
-    def command(self, cmd):
+    def stream(self, command, chunk_size=32768, op='stream'):
+        """Execute a command and stream its output as it arrives
+        Returns a ChannelStream yielding ('stdout' | 'stderr', data). stdout
+        and stderr are read concurrently. The exit status is in the stream's
+        rc after iteration. op names the operation in the metrics.
+        """
+        logger.debug('stream(%s)', command)
+        start = metrics.now()
+        sshclient = self.ssh_connect()
+        try:
+            opened = metrics.now()
+            channel = sshclient.get_transport().open_session()
+            channel.exec_command(command)
+            metrics.since('zorilla_ssh_phase_seconds', opened,
+                          phase='channel_open', source='host')
+        except Exception:
+            # The transport is likely dead, keep it from the next caller
+            self.ssh_discard(sshclient)
+            raise
+        return ChannelStream(channel, lambda: self.ssh_close(sshclient),
+                             chunk_size, op, start, current_cancel())
+
+    def command(self, cmd, capture=None, error_capture=None, echo=True):
         """Issue a command remotely on the host via ssh port 22
         This will output each line in real time to the logger. 
         Makes it look as if the command is running locally
+        stdout and stderr go to capture and error_capture, OutputCapture
+        instances, when given. Otherwise stdout lines are returned.
         """
         logger.debug('command(%s)' % cmd)
         output = []
-        trans = paramiko.Transport((self.target, 22))
-        trans.connect(username=self.username, password=self.password)
-        session = trans.open_channel("session")
-        fd = session.makefile('rw')
-        session.exec_command(cmd)
-        rc = 0
-        while True:
-            temp = fd.readline()
-            output.append(temp)
-            # Bail out if the string is empty
-            if len(temp) == 0:
-                fd.close()
-                trans.close()
-                if len(output) == 0:
-                    rc = -1
-                break;
-            logger.error(temp.strip())
+        captures = {'stdout': capture, 'stderr': error_capture}
+        partial = {'stdout': '', 'stderr': ''}
+        log = self.log_session(cmd)
+        stream = self.stream(cmd, op='command')
+        for name, data in stream:
+            if log is not None:
+                log.write(data)
+            if captures[name] is not None:
+                captures[name].write(data)
+                if not echo:
+                    continue
+            lines = (partial[name] + data).split('\n')
+            partial[name] = lines.pop()
+            # Don't let a stream without newlines grow without bound
+            if len(partial[name]) > 65536:
+                lines.append(partial[name])
+                partial[name] = ''
+            for line in lines:
+                if echo:
+                    logger.error(line.strip())
+                if name == 'stdout' and capture is None:
+                    output.append(line + '\n')
+        for name in ['stdout', 'stderr']:
+            if len(partial[name]):
+                if echo:
+                    logger.error(partial[name].strip())
+                if name == 'stdout' and capture is None:
+                    output.append(partial[name])
+        rc = stream.rc
+        if log is not None:
+            log.close()
+        if capture is not None:
+            output = capture
         return rc, output
 
+    def log_session(self, command):
+        """A LogSession for a command's output when log_store is set
+        """
+        if self.log_store is None:
+            return None
+        return self.log_store.session(self.target, 'command', command)
+
     def ssh_connect(self):
         """Connect to host via SSH
+        Returns a pooled client when pooling is enabled
+        """
+        if self.pool is not None:
+            return self.pool.acquire(self.pool_key(), self.ssh_connect_new)
+        return self.ssh_connect_new()
+
+    def ssh_connect_new(self):
+        """Open a new SSH connection to the host
+        When an SSH broker is running this is a BrokerClient sharing its
+        connection to the host.
         """
         sshclient = SSHClient()
         sshclient.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -102,12 +228,31 @@ class Host(object):
         sys.stdout.flush()
         sys.stderr.flush()
         retry = 0
-        retries = 5
-        sleep_time = 10
+        retries = self.connect_retries
+        sleep_time = self.connect_sleep
+        start = metrics.now()
+        token = current_cancel()
         while True:
+            self.check_cancel('ssh_connect')
             try:
-                sshclient.connect(self.target, username = self.username, 
-                                  password = self.password)
+                if self.use_broker:
+                    client = broker.connect(self.target, self.port,
+                                            self.username, self.password,
+                                            self.connect_timeout)
+                    if client is not None:
+                        logger.debug('ssh_connect: Using the broker for %s',
+                                     self.target)
+                        return client
+                # A cancel closes the client, ending the key exchange or
+                # authentication
+                with self.cancellable(sshclient.close, 'ssh_connect'):
+                    metrics.ssh_connect(sshclient, self.target,
+                                        port = self.port,
+                                        username = self.username,
+                                        password = self.password,
+                                        timeout = self.connect_timeout)
+                metrics.since('zorilla_ssh_phase_seconds', start,
+                              phase='connect', source='host')
                 logger.debug('ssh_connect: Successfully connected to the target %s',
                              self.target)
                 break;
@@ -115,7 +260,13 @@ class Host(object):
                 logger.error('ssh_connect: Exception: %r', e)
                 if retry < retries:
                     retry += 1
-                    time.sleep(sleep_time)
+                    metrics.count('zorilla_ssh_connect_retries')
+                    metrics.observe('zorilla_ssh_phase_seconds', sleep_time,
+                                    phase='retry_sleep', source='host')
+                    if token is not None:
+                        token.wait(sleep_time)
+                    else:
+                        time.sleep(sleep_time)
                     logger.error("ssh_connect: Trying to connect to %s retry %u of %u", 
                                  self.target, retry, retries)
                     continue
@@ -124,39 +275,189 @@ class Host(object):
 
     def ssh_close(self, sshclient):
         """Disconnect SSH session
+        Pooled connections are handed back to the pool and stay open
         """
+        if self.pool is not None:
+            self.pool.release(self.pool_key())
+            return
         sshclient.close()
 
-    def sshcmd(self, command):
+    def ssh_discard(self, sshclient):
+        """Close the connection, taking it out of the pool
+        """
+        if self.pool is not None:
+            self.pool.discard(self.pool_key())
+        sshclient.close()
+
+    def check_cancel(self, where):
+        """Raise ExpectTimeout once the cancel_scope of this thread fired
+        """
+        token = current_cancel()
+        if token is not None and token.cancelled:
+            raise ExpectTimeout('%s: %s cancelled' % (where, self.target),
+                                reason=CANCELLED)
+
+    @contextmanager
+    def cancellable(self, close, where):
+        """Call close if the cancel_scope of this thread fires in the block
+        close drops the connection, so reads blocked on it fail at once
+        """
+        token = current_cancel()
+        if token is None:
+            yield
+            return
+
+        def cancel():
+            logger.error('%s: %s cancelled, closing the connection', where,
+                         self.target)
+            close()
+
+        token.add_callback(cancel)
+        try:
+            yield
+        finally:
+            token.remove_callback(cancel)
+        self.check_cancel(where)
+
+    def open_session(self):
+        """Return the persistent shell session, starting it if needed
+        """
+        if self.session is not None and self.session.alive():
+            return self.session
+        self.close_session()
+        self.session_client = self.ssh_connect()
+        self.session = ShellSession(self.session_client.get_transport(),
+                                    timeout=self.session_timeout)
+        return self.session
+
+    def close_session(self):
+        """Exit the persistent shell session
+        """
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        if self.session_client is not None:
+            self.ssh_close(self.session_client)
+            self.session_client = None
+
+    def session_cmd(self, command, capture=None, error_capture=None):
+        """Execute a command in the persistent shell session
+        Returns (rc, output, error) like sshcmd. After a timeout the shell
+        is closed, the next call starts a new one.
+        """
+        logger.debug('session_cmd(%s)', command)
+        return self.session_run([command], [(capture, error_capture)],
+                                'session_cmd')[0]
+
+    def session_batch(self, commands):
+        """Pipeline commands through the persistent shell session
+        Returns a list of (rc, output, error), one per command
+        """
+        logger.debug('session_batch(%r)', commands)
+        return self.session_run(commands, [(None, None)] * len(commands),
+                                'session_batch')
+
+    def session_run(self, commands, captures, op):
+        """Run commands in the session, logged to log_store and timed
+        """
+        start = metrics.now()
+        logs = [self.log_session(command) for command in commands]
+        try:
+            results = self.open_session().run_batch(
+                commands, captures=[c + (log,) for c, log in zip(captures,
+                                                                  logs)])
+        except Exception:
+            self.close_session()
+            raise
+        finally:
+            for log in logs:
+                if log is not None:
+                    log.close()
+        if start is not None:
+            metrics.since('zorilla_op_seconds', start, op=op)
+            metrics.observe('zorilla_op_bytes',
+                            sum([output_bytes(output) + output_bytes(error)
+                                 for rc, output, error in results]), op=op)
+        return results
+
+    def sshcmd(self, command, capture=None, error_capture=None):
         """Execute a command on the host using SSH
+        stdout and stderr go to capture and error_capture, OutputCapture
+        instances, when given and are returned in place of the line lists.
         """
+        if self.persistent:
+            return self.session_cmd(command, capture, error_capture)
         logger.debug('sshcmd(%s)', command)
-        sshclient = self.ssh_connect()
-
-        # Append exit status output to command
-        command += '; echo $?'
-        stdin, stdout, stderr = sshclient.exec_command(command)
-        output = stdout.readlines()
-        error = stderr.readlines()
-        stdout.flush()
-        stderr.flush()
-        self.ssh_close(sshclient)
-        rc = 0
-        # Parse return code from last line in output
-        if len(output):
-            rc = int(output[-1].strip())
-            # Remove this line from the output
-            output.pop()
+        chunks = {'stdout': [], 'stderr': []}
+        captures = {'stdout': capture, 'stderr': error_capture}
+        stream = self.stream(command, op='sshcmd')
+        log = self.log_session(command)
+        for name, data in stream:
+            if log is not None:
+                log.write(data)
+            if captures[name] is not None:
+                captures[name].write(data)
+            else:
+                chunks[name].append(data)
+        rc = stream.rc
+        if log is not None:
+            log.close()
+        output = capture
+        if output is None:
+            output = ''.join(chunks['stdout']).splitlines(True)
+        error = error_capture
+        if error is None:
+            error = ''.join(chunks['stderr']).splitlines(True)
         logger.debug('rc: %r', rc)
         logger.debug('output: %r', output)
         logger.debug('error: %r', error)
         return rc, output, error
 
-    def scpfile(self, remote_file, local_path):
+    def cached_sshcmd(self, command, ttl=None):
+        """sshcmd for a command whose result does not change while the
+        host is up, e.g. 'uname -a'
+        Results with rc 0 are kept in result_cache for ttl seconds, or the
+        cache's default. Without a result_cache this is sshcmd. The first
+        call checks the host's boot id, results cached before a reboot,
+        e.g. by an earlier run, are not used.
+        """
+        if self.result_cache is None:
+            return self.sshcmd(command)
+        if not self.boot_checked:
+            self.result_cache.check_boot(self.target, self.port,
+                                         self.boot_id())
+            self.boot_checked = True
+        result = self.result_cache.get(self.target, self.port, self.username,
+                                       command)
+        if result is None:
+            result = self.sshcmd(command)
+            if result[0] == 0:
+                self.result_cache.put(self.target, self.port, self.username,
+                                      command, result, ttl)
+        else:
+            logger.debug('cached_sshcmd(%s): cached', command)
+        # Copies, so callers can not change the cached lists
+        rc, output, error = result
+        return rc, list(output), list(error)
+
+    def boot_id(self):
+        """An id that changes each time the host boots, None if unknown
+        """
+        rc, output, error = self.sshcmd(self.boot_id_command)
+        boot_id = ''.join(output).strip()
+        if rc != 0 or not boot_id:
+            logger.error('boot_id: %s has none, rc %r', self.target, rc)
+            return None
+        return boot_id
+
+    def scpfile(self, remote_file, local_path, chunked=False):
         """ Copy a file from the host to a local directory
+        With chunked set the file is moved by sftpfile
         """
         logger.debug('scpfile: remote_file %s local_path %s',
                      remote_file, local_path)
+        if chunked:
+            return self.sftpfile(remote_file, local_path)
         try:
             sshclient = self.ssh_connect()
         except Exception as e:
@@ -166,7 +467,9 @@ class Host(object):
         scp = SCPClient(sshclient.get_transport(), buff_size=1024*1024,
                         socket_timeout=30.0, progress=self.progress_cb)
         try:
-            scp.get(remote_file, local_path, preserve_times=True)
+            with self.cancellable(lambda: self.ssh_discard(sshclient),
+                                  'scpfile'):
+                scp.get(remote_file, local_path, preserve_times=True)
             self.ssh_close(sshclient)
         except Exception as e:
             logger.error('scpfile: Exception: %r', e)
@@ -180,11 +483,15 @@ class Host(object):
                  stat.S_IWOTH | stat.S_IWRITE | stat.S_IREAD)
         return local_pathname
 
-    def scpfileto(self, local_pathname, remote_path):
+    def scpfileto(self, local_pathname, remote_path, chunked=False):
         """ Copy a given file from a local directory to the host
+        With chunked set the file is moved by sftpfileto
         """
         logger.debug('scpfileto: local_pathname %s remote_path %s',
                      local_pathname, remote_path)
+        if chunked:
+            self.sftpfileto(local_pathname, remote_path)
+            return
         try:
             sshclient = self.ssh_connect()
         except Exception as e:
@@ -194,47 +501,170 @@ class Host(object):
         scp = SCPClient(sshclient.get_transport(), buff_size=1024*1024,
                         progress=self.progress_cb)
         try:
-            scp.put(local_pathname, remote_path)
+            with self.cancellable(lambda: self.ssh_discard(sshclient),
+                                  'scpfileto'):
+                scp.put(local_pathname, remote_path)
             self.ssh_close(sshclient)
         except Exception as e:
             logger.error('scpfileto: Exception: %r', e)
             self.ssh_close(sshclient)
             raise
 
-    def ssh_up(self, retries = 40):
+    def transfer(self, direction, source, destination, verify):
+        """Run a chunked transfer, resuming it after a failure
+        Each attempt gets a fresh connection if the last one dropped
+        """
+        retry = 0
+        while True:
+            sshclient = self.ssh_connect()
+            transfer = ChunkedTransfer(sshclient.get_transport(),
+                                       chunk_size=self.transfer_chunk_size,
+                                       channels=self.transfer_channels,
+                                       verify=verify,
+                                       progress=self.progress_cb)
+            try:
+                with self.cancellable(lambda: self.ssh_discard(sshclient),
+                                      'transfer'):
+                    pathname = getattr(transfer, direction)(source,
+                                                            destination)
+                self.ssh_close(sshclient)
+                logger.debug('transfer: %s', transfer.stats)
+                return pathname
+            except Exception as e:
+                logger.error('transfer: Exception: %r', e)
+                self.ssh_close(sshclient)
+                self.check_cancel('transfer')
+                if retry < self.transfer_retries:
+                    retry += 1
+                    logger.error('transfer: Resuming %s retry %u of %u',
+                                 source, retry, self.transfer_retries)
+                    continue
+                raise
+            finally:
+                if hasattr(self, 'progress_bar'):
+                    del(self.progress_bar)
+
+    def sftpfile(self, remote_file, local_path, verify=True):
+        """Copy a large file from the host over several SFTP channels
+        Chunks are verified by md5 and an interrupted copy resumes.
+        Returns the local pathname
+        """
+        logger.debug('sftpfile: remote_file %s local_path %s',
+                     remote_file, local_path)
+        local_pathname = self.transfer('get', remote_file, local_path, verify)
+        os.chmod(local_pathname, stat.S_IRUSR | stat.S_IRGRP | 
+                 stat.S_IROTH | stat.S_IWUSR | stat.S_IWGRP | 
+                 stat.S_IWOTH | stat.S_IWRITE | stat.S_IREAD)
+        return local_pathname
+
+    def sftpfileto(self, local_pathname, remote_path, verify=True):
+        """Copy a large file to the host over several SFTP channels
+        Chunks are verified by md5 and an interrupted copy resumes.
+        Returns the remote pathname
+        """
+        logger.debug('sftpfileto: local_pathname %s remote_path %s',
+                     local_pathname, remote_path)
+        return self.transfer('put', local_pathname, remote_path, verify)
+
+    def sync(self, local_dir, remote_dir, dry_run=False, delete=False):
+        """Make remote_dir match local_dir, sending only changed blocks
+        Returns SyncStats. With dry_run set nothing on the host changes and
+        the stats report what would be sent and saved.
+        """
+        logger.debug('sync: local_dir %s remote_dir %s dry_run %r',
+                     local_dir, remote_dir, dry_run)
+        try:
+            sshclient = self.ssh_connect()
+        except Exception as e:
+            logger.error('sync: Exception: %r', e)
+            raise
+
+        try:
+            with self.cancellable(lambda: self.ssh_discard(sshclient), 'sync'):
+                stats = DirSync(sshclient.get_transport(),
+                                delete=delete).sync(local_dir, remote_dir,
+                                                    dry_run)
+            self.ssh_close(sshclient)
+        except Exception as e:
+            logger.error('sync: Exception: %r', e)
+            self.ssh_close(sshclient)
+            raise
+        logger.debug('sync: %s', stats)
+        return stats
+
+    def tar_stream(self, direction, source, destination, compression,
+                   include, exclude):
+        logger.debug('%s_tree: %s to %s compression %r', direction, source,
+                     destination, compression)
+        try:
+            sshclient = self.ssh_connect()
+        except Exception as e:
+            logger.error('%s_tree: Exception: %r', direction, e)
+            raise
+
+        stream = TarStream(sshclient.get_transport(), compression, include,
+                           exclude)
+        try:
+            with self.cancellable(lambda: self.ssh_discard(sshclient),
+                                  '%s_tree' % direction):
+                result = getattr(stream, direction)(source, destination)
+            self.ssh_close(sshclient)
+        except Exception as e:
+            logger.error('%s_tree: Exception: %r', direction, e)
+            self.ssh_close(sshclient)
+            raise
+        logger.debug('%s_tree: %r', direction, result)
+        return result
+
+    def put_tree(self, local_dir, remote_dir, compression=None, include=None,
+                 exclude=None):
+        """Copy a tree of files to the host as one tar stream
+        compression is None, 'gz' or 'zstd'. include and exclude are lists
+        of glob patterns on the relative path.
+        Returns a TarResult whose manifest lists every file sent
+        """
+        return self.tar_stream('put', local_dir, remote_dir, compression,
+                               include, exclude)
+
+    def get_tree(self, remote_dir, local_dir, compression=None, include=None,
+                 exclude=None):
+        """Copy a tree of files from the host as one tar stream
+        Returns a TarResult whose manifest lists every file written
+        """
+        return self.tar_stream('get', remote_dir, local_dir, compression,
+                               include, exclude)
+
+    def ssh_up(self, retries = 40, banner = False):
         """Check/wait for SSH to come up
+        Returns as soon as the port opens, or after retries * 5 seconds.
+        With banner set, wait for the SSH identification string as well.
         """
         logger.error('Checking for SSH up...')
-        retry = 1
-        sleep_time = 5
-        while True:
-            if (self.probe_port(22) == 0):
-                logger.error('SSH is up.')
-                return 0
-            if retry > retries:
-                break
-            retry += 1
-            time.sleep(sleep_time)
-            logger.error('Waiting for SSH up...retry %u of %u', 
-                         retry, retries)
-
-        logger.error('SSH not up after %u seconds', retries * sleep_time)
+        timeout = retries * 5
+        prober = PortProber(connect_timeout=self.probe_timeout, banner=banner)
+        flipped = prober.wait([(self.target, self.port)], up=True, timeout=timeout)
+        if flipped[(self.target, self.port)] is not None:
+            logger.error('SSH is up.')
+            return 0
+
+        logger.error('SSH not up after %u seconds', timeout)
         return -1
 
     def ssh_down(self, retries = 80):
         """Check/wait for SSH to go down
+        Returns as soon as the port closes, or after retries * 3 seconds.
         """
         logger.error('Checking for SSH down %s...', time.asctime())
-        retry = 0
-        sleep_time = 3
-        while retry < retries:
-            if (self.probe_port(22) != 0):
-                logger.error('SSH is down.')
-                return 0
-            retry += 1
-            time.sleep(sleep_time)
-            logger.error('Waiting for SSH to go down...retry %u of %u %s', 
-                         retry, retries, time.asctime())
-
-        logger.error('SSH not down after %u seconds', retries * sleep_time)
+        timeout = retries * 3
+        prober = PortProber(connect_timeout=self.probe_timeout)
+        flipped = prober.wait([(self.target, self.port)], up=False, timeout=timeout)
+        if flipped[(self.target, self.port)] is not None:
+            logger.error('SSH is down.')
+            # Anything cached may change across the reboot
+            if self.result_cache is not None:
+                self.result_cache.invalidate(self.target, self.port)
+                self.boot_checked = False
+            return 0
 
+        logger.error('SSH not down after %u seconds', timeout)
+        return -1
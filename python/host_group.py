@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+#
+# Run Host operations concurrently across many targets
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import time
+import logging
+import threading
+import Queue
+from zorilla.host import Host
+from zorilla.probe import wait_all_up, wait_all_down
+from zorilla.deadline import CancelToken, cancel_scope
+
+logger = logging.getLogger(__name__)
+
+class HostGroupException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+class HostResult(object):
+    """Outcome of one operation on one host
+    """
+    def __init__(self, target, rc=None, output=None, error=None,
+                 duration=0.0, exception=None, skipped=False,
+                 timed_out=False):
+        self.target = target
+        self.rc = rc
+        self.output = output
+        self.error = error
+        self.duration = duration
+        self.exception = exception
+        self.skipped = skipped
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        """True if the operation ran and did not fail
+        """
+        if self.skipped or self.timed_out or self.exception is not None:
+            return False
+        return self.rc is None or self.rc == 0
+
+    def __repr__(self):
+        if self.skipped:
+            state = 'skipped'
+        elif self.timed_out:
+            state = 'timed out'
+        elif self.exception is not None:
+            state = 'exception %r' % self.exception
+        else:
+            state = 'rc %r' % self.rc
+        return 'HostResult(%s %s %.2fs)' % (self.target, state, self.duration)
+
+class GroupResult(object):
+    """Per host results, in the order the targets were given
+    """
+    def __init__(self, targets):
+        self.targets = list(targets)
+        self.results = [None] * len(self.targets)
+        self.aborted = False
+
+    def add(self, index, result):
+        self.results[index] = result
+
+    def __getitem__(self, target):
+        for result in self:
+            if result.target == target:
+                return result
+        raise KeyError(target)
+
+    def __iter__(self):
+        for result in self.results:
+            if result is not None:
+                yield result
+
+    def __len__(self):
+        return len([r for r in self.results if r is not None])
+
+    def succeeded(self):
+        return [r for r in self if r.ok]
+
+    def failed(self):
+        return [r for r in self if not r.ok and not r.skipped]
+
+    def skipped(self):
+        return [r for r in self if r.skipped]
+
+    @property
+    def ok(self):
+        return not self.aborted and len(self.succeeded()) == len(self.targets)
+
+    def summary(self):
+        return ('%u hosts: %u ok %u failed %u skipped' %
+                (len(self.targets), len(self.succeeded()),
+                 len(self.failed()), len(self.skipped())))
+
+def quiet_progress(filename, size, sent, stats=None):
+    """Progress callback that draws nothing, bars would interleave
+    """
+    pass
+
+class HostGroup(object):
+    """Run Host operations concurrently across many targets
+    Failures come back as results rather than exceptions.
+    e.g.:
+    group = HostGroup(['10.0.0.1', '10.0.0.2'], 'root', '', workers=32,
+                      timeout=60, max_failures=5)
+    results = group.sshcmd('uname -a')
+    for r in results.failed():
+        logger.error('%s: %r', r.target, r)
+    """
+    # Seconds a cancelled call has to unwind before it is abandoned
+    cancel_grace = 5.0
+
+    def __init__(self, targets, username='root', password='', workers=16,
+                 timeout=None, fail_fast=False, max_failures=None,
+                 connect_retries=None, connect_sleep=None):
+        """targets are addresses or Host instances. timeout is the per host
+        limit in seconds. Dispatch stops once max_failures hosts have failed,
+        fail_fast is the same as max_failures=1. Host instances given are
+        used as they are, apart from connect_retries and connect_sleep when
+        those are given.
+        """
+        self.hosts = []
+        for target in targets:
+            if isinstance(target, Host):
+                host = target
+            else:
+                host = Host(target, username, password)
+                # A connect should not outlast the per host timeout
+                if timeout is not None and (host.connect_timeout is None or
+                                            host.connect_timeout > timeout):
+                    host.connect_timeout = timeout
+                host.progress_cb = quiet_progress
+            if connect_retries is not None:
+                host.connect_retries = connect_retries
+            if connect_sleep is not None:
+                host.connect_sleep = connect_sleep
+            self.hosts.append(host)
+        self.workers = workers
+        self.timeout = timeout
+        if fail_fast:
+            max_failures = 1
+        self.max_failures = max_failures
+        # Host of each call still running after it timed out and was
+        # cancelled
+        self.abandoned = {}
+        self.lock = threading.Lock()
+
+    def run(self, fn, *args):
+        """Call fn(host, *args) on every host
+        fn returns (rc, output, error)
+        """
+        results = GroupResult([h.target for h in self.hosts])
+        work = Queue.Queue()
+        for index, host in enumerate(self.hosts):
+            work.put((index, host))
+        lock = threading.Lock()
+        state = {'failures': 0}
+
+        def stopped():
+            return (self.max_failures is not None and
+                    state['failures'] >= self.max_failures)
+
+        def worker():
+            while True:
+                try:
+                    index, host = work.get_nowait()
+                except Queue.Empty:
+                    return
+                with lock:
+                    stop = stopped()
+                if stop:
+                    results.add(index, HostResult(host.target, skipped=True))
+                    continue
+                result = self.run_one(host, fn, args)
+                with lock:
+                    results.add(index, result)
+                    if not result.ok:
+                        state['failures'] += 1
+                        if stopped() and not results.aborted:
+                            logger.error('run: %u failures, stopping',
+                                         state['failures'])
+                            results.aborted = True
+
+        threads = []
+        for i in range(min(self.workers, len(self.hosts))):
+            t = threading.Thread(target=worker, name='hostgroup-%u' % i)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        logger.debug('run: %s', results.summary())
+        return results
+
+    def run_one(self, host, fn, args):
+        """Run fn on one host, bounded by the per host timeout
+        On timeout the host's connect retries, channel reads, transfers and
+        expect calls made by fn are cancelled. A call that has not unwound
+        cancel_grace seconds later is abandoned. Abandoned calls count
+        against workers and their hosts are not run again until they end.
+        """
+        reason = self.stuck(host)
+        if reason is not None:
+            logger.error('run_one: %s', reason)
+            return HostResult(host.target,
+                              exception=HostGroupException(reason))
+        box = {}
+        token = CancelToken()
+
+        def call():
+            try:
+                with cancel_scope(token):
+                    box['value'] = fn(host, *args)
+            except Exception as e:
+                box['exception'] = e
+
+        start = time.time()
+        if self.timeout is None:
+            call()
+        else:
+            t = threading.Thread(target=call, name='hostgroup-%s' % host.target)
+            t.daemon = True
+            t.start()
+            t.join(self.timeout)
+            if t.is_alive():
+                logger.error('run_one: %s timed out after %.1f s',
+                             host.target, self.timeout)
+                token.cancel()
+                t.join(self.cancel_grace)
+                if t.is_alive():
+                    logger.error('run_one: %s still running %.1f s after '
+                                 'cancel, abandoning it', host.target,
+                                 self.cancel_grace)
+                    with self.lock:
+                        self.abandoned[t] = host
+                return HostResult(host.target, duration=time.time() - start,
+                                  timed_out=True)
+        duration = time.time() - start
+        if 'exception' in box:
+            logger.error('run_one: %s Exception: %r', host.target,
+                         box['exception'])
+            return HostResult(host.target, duration=duration,
+                              exception=box['exception'])
+        rc, output, error = box['value']
+        return HostResult(host.target, rc, output, error, duration)
+
+    def stuck(self, host):
+        """Why host can not be run now, None if it can
+        """
+        with self.lock:
+            for t in self.abandoned.keys():
+                if not t.is_alive():
+                    del self.abandoned[t]
+            if any([h is host for h in self.abandoned.values()]):
+                return ('%s is still running a call that timed out' %
+                        host.target)
+            if len(self.abandoned) >= self.workers:
+                return ('%s not run, %u calls that timed out are still '
+                        'running' % (host.target, len(self.abandoned)))
+        return None
+
+    def sshcmd(self, command):
+        """Execute a command on every host using SSH
+        """
+        return self.run(lambda host: host.sshcmd(command))
+
+    def command(self, cmd):
+        """Issue a command on every host, logging output as it arrives
+        """
+        def command(host):
+            rc, output = host.command(cmd)
+            return rc, output, None
+        return self.run(command)
+
+    def scpfileto(self, local_pathname, remote_path):
+        """Copy a local file to every host
+        """
+        def scpfileto(host):
+            host.scpfileto(local_pathname, remote_path)
+            return None, None, None
+        return self.run(scpfileto)
+
+    def scpfile(self, remote_file, local_path):
+        """Copy a file from every host into local_path/<target>/
+        The local pathname of each copy is returned as the output
+        """
+        def scpfile(host):
+            path = os.path.join(local_path, host.target)
+            if not os.path.exists(path):
+                os.makedirs(path)
+            return None, host.scpfile(remote_file, path), None
+        return self.run(scpfile)
+
+    def wait_all_up(self, timeout=200, port=None, prober=None):
+        """Wait for SSH to come up on every host
+        Returns {host: seconds until it came up, None if it did not}
+        """
+        return wait_all_up(self.hosts, timeout, port, prober)
+
+    def wait_all_down(self, timeout=240, port=None, prober=None):
+        """Wait for SSH to go down on every host
+        Returns {host: seconds until it went down, None if it did not}
+        """
+        down = wait_all_down(self.hosts, timeout, port, prober)
+        for host, seconds in down.items():
+            if seconds is not None and host.result_cache is not None:
+                host.result_cache.invalidate(host.target, host.port)
+                host.boot_checked = False
+        return down
@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+#
+# Local paramiko based SSH/SFTP server standing in for a target
+#
+#    exec and shell requests run /bin/sh on this machine
+#    sftp serves the local filesystem, optionally below a root directory
+#    traffic can be delayed and rate limited to look like a slower link
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import time
+import errno
+import Queue
+import socket
+import threading
+from collections import deque
+import subprocess
+import logging
+import paramiko
+from paramiko import (ServerInterface, SFTPServer, SFTPServerInterface,
+                      SFTPAttributes, SFTPHandle, SFTP_OK)
+
+logger = logging.getLogger(__name__)
+
+class LocalSFTPHandle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            LocalSFTPInterface.set_attrs(self.filename, attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+class LocalSFTPInterface(SFTPServerInterface):
+    """Serve the local filesystem, below root when one is given
+    """
+    root = None
+
+    def local(self, path):
+        path = self.canonicalize(path)
+        if self.root is None:
+            return path
+        return os.path.join(self.root, path.lstrip('/'))
+
+    @staticmethod
+    def set_attrs(path, attr):
+        if attr.st_mode is not None:
+            os.chmod(path, attr.st_mode & 0o7777)
+        if attr.st_mtime is not None:
+            os.utime(path, (attr.st_atime, attr.st_mtime))
+        if attr.st_size is not None:
+            with open(path, 'r+b') as f:
+                f.truncate(attr.st_size)
+
+    def call(self, fn, *args):
+        try:
+            fn(*args)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def list_folder(self, path):
+        path = self.local(path)
+        try:
+            out = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(
+                    os.lstat(os.path.join(path, name)))
+                attr.filename = name
+                out.append(attr)
+            return out
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self.local(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self.local(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        path = self.local(path)
+        binary = getattr(os, 'O_BINARY', 0)
+        try:
+            mode = 0o666
+            if attr is not None and attr.st_mode is not None:
+                mode = attr.st_mode & 0o7777
+            fd = os.open(path, flags | binary, mode)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            fmode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            fmode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            fmode = 'rb'
+        try:
+            f = os.fdopen(fd, fmode)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        handle = LocalSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        return self.call(os.remove, self.local(path))
+
+    def rename(self, oldpath, newpath):
+        return self.call(os.rename, self.local(oldpath), self.local(newpath))
+
+    def posix_rename(self, oldpath, newpath):
+        return self.call(os.rename, self.local(oldpath), self.local(newpath))
+
+    def mkdir(self, path, attr):
+        return self.call(os.mkdir, self.local(path))
+
+    def rmdir(self, path):
+        return self.call(os.rmdir, self.local(path))
+
+    def chattr(self, path, attr):
+        return self.call(self.set_attrs, self.local(path), attr)
+
+    def symlink(self, target_path, path):
+        return self.call(os.symlink, target_path, self.local(path))
+
+    def readlink(self, path):
+        try:
+            return os.readlink(self.local(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+class LocalServerInterface(ServerInterface):
+    def __init__(self, server):
+        self.server = server
+
+    def check_auth_password(self, username, password):
+        if (self.server.username in (None, username) and
+            self.server.password in (None, password)):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height,
+                                  pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.server.spawn(channel, '/bin/sh -i', True)
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        self.server.spawn(channel, command, False)
+        return True
+
+class ShapedSocket(object):
+    """Socket that delays and rate limits traffic in both directions
+    latency is the one way delay in seconds and bandwidth the rate in bytes
+    per second each way, None for no limit.
+    """
+    def __init__(self, sock, latency=0.0, bandwidth=None):
+        self.sock = sock
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.timeout = None
+        self.outbound = Queue.Queue()
+        self.inbound = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.eof = False
+        self.paced = {'in': 0.0, 'out': 0.0}
+        for fn in (self.writer, self.reader):
+            t = threading.Thread(target=fn)
+            t.daemon = True
+            t.start()
+
+    def pace(self, direction, size):
+        """Sleep for the time size bytes take at bandwidth
+        """
+        if not self.bandwidth:
+            return
+        start = max(time.time(), self.paced[direction])
+        self.paced[direction] = start + float(size) / self.bandwidth
+        pause = self.paced[direction] - time.time()
+        if pause > 0:
+            time.sleep(pause)
+
+    def writer(self):
+        while True:
+            item = self.outbound.get()
+            if item is None:
+                break
+            due, data = item
+            pause = due - time.time()
+            if pause > 0:
+                time.sleep(pause)
+            self.pace('out', len(data))
+            try:
+                self.sock.sendall(data)
+            except socket.error:
+                break
+        self.sock.close()
+
+    def reader(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error:
+                data = ''
+            if len(data) == 0:
+                break
+            self.pace('in', len(data))
+            with self.cond:
+                self.inbound.append((time.time() + self.latency, data))
+                self.cond.notify_all()
+        with self.cond:
+            self.eof = True
+            self.cond.notify_all()
+
+    def send(self, data):
+        if self.closed:
+            raise socket.error(errno.EPIPE, 'send: socket closed')
+        self.outbound.put((time.time() + self.latency, data))
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def recv(self, size):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        with self.cond:
+            while True:
+                wait = None
+                if self.inbound:
+                    due, data = self.inbound[0]
+                    wait = due - time.time()
+                    if wait <= 0:
+                        if len(data) > size:
+                            self.inbound[0] = (due, data[size:])
+                            return data[:size]
+                        self.inbound.popleft()
+                        return data
+                elif self.eof:
+                    return ''
+                if deadline is not None:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        raise socket.timeout()
+                    wait = left if wait is None else min(wait, left)
+                self.cond.wait(wait)
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.outbound.put(None)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+class LocalSSHServer(object):
+    """SSH/SFTP server on localhost for exercising Host and SSHExpect
+    e.g.:
+    server = LocalSSHServer()
+    server.start()
+    host = Host('127.0.0.1', 'root', '', port=server.port)
+    host.sshcmd('uname -a')
+    server.stop()
+    """
+    def __init__(self, address='127.0.0.1', port=0, username=None,
+                 password=None, root=None, prompt='[root@localhost ~]$ ',
+                 latency=0.0, bandwidth=None):
+        """username and password of None accept anything. sftp paths are
+        resolved below root when one is given. latency in seconds and
+        bandwidth in bytes per second shape each connection.
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.address = address
+        self.port = port
+        self.username = username
+        self.password = password
+        self.root = root
+        self.prompt = prompt
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = None
+        self.thread = None
+        self.transports = []
+        self.connections = 0
+        self.running = False
+
+    def start(self):
+        """Listen and serve from a background thread
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.address, self.port))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        self.running = True
+        self.thread = threading.Thread(target=self.serve,
+                                       name='local-ssh-%u' % self.port)
+        self.thread.daemon = True
+        self.thread.start()
+        logger.debug('start: listening on %s:%u', self.address, self.port)
+        return self
+
+    def serve(self):
+        while self.running:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                break
+            self.connections += 1
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            t = threading.Thread(target=self.handshake, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def make_socket(self, conn):
+        """Hook for wrapping the accepted socket, e.g. to shape traffic
+        """
+        if self.latency or self.bandwidth:
+            return ShapedSocket(conn, self.latency, self.bandwidth)
+        return conn
+
+    def handshake(self, conn):
+        try:
+            transport = paramiko.Transport(self.make_socket(conn))
+            transport.add_server_key(self.host_key)
+            interface = type('RootedSFTPInterface', (LocalSFTPInterface,),
+                             {'root': self.root})
+            transport.set_subsystem_handler('sftp', SFTPServer, interface)
+            transport.start_server(server=LocalServerInterface(self))
+            self.transports.append(transport)
+        except Exception as e:
+            logger.debug('handshake: Exception: %r', e)
+            conn.close()
+
+    def spawn(self, channel, command, shell):
+        t = threading.Thread(target=self.run, args=(channel, command, shell))
+        t.daemon = True
+        t.start()
+
+    def run(self, channel, command, shell):
+        """Run a command for a channel, pumping stdin, stdout and stderr
+        """
+        env = dict(os.environ)
+        env['PS1'] = self.prompt
+        try:
+            proc = subprocess.Popen(command, shell=True, cwd=self.root,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT if shell
+                                    else subprocess.PIPE, env=env)
+        except OSError as e:
+            channel.sendall_stderr('%s\n' % e)
+            channel.send_exit_status(127)
+            channel.close()
+            return
+        threads = [threading.Thread(target=self.pump_stdin,
+                                    args=(channel, proc))]
+        if not shell:
+            threads.append(threading.Thread(target=self.pump_out,
+                                            args=(proc.stderr,
+                                                  channel.sendall_stderr)))
+        for t in threads:
+            t.daemon = True
+            t.start()
+        self.pump_out(proc.stdout, channel.sendall)
+        if not shell:
+            threads[1].join()
+        rc = proc.wait()
+        try:
+            channel.send_exit_status(rc)
+            channel.shutdown_write()
+            channel.close()
+        except Exception as e:
+            logger.debug('run: Exception: %r', e)
+
+    def pump_stdin(self, channel, proc):
+        try:
+            while True:
+                data = channel.recv(65536)
+                if len(data) == 0:
+                    break
+                proc.stdin.write(data)
+                proc.stdin.flush()
+        except (IOError, OSError, socket.error) as e:
+            if getattr(e, 'errno', None) not in (None, errno.EPIPE):
+                logger.debug('pump_stdin: Exception: %r', e)
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+
+    def pump_out(self, pipe, send):
+        try:
+            while True:
+                data = os.read(pipe.fileno(), 65536)
+                if len(data) == 0:
+                    break
+                send(data)
+        except Exception as e:
+            logger.debug('pump_out: Exception: %r', e)
+
+    def stop(self):
+        """Stop listening and close every transport
+        """
+        self.running = False
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+            self.sock = None
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
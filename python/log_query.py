@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+# Query the captured output in a log store
+#
+#    Prints the lines a host, session or kind of session produced between
+#    two times, each stamped with when it started. With --sessions lists
+#    the matching sessions instead.
+#
+# mdeacon@zorillaeng.com
+
+import sys
+import time
+import logging
+import signal
+import traceback
+from zorilla.config import init_config, init_logging
+from zorilla.log_store import LogStore, parse_time
+
+logger = logging.getLogger()
+
+def sig_handler(signal, frame):
+    logger.error('Ctrl-c pressed...')
+    sys.exit()
+
+def timestamp(when):
+    return '%s.%03u' % (time.strftime('%Y-%m-%d %H:%M:%S',
+                                      time.localtime(when)),
+                        int(when * 1000) % 1000)
+
+def query(args):
+    store = LogStore(args.store)
+    try:
+        session = None
+        if args.session:
+            session = int(args.session)
+        if args.sessions:
+            for s in store.find_sessions(args.host, session, args.kind):
+                logger.error('%6u %s %-16s %-8s %s', s.id, timestamp(s.start),
+                             s.host, s.kind, s.name or '')
+            return
+        count = 0
+        for when, s, line in store.lines(parse_time(args.start),
+                                         parse_time(args.end), args.host,
+                                         session, args.kind):
+            logger.error('%s %s[%u] %s', timestamp(when), s.host, s.id, line)
+            count += 1
+        if count == 0:
+            logger.error('No output found')
+    finally:
+        store.close()
+
+def main(argv=None):
+    # Do argv default this way, as doing it in the functional
+    # declaration sets it at compile time.
+    if argv is None:
+        argv = sys.argv
+
+    # Default configuration
+    defaults = {'loglevel':'ERROR',
+                'report':''}
+
+    # Initialize configuration
+    # This is common to all test utilities
+    parser, remaining_argv = init_config(defaults)
+
+    # Custom parameters
+    parser.add_argument("--store", help="log store path")
+    parser.add_argument("-H", "--host", help="only this host")
+    parser.add_argument("--session", help="only this session id")
+    parser.add_argument("--kind", help="only sessions of this kind, e.g. "
+                        "serial, ssh or command")
+    parser.add_argument("-s", "--start", help="from this time, e.g. "
+                        "'2016-05-01 03:10', '03:10' or -s=-15m for 15 "
+                        "minutes ago")
+    parser.add_argument("-e", "--end", help="up to this time")
+    parser.add_argument("--sessions", action='store_true',
+                        help="list the matching sessions")
+    args = parser.parse_args(remaining_argv)
+
+    # Set up logging
+    # This is common to all test utilities
+    init_logging(argv, args, logger)
+
+    # Install Ctrl-C handling
+    signal.signal(signal.SIGINT, sig_handler)
+
+    try:
+        query(args)
+    except Exception as e:
+        logger.error('main: Exception: %r', e)
+        logger.error('Traceback:\n%s', traceback.format_exc())
+        return -1
+
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,540 @@
+#!/usr/bin/env python
+#
+# Indexed store of captured console, session and command output
+#
+#    Output is appended as timestamped records, packed into zlib compressed
+#    blocks in segment files. A sparse index holds one entry per block with
+#    its time range, and a session index lists the blocks holding each
+#    session, so queries seek straight to the blocks they need. The oldest
+#    segments are deleted once the store grows past max_bytes. Processes
+#    sharing a store each write their own segment, and take a lock file
+#    to hand out segment and session numbers and to update the indexes.
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import re
+import json
+import time
+import zlib
+import glob
+import atexit
+import struct
+import logging
+import threading
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # Windows, where a store can only be shared between threads
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Block header: compressed length, records, first and last record time
+BLOCK = struct.Struct('>IIdd')
+# Record header: time, session, data length
+RECORD = struct.Struct('>dII')
+# Index entry: segment, offset, compressed length, first and last time
+INDEX = struct.Struct('>IQIdd')
+# Session index entry: session, segment, offset
+SESSION_BLOCK = struct.Struct('>IIQ')
+
+SEGMENT = re.compile(r'segment-(\d+)\.dat$')
+
+class LogStoreException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+def get_store_path():
+    """Return the default log store path
+    """
+    home = os.path.expanduser("~")
+    return os.path.join(home, '.zorilla', 'logstore')
+
+def parse_time(value, now=None):
+    """Seconds since the epoch from epoch seconds, 'YYYY-mm-dd HH:MM[:SS]'
+    local time, 'HH:MM[:SS]' today, or '-30s', '-10m', '-2h', '-1d' ago
+    """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if now is None:
+        now = time.time()
+    value = value.strip()
+    m = re.match(r'^-(\d+(?:\.\d+)?)([smhd])$', value)
+    if m:
+        scale = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[m.group(2)]
+        return now - float(m.group(1)) * scale
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    for fmt in ('%H:%M:%S', '%H:%M'):
+        try:
+            t = time.strptime(value, fmt)
+        except ValueError:
+            continue
+        today = time.localtime(now)
+        return time.mktime(today[:3] + t[3:6] + today[6:])
+    raise LogStoreException('parse_time: can not parse %r' % value)
+
+class LogSession(object):
+    """One captured stream, e.g. a console or an SSH session
+    Has write so it can be given wherever an output capture goes.
+    """
+    def __init__(self, store, id, host, kind, name=None, start=None):
+        self.store = store
+        self.id = id
+        self.host = host
+        self.kind = kind
+        self.name = name
+        self.start = start
+
+    def write(self, data):
+        if self.store is not None and len(data):
+            self.store.append(self.id, data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.store = None
+
+    def to_dict(self):
+        return {'id': self.id, 'host': self.host, 'kind': self.kind,
+                'name': self.name, 'start': self.start}
+
+    def __repr__(self):
+        return 'LogSession(%u %s %s %r)' % (self.id, self.host, self.kind,
+                                            self.name)
+
+class LogRecord(object):
+    """A chunk of output and when it was captured
+    """
+    def __init__(self, time, session, data):
+        self.time = time
+        self.session = session
+        self.data = data
+
+    @property
+    def host(self):
+        return self.session.host
+
+    def __repr__(self):
+        return 'LogRecord(%.3f %u %u bytes)' % (self.time, self.session.id,
+                                                len(self.data))
+
+class LogStore(object):
+    """Append output and query it by time, host or session
+    e.g.:
+    store = LogStore(max_bytes=1073741824, flush_interval=1.0)
+    console = store.session('board17', 'serial', '/dev/ttyUSB17')
+    console.write(data)
+    for record in store.query(start='03:10', end='03:15', host='board17'):
+        logger.error(record.data)
+    store.close()
+    """
+    def __init__(self, path=None, max_bytes=1073741824,
+                 segment_bytes=67108864, block_bytes=65536, level=6,
+                 flush_interval=1.0):
+        """Sizes are in bytes. Records are compressed block_bytes at a time,
+        or after flush_interval seconds if that comes first. A segment file
+        is closed once it reaches segment_bytes and the oldest segments are
+        deleted when all of them exceed max_bytes. The store is closed at
+        exit.
+        """
+        if path is None:
+            path = get_store_path()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.block_bytes = block_bytes
+        self.level = level
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.lock_f = open(self.pathname('lock'), 'a')
+        self.pending = []
+        self.pending_bytes = 0
+        self.readers = {}
+        self.sessions = {}
+        with self.locked():
+            self.load()
+        # Numbered when the first block is written
+        self.segment = None
+        self.f = None
+        self.flusher = None
+        self.closing = threading.Event()
+        atexit.register(self.close)
+
+    def pathname(self, name):
+        return os.path.join(self.path, name)
+
+    def segment_pathname(self, segment):
+        return self.pathname('segment-%06u.dat' % segment)
+
+    @contextmanager
+    def locked(self):
+        """Hold the store against other threads and processes
+        """
+        with self.lock:
+            if fcntl is not None:
+                fcntl.flock(self.lock_f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self.lock_f, fcntl.LOCK_UN)
+
+    def segments(self):
+        """Segment numbers on disk, oldest first
+        """
+        numbers = []
+        for pathname in glob.glob(self.pathname('segment-*.dat')):
+            m = SEGMENT.search(pathname)
+            if m:
+                numbers.append(int(m.group(1)))
+        return sorted(numbers)
+
+    def load(self):
+        """Read the sessions and both indexes, with the store locked
+        Other processes may have added to them since they were last read.
+        """
+        sessions = {}
+        pathname = self.pathname('sessions')
+        if os.path.exists(pathname):
+            with open(pathname) as f:
+                for line in f:
+                    try:
+                        d = json.loads(line)
+                    except ValueError:
+                        continue
+                    # Keep this store's open sessions
+                    session = self.sessions.get(d['id'])
+                    if session is None:
+                        session = LogSession(None, d['id'], d['host'],
+                                             d['kind'], d['name'], d['start'])
+                    sessions[d['id']] = session
+        self.sessions = sessions
+        self.index = []
+        self.blocks = {}
+        for fields in self.read_entries('index', INDEX):
+            self.index.append(fields)
+            self.blocks[fields[:2]] = fields
+        self.session_blocks = {}
+        for session, segment, offset in self.read_entries('session_index',
+                                                           SESSION_BLOCK):
+            if (segment, offset) in self.blocks:
+                self.session_blocks.setdefault(session, []).append(
+                    (segment, offset))
+
+    def read_entries(self, name, layout):
+        pathname = self.pathname(name)
+        if not os.path.exists(pathname):
+            return []
+        with open(pathname, 'rb') as f:
+            data = f.read()
+        # Ignore a torn entry at the end
+        count = len(data) // layout.size
+        return [layout.unpack_from(data, i * layout.size)
+                for i in range(count)]
+
+    def session(self, host, kind, name=None):
+        """Start a new session and return its LogSession
+        """
+        with self.locked():
+            session = LogSession(self, self.next_session(), host, kind, name,
+                                 time.time())
+            self.sessions[session.id] = session
+            with open(self.pathname('sessions'), 'a') as f:
+                f.write(json.dumps(session.to_dict()) + '\n')
+        return session
+
+    def next_session(self):
+        """Allocate a session id, with the store locked
+        The next id to hand out, by any process, is kept in a file
+        """
+        pathname = self.pathname('next_session')
+        try:
+            with open(pathname) as f:
+                id = int(f.read())
+        except (IOError, ValueError):
+            # A store from before the counter, or a torn write
+            self.load()
+            id = max(self.sessions.keys() or [0]) + 1
+        self.rewrite('next_session', [str(id + 1)])
+        return id
+
+    def append(self, session, data, when=None):
+        """Add a chunk of output to a session, stamped now unless given
+        """
+        if when is None:
+            when = time.time()
+        with self.lock:
+            self.pending.append((when, session, bytes(data)))
+            self.pending_bytes += RECORD.size + len(data)
+            if self.pending_bytes >= self.block_bytes:
+                self.write_block()
+            elif self.flusher is None and self.flush_interval:
+                self.start_flusher()
+
+    def start_flusher(self):
+        """Write pending records every flush_interval seconds, so the last
+        output before a hang or crash is on disk
+        """
+        def run():
+            while not self.closing.wait(self.flush_interval):
+                with self.lock:
+                    if self.pending:
+                        self.write_block()
+
+        self.flusher = threading.Thread(target=run, name='log-store-flush')
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def open_segment(self):
+        """Start a new segment, with the store locked
+        It stays locked against retain in other processes while open. A
+        crash may have left a torn block, so a segment is never reopened.
+        """
+        segments = self.segments()
+        self.segment = (segments[-1] + 1) if segments else 1
+        self.f = open(self.segment_pathname(self.segment), 'ab')
+        if fcntl is not None:
+            fcntl.flock(self.f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def in_use(self, segment):
+        """True if another process is writing a segment
+        """
+        if fcntl is None:
+            return False
+        try:
+            f = open(self.segment_pathname(segment), 'rb')
+        except IOError:
+            return False
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return True
+        finally:
+            f.close()
+        return False
+
+    def write_block(self):
+        """Compress the pending records into a block
+        """
+        if not self.pending:
+            return
+        records, self.pending = self.pending, []
+        self.pending_bytes = 0
+        raw = b''.join([RECORD.pack(when, session, len(data)) + data
+                        for when, session, data in records])
+        compressed = zlib.compress(raw, self.level)
+        first = min([r[0] for r in records])
+        last = max([r[0] for r in records])
+        with self.locked():
+            if self.f is None:
+                self.open_segment()
+            offset = self.f.tell()
+            self.f.write(BLOCK.pack(len(compressed), len(records), first,
+                                    last))
+            self.f.write(compressed)
+            self.f.flush()
+            entry = (self.segment, offset, len(compressed), first, last)
+            self.index.append(entry)
+            self.blocks[entry[:2]] = entry
+            with open(self.pathname('index'), 'ab') as f:
+                f.write(INDEX.pack(*entry))
+            sessions = sorted(set([r[1] for r in records]))
+            with open(self.pathname('session_index'), 'ab') as f:
+                for session in sessions:
+                    f.write(SESSION_BLOCK.pack(session, self.segment, offset))
+                    self.session_blocks.setdefault(session, []).append(
+                        (self.segment, offset))
+            if self.f.tell() >= self.segment_bytes:
+                self.f.close()
+                self.f = None
+                self.segment = None
+                self.retain()
+
+    def flush(self):
+        with self.lock:
+            self.write_block()
+
+    def size(self):
+        """Bytes held in segment files
+        """
+        return sum([os.path.getsize(self.segment_pathname(s))
+                    for s in self.segments()])
+
+    def retain(self):
+        """Delete the oldest closed segments while over max_bytes, with the
+        store locked
+        Segments other processes are writing are left alone.
+        """
+        self.load()
+        segments = [s for s in self.segments() if s != self.segment]
+        sizes = dict([(s, os.path.getsize(self.segment_pathname(s)))
+                      for s in segments])
+        total = sum(sizes.values())
+        dropped = set()
+        for segment in segments:
+            if total <= self.max_bytes:
+                break
+            if self.in_use(segment):
+                continue
+            self.close_reader(segment)
+            os.remove(self.segment_pathname(segment))
+            total -= sizes[segment]
+            dropped.add(segment)
+            logger.debug('retain: removed segment %u', segment)
+        if not dropped:
+            return
+        self.index = [e for e in self.index if e[0] not in dropped]
+        self.blocks = dict([(e[:2], e) for e in self.index])
+        for session in self.session_blocks.keys():
+            blocks = [b for b in self.session_blocks[session]
+                      if b[0] not in dropped]
+            if blocks:
+                self.session_blocks[session] = blocks
+            else:
+                del self.session_blocks[session]
+        self.rewrite('index', [INDEX.pack(*e) for e in self.index])
+        self.rewrite('session_index',
+                     [SESSION_BLOCK.pack(session, segment, offset)
+                      for session, blocks in sorted(self.session_blocks.items())
+                      for segment, offset in blocks])
+        # Forget closed sessions whose output is all gone. Sessions of
+        # other processes look closed here, those started after the oldest
+        # output kept may still be writing.
+        oldest = min([e[3] for e in self.index] or [time.time()])
+        for session in self.sessions.values():
+            if (session.store is None and session.start < oldest and
+                session.id not in self.session_blocks):
+                del self.sessions[session.id]
+        self.rewrite('sessions', [json.dumps(s.to_dict()) + '\n'
+                                  for s in sorted(self.sessions.values(),
+                                                  key=lambda s: s.id)])
+
+    def rewrite(self, name, chunks):
+        pathname = self.pathname(name)
+        with open(pathname + '.tmp', 'wb') as f:
+            f.write(b''.join(chunks))
+        os.rename(pathname + '.tmp', pathname)
+
+    def close_reader(self, segment):
+        f = self.readers.pop(segment, None)
+        if f is not None:
+            f.close()
+
+    def read_block(self, segment, offset):
+        """Records of one block as (time, session, data)
+        """
+        f = self.readers.get(segment)
+        if f is None:
+            f = open(self.segment_pathname(segment), 'rb')
+            self.readers[segment] = f
+        f.seek(offset)
+        length, count, first, last = BLOCK.unpack(f.read(BLOCK.size))
+        raw = zlib.decompress(f.read(length))
+        records = []
+        pos = 0
+        for i in range(count):
+            when, session, size = RECORD.unpack_from(raw, pos)
+            pos += RECORD.size
+            records.append((when, session, raw[pos:pos + size]))
+            pos += size
+        return records
+
+    def find_sessions(self, host=None, session=None, kind=None):
+        """Sessions matching all the given host, session id and kind
+        """
+        found = []
+        for s in sorted(self.sessions.values(), key=lambda s: s.id):
+            if host is not None and s.host != host:
+                continue
+            if session is not None and s.id != session:
+                continue
+            if kind is not None and s.kind != kind:
+                continue
+            found.append(s)
+        return found
+
+    def query(self, start=None, end=None, host=None, session=None, kind=None):
+        """LogRecords from start to end, in time order
+        Times are anything parse_time takes. Only the blocks that overlap
+        the time range and, when host, session or kind is given, hold one of
+        the selected sessions are read.
+        """
+        start = parse_time(start)
+        end = parse_time(end)
+        with self.locked():
+            # Take in what other processes have written
+            self.load()
+            wanted = None
+            if host is not None or session is not None or kind is not None:
+                wanted = set([s.id for s in
+                              self.find_sessions(host, session, kind)])
+                keys = set()
+                for id in wanted:
+                    keys.update(self.session_blocks.get(id, []))
+                entries = [self.blocks[k] for k in keys if k in self.blocks]
+            else:
+                entries = list(self.index)
+            entries = [e for e in entries
+                       if (start is None or e[4] >= start) and
+                          (end is None or e[3] <= end)]
+            entries.sort(key=lambda e: (e[3], e[0], e[1]))
+            records = []
+            for segment, offset, length, first, last in entries:
+                records += self.read_block(segment, offset)
+            records += self.pending
+        selected = [r for r in records
+                    if (start is None or r[0] >= start) and
+                       (end is None or r[0] <= end) and
+                       (wanted is None or r[1] in wanted)]
+        selected.sort(key=lambda r: r[0])
+        unknown = LogSession(None, 0, None, None)
+        return [LogRecord(when, self.sessions.get(id, unknown), data)
+                for when, id, data in selected]
+
+    def lines(self, start=None, end=None, host=None, session=None, kind=None):
+        """(time, LogSession, line) for the output of each session split
+        into lines, stamped with the time the line started
+        """
+        partial = {}
+        lines = []
+        for record in self.query(start, end, host, session, kind):
+            id = record.session.id
+            when, text, owner = partial.get(id, (record.time, '', None))
+            pieces = (text + record.data).split('\n')
+            for piece in pieces[:-1]:
+                lines.append((when, record.session, piece.rstrip('\r')))
+                when = record.time
+            partial[id] = (when, pieces[-1], record.session)
+        for when, text, owner in partial.values():
+            if text:
+                lines.append((when, owner, text))
+        lines.sort(key=lambda l: l[0])
+        return lines
+
+    def close(self):
+        self.closing.set()
+        with self.lock:
+            self.write_block()
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+                self.segment = None
+            for segment in self.readers.keys():
+                self.close_reader(segment)
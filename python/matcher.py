@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+#
+# Incremental multi-pattern matching for expect-like receive loops
+#
+#    Literal lists keep their original semantics, the lowest index wins
+#    PatternSets mix literals and regular expressions and return match
+#    objects for the earliest match in the stream
+#
+# mdeacon@zorillaeng.com
+#
+
+import re
+import sre_parse
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ExpectMatcher(object):
+    """Match a list of literal patterns against a growing stream
+    All patterns are folded into one alternation so a chunk is scanned in
+    a single pass. Only the new data plus an overlap of (longest pattern - 1)
+    bytes is scanned on each feed, so the cost is linear in the output size.
+    e.g.:
+    matcher = ExpectMatcher(['login:', '~]$'])
+    idx = matcher.feed(data)
+    if idx >= 0:
+        output = matcher.output
+    """
+    def __init__(self, patterns, max_buffer=None):
+        """max_buffer bounds the retained output in bytes, None keeps it all
+        """
+        self.patterns = list(patterns)
+        longest = max([len(p) for p in self.patterns] or [0])
+        self.overlap = max(0, longest - 1)
+        if max_buffer is not None:
+            max_buffer = max(max_buffer, self.overlap)
+        self.max_buffer = max_buffer
+        if self.patterns:
+            self.regex = re.compile('|'.join([re.escape(p)
+                                              for p in self.patterns]))
+        else:
+            self.regex = None
+        self.buf = bytearray()
+        self.discarded = 0
+        self.match = None
+
+    def feed(self, data):
+        """Append data to the stream
+        Return the index of the matched pattern or -1. When several patterns
+        match, the lowest index wins, as with a scan of the whole buffer.
+        The ExpectMatch is left in match.
+        """
+        start = max(0, len(self.buf) - self.overlap)
+        self.buf += data
+        idx = -1
+        if self.regex is not None and self.regex.search(self.buf, start):
+            # Rare path, find the first pattern in the list that matched
+            for i, p in enumerate(self.patterns):
+                offset = self.buf.find(p, start)
+                if offset >= 0:
+                    idx = i
+                    self.match = ExpectMatch(i, p, self.discarded + offset,
+                                             self.discarded + offset + len(p),
+                                             p)
+                    break
+        self.trim()
+        return idx
+
+    def trim(self):
+        """Drop the oldest output beyond max_buffer
+        """
+        if self.max_buffer is None:
+            return
+        excess = len(self.buf) - self.max_buffer
+        if excess > 0:
+            del self.buf[:excess]
+            self.discarded += excess
+
+    @property
+    def output(self):
+        """Output retained so far
+        """
+        return bytes(self.buf)
+
+class ExpectMatch(object):
+    """What matched, where in the stream, and the captured groups
+    start and end are byte offsets from the start of the stream, they stay
+    valid when max_buffer has dropped older output.
+    """
+    def __init__(self, index, pattern, start, end, text, groups=(),
+                 groupdict=None):
+        self.index = index
+        self.pattern = pattern
+        self.start = start
+        self.end = end
+        self.text = text
+        self._groups = groups
+        self._groupdict = groupdict or {}
+
+    def group(self, n=0):
+        """The whole match for 0, otherwise a captured group by number or
+        name, None if it did not take part
+        """
+        if n == 0:
+            return self.text
+        if isinstance(n, basestring):
+            return self._groupdict[n]
+        return self._groups[n - 1]
+
+    def groups(self):
+        return self._groups
+
+    def groupdict(self):
+        return dict(self._groupdict)
+
+    def span(self):
+        return self.start, self.end
+
+    def __repr__(self):
+        return 'ExpectMatch(%u %r at %u:%u)' % (self.index, self.text,
+                                                self.start, self.end)
+
+def is_regex(pattern):
+    return hasattr(pattern, 'pattern') and hasattr(pattern, 'search')
+
+def as_bytes(value):
+    if value is None:
+        return None
+    return bytes(value)
+
+class PatternSet(object):
+    """Literals and compiled regular expressions searched in one pass
+    Build it once and pass it to recv or expect as often as needed.
+    A regex of unbounded width may only match within window bytes of the
+    data that completes it.
+    e.g.:
+    prompt = PatternSet([re.compile(r'\[(\w+)@\S+ ~\]\$ $'), 'login:'])
+    i, output = sexp.send_recv('\n', prompt)
+    user = sexp.match.group(1)
+    """
+    def __init__(self, patterns, window=4096):
+        self.patterns = list(patterns)
+        self.window = window
+        # Regexes with flags of their own are searched on their own
+        combined = []
+        self.separate = []
+        widths = [0]
+        for i, p in enumerate(self.patterns):
+            if is_regex(p):
+                source, flags = p.pattern, p.flags
+            else:
+                source, flags = re.escape(p), 0
+            lo, hi = sre_parse.parse(source, flags).getwidth()
+            widths.append(min(hi, window))
+            if flags:
+                self.separate.append((i, p))
+            else:
+                combined.append((i, source))
+        self.overlap = max(0, max(widths) - 1)
+        self.regex = None
+        self.alternatives = []
+        if combined:
+            try:
+                self.regex = re.compile('|'.join(['(%s)' % source for
+                                                  i, source in combined]))
+            except re.error:
+                # e.g. the same group name in two patterns
+                self.separate += [(i, self.compile(i)) for i, source in
+                                  combined]
+                self.separate.sort()
+                combined = []
+        # Outer group number of each alternative, its own groups follow
+        group = 1
+        for i, source in combined:
+            self.alternatives.append((group, i))
+            group += 1 + re.compile(source).groups
+
+    def compile(self, i):
+        p = self.patterns[i]
+        if is_regex(p):
+            return p
+        return re.compile(re.escape(p))
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __getitem__(self, i):
+        return self.patterns[i]
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def search(self, buf, start, offset=0):
+        """Earliest match in buf at or after start, ties go to the lowest
+        index. offset is the stream offset of buf[0].
+        Returns an ExpectMatch or None
+        """
+        best = None
+        if self.regex is not None:
+            m = self.regex.search(buf, start)
+            if m is not None:
+                for group, i in self.alternatives:
+                    if m.start(group) >= 0:
+                        break
+                best = (m.start(), i, m, group)
+        for i, regex in self.separate:
+            m = regex.search(buf, start)
+            if m is not None and (best is None or
+                                  (m.start(), i) < best[:2]):
+                best = (m.start(), i, m, 0)
+        if best is None:
+            return None
+        pos, i, m, group = best
+        p = self.patterns[i]
+        if is_regex(p):
+            count = p.groups
+            groups = tuple([as_bytes(m.group(group + n))
+                            for n in range(1, count + 1)])
+            groupdict = dict([(name, as_bytes(m.group(group + n)))
+                              for name, n in p.groupindex.items()])
+        else:
+            groups, groupdict = (), {}
+        return ExpectMatch(i, p, offset + m.start(group), offset + m.end(group),
+                           as_bytes(m.group(group)), groups, groupdict)
+
+    def matcher(self, max_buffer=None):
+        return PatternMatcher(self, max_buffer)
+
+class PatternMatcher(ExpectMatcher):
+    """Match a PatternSet against a growing stream
+    Only the new data plus an overlap is searched on each feed.
+    """
+    def __init__(self, pattern_set, max_buffer=None):
+        self.pattern_set = pattern_set
+        self.overlap = pattern_set.overlap
+        if max_buffer is not None:
+            max_buffer = max(max_buffer, self.overlap)
+        self.max_buffer = max_buffer
+        self.buf = bytearray()
+        self.discarded = 0
+        self.match = None
+
+    def feed(self, data):
+        """Append data to the stream
+        Return the index of the matched pattern or -1, the ExpectMatch is
+        left in match
+        """
+        start = max(0, len(self.buf) - self.overlap)
+        self.buf += data
+        self.match = self.pattern_set.search(self.buf, start, self.discarded)
+        self.trim()
+        if self.match is None:
+            return -1
+        return self.match.index
+
+def expect_matcher(patterns, max_buffer=None):
+    """Matcher for a list of literals, a list holding regexes or a
+    PatternSet
+    """
+    if isinstance(patterns, PatternSet):
+        return patterns.matcher(max_buffer)
+    if any([is_regex(p) for p in patterns]):
+        return PatternSet(patterns).matcher(max_buffer)
+    return ExpectMatcher(patterns, max_buffer)
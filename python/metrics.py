@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+#
+# Per-phase latency and byte count histograms
+#
+#    Host, SSHExpect and SerialExpect time the phases of their operations
+#    into fixed bucket histograms. Nothing is recorded, and no clock is
+#    read, until enable() is called. The data can be read as a dict,
+#    written in the Prometheus text format or logged as a summary.
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import time
+import bisect
+import socket
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Instrumented code checks this before reading the clock
+enabled = False
+
+SECONDS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0]
+BYTES = [64 * 4 ** i for i in range(11)]
+
+HELP = {
+    'zorilla_ssh_phase_seconds': 'Time in each phase of an SSH connect',
+    'zorilla_ssh_connect_retries': 'ssh_connect attempts that were retried',
+    'zorilla_op_seconds': 'Time from start to end of a remote operation',
+    'zorilla_op_first_byte_seconds': 'Time from the start of a remote '
+                                     'operation to its first output',
+    'zorilla_op_bytes': 'Output bytes of a remote operation',
+    'zorilla_expect_seconds': 'Time in each phase of an expect recv',
+    'zorilla_expect_bytes': 'Bytes read by an expect recv',
+    'zorilla_result_cache': 'Host.cached_sshcmd lookups by result',
+}
+
+class Histogram(object):
+    """Counts of observations in fixed buckets, with the sum, min and max
+    """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile, at most max
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return self.max
+
+    def to_dict(self):
+        with self.lock:
+            return {'count': self.count, 'sum': self.sum, 'min': self.min,
+                    'max': self.max, 'buckets': zip(self.bounds + ['+Inf'],
+                                                    self.counts)}
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def to_dict(self):
+        return {'value': self.value}
+
+class MetricsRegistry(object):
+    """Histograms and counters by name and labels
+    Histograms named *_seconds get time buckets, others byte buckets.
+    e.g.:
+    metrics.enable()
+    host.sshcmd('uptime')
+    for name, labels, data in metrics.registry.items():
+        ...
+    metrics.registry.write_textfile('/var/lib/node_exporter/zorilla.prom')
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get(self, kind, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    if kind == 'counter':
+                        metric = Counter()
+                    elif name.endswith('_seconds'):
+                        metric = Histogram(SECONDS)
+                    else:
+                        metric = Histogram(BYTES)
+                    self.metrics[key] = metric
+        return metric
+
+    def items(self):
+        """(name, labels, dict of the data) sorted by name and labels
+        """
+        with self.lock:
+            keys = sorted(self.metrics.keys())
+        return [(name, dict(labels), self.metrics[(name, labels)].to_dict())
+                for name, labels in keys]
+
+    def reset(self):
+        with self.lock:
+            self.metrics = {}
+
+    def openmetrics(self):
+        """Every metric in the Prometheus/OpenMetrics text format
+        """
+        lines = []
+        with self.lock:
+            keys = sorted(self.metrics.keys())
+        family = None
+        for name, labels in keys:
+            metric = self.metrics[(name, labels)]
+            counter = isinstance(metric, Counter)
+            if name != family:
+                family = name
+                if name in HELP:
+                    lines.append('# HELP %s %s' % (name, HELP[name]))
+                lines.append('# TYPE %s %s' % (name, 'counter' if counter
+                                               else 'histogram'))
+            if counter:
+                lines.append('%s_total%s %u' % (name, format_labels(labels),
+                                                metric.value))
+                continue
+            data = metric.to_dict()
+            seen = 0
+            for bound, n in data['buckets']:
+                seen += n
+                le = bound if bound == '+Inf' else repr(float(bound))
+                lines.append('%s_bucket%s %u' % (
+                    name, format_labels(labels + (('le', le),)), seen))
+            lines.append('%s_sum%s %r' % (name, format_labels(labels),
+                                          data['sum']))
+            lines.append('%s_count%s %u' % (name, format_labels(labels),
+                                            data['count']))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, pathname):
+        """Write openmetrics() atomically, for a textfile collector
+        """
+        with open(pathname + '.tmp', 'w') as f:
+            f.write(self.openmetrics())
+        os.rename(pathname + '.tmp', pathname)
+
+    def summary(self):
+        """One line per metric with the count, mean, p50, p95 and max
+        """
+        lines = []
+        for name, labels, data in self.items():
+            label = name + format_labels(tuple(sorted(labels.items())))
+            if 'value' in data:
+                lines.append('%s %u' % (label, data['value']))
+                continue
+            metric = self.metrics[(name, tuple(sorted(labels.items())))]
+            scale, unit = (1000.0, 'ms') if name.endswith('_seconds') \
+                else (1, 'B')
+            lines.append('%s count %u mean %.1f p50 %.1f p95 %.1f max %.1f %s' %
+                         (label, data['count'],
+                          scale * data['sum'] / max(1, data['count']),
+                          scale * metric.quantile(0.5),
+                          scale * metric.quantile(0.95),
+                          scale * data['max'], unit))
+        return lines
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                           .replace('"', '\\"'))
+                              for k, v in labels])
+
+registry = MetricsRegistry()
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+def now():
+    """The time when enabled, None otherwise, to pass to since
+    """
+    if enabled:
+        return time.time()
+    return None
+
+def since(name, start, **labels):
+    """Observe the time from start, ignored when start is None
+    """
+    if start is not None:
+        registry.get('histogram', name, labels).observe(time.time() - start)
+
+def observe(name, value, **labels):
+    if enabled:
+        registry.get('histogram', name, labels).observe(value)
+
+def count(name, n=1, **labels):
+    if enabled:
+        registry.get('counter', name, labels).inc(n)
+
+def ssh_connect(client, target, port=22, timeout=None, source='host',
+                **kwargs):
+    """client.connect, with the TCP connect, key exchange and
+    authentication timed when enabled
+    """
+    if not enabled:
+        return client.connect(target, port=port, timeout=timeout, **kwargs)
+    start = time.time()
+    sock = socket.create_connection((target, port), timeout)
+    since('zorilla_ssh_phase_seconds', start, phase='tcp_connect',
+          source=source)
+    auth = client._auth
+    spent = {'auth': 0.0}
+
+    def timed_auth(*args, **kw):
+        begin = time.time()
+        try:
+            return auth(*args, **kw)
+        finally:
+            spent['auth'] = time.time() - begin
+
+    # The instance attribute stands in for the method for this connect
+    client._auth = timed_auth
+    begin = time.time()
+    try:
+        client.connect(target, port=port, timeout=timeout, sock=sock,
+                       **kwargs)
+    except Exception:
+        sock.close()
+        raise
+    finally:
+        del client._auth
+    elapsed = time.time() - begin
+    observe('zorilla_ssh_phase_seconds', elapsed - spent['auth'], phase='kex',
+            source=source)
+    observe('zorilla_ssh_phase_seconds', spent['auth'], phase='auth',
+            source=source)
+
+class RecvTimer(object):
+    """Times one expect recv: the wait for the first byte, the pattern
+    matching and the whole call, with the bytes read
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self.start = time.time()
+        self.first = None
+        self.matching = 0.0
+        self.total = 0
+
+    def feed(self, matcher, data):
+        now = time.time()
+        if self.first is None:
+            self.first = now - self.start
+        self.total += len(data)
+        i = matcher.feed(data)
+        self.matching += time.time() - now
+        return i
+
+    def done(self):
+        labels = {'transport': self.transport}
+        observe('zorilla_expect_seconds', time.time() - self.start,
+                phase='total', **labels)
+        if self.first is not None:
+            observe('zorilla_expect_seconds', self.first, phase='first_byte',
+                    **labels)
+        observe('zorilla_expect_seconds', self.matching, phase='match',
+                **labels)
+        observe('zorilla_expect_bytes', self.total, **labels)
+
+def recv_timer(transport):
+    """A RecvTimer when enabled, None otherwise
+    """
+    if enabled:
+        return RecvTimer(transport)
+    return None
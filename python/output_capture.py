@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# Streaming, bounded-memory capture of remote command output
+#
+# mdeacon@zorillaeng.com
+#
+
+import select
+import tempfile
+import logging
+from zorilla import metrics
+from zorilla.deadline import ExpectTimeout, CANCELLED
+
+logger = logging.getLogger(__name__)
+
+class OutputCapture(object):
+    """Keep the head and tail of a stream in memory, spool the rest
+    The full stream is written to a spool that stays in memory up to
+    spool_memory bytes and then rolls over to a temporary file.
+    e.g.:
+    capture = OutputCapture(head=65536, tail=65536)
+    rc, output, error = host.sshcmd('dmesg', capture=capture)
+    logger.error(''.join(capture.lines()))
+    full = capture.open().read()
+    """
+    def __init__(self, head=65536, tail=65536, spool=True,
+                 spool_memory=1048576, spool_dir=None):
+        """head and tail are in bytes. With spool False only the head and
+        tail are kept.
+        """
+        self.head_size = head
+        self.tail_size = tail
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+        self.spool = None
+        if spool:
+            self.spool = tempfile.SpooledTemporaryFile(max_size=spool_memory,
+                                                       dir=spool_dir)
+
+    def write(self, data):
+        """Append a chunk of the stream
+        """
+        self.total += len(data)
+        if self.spool is not None:
+            self.spool.write(data)
+        room = self.head_size - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if len(data):
+            self.tail += data
+            excess = len(self.tail) - self.tail_size
+            if excess > 0:
+                del self.tail[:excess]
+
+    @property
+    def truncated(self):
+        """True if the middle of the stream is not held in memory
+        """
+        return self.total > len(self.head) + len(self.tail)
+
+    def lines(self):
+        """Lines of the head and tail, with a marker for what was left out
+        """
+        if not self.truncated:
+            return bytes(self.head + self.tail).splitlines(True)
+        skipped = self.total - len(self.head) - len(self.tail)
+        marker = '\n... %u bytes not shown ...\n' % skipped
+        return (bytes(self.head).splitlines(True) + [marker] +
+                bytes(self.tail).splitlines(True))
+
+    def open(self):
+        """Return the spooled stream, rewound to the start
+        """
+        if self.spool is None:
+            raise IOError('open: capture has no spool')
+        self.spool.flush()
+        self.spool.seek(0)
+        return self.spool
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+class ChannelStream(object):
+    """Iterate over ('stdout' | 'stderr', data) chunks of an exec channel
+    Both streams are read as data arrives, so a full stderr window cannot
+    stall stdout. The exit status is in rc once iteration is done. With a
+    start time from metrics.now() the time to the first byte, the total
+    time and the bytes are recorded for op. Iteration raises ExpectTimeout
+    once the cancel token fires.
+    """
+    def __init__(self, channel, on_close=None, chunk_size=32768, op=None,
+                 start=None, cancel=None):
+        self.channel = channel
+        self.cancel = cancel
+        self.on_close = on_close
+        self.chunk_size = chunk_size
+        self.op = op
+        self.start = start
+        self.total = 0
+        self.rc = None
+
+    def __iter__(self):
+        channel = self.channel
+        try:
+            while True:
+                got = False
+                while channel.recv_ready():
+                    got = True
+                    data = channel.recv(self.chunk_size)
+                    if self.start is not None:
+                        self.received(data)
+                    yield 'stdout', data
+                while channel.recv_stderr_ready():
+                    got = True
+                    data = channel.recv_stderr(self.chunk_size)
+                    if self.start is not None:
+                        self.received(data)
+                    yield 'stderr', data
+                if got:
+                    continue
+                # The exit status follows all data on the channel
+                if channel.exit_status_ready() or channel.closed:
+                    if not (channel.recv_ready() or
+                            channel.recv_stderr_ready()):
+                        break
+                    continue
+                select.select([channel], [], [], 1.0)
+                if self.cancel is not None and self.cancel.cancelled:
+                    raise ExpectTimeout('stream: cancelled', reason=CANCELLED)
+            self.rc = channel.recv_exit_status()
+        finally:
+            self.close()
+
+    def received(self, data):
+        if self.total == 0 and len(data):
+            metrics.since('zorilla_op_first_byte_seconds', self.start,
+                          op=self.op)
+        self.total += len(data)
+
+    def close(self):
+        if self.channel is not None:
+            if self.start is not None:
+                metrics.since('zorilla_op_seconds', self.start, op=self.op)
+                metrics.observe('zorilla_op_bytes', self.total, op=self.op)
+                self.start = None
+            self.channel.close()
+            self.channel = None
+            if self.on_close is not None:
+                self.on_close()
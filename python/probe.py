@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#
+# Concurrent, non-blocking L4 reachability probing
+#
+# mdeacon@zorillaeng.com
+#
+
+import errno
+import socket
+import select
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# connect_ex results meaning the connect is under way
+IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY,
+               getattr(errno, 'WSAEWOULDBLOCK', 10035))
+
+class PortProber(object):
+    """Probe many host:port pairs at once
+    Every connect in a round runs concurrently with its own timeout, so a
+    dead host costs connect_timeout rather than the OS SYN timeout.
+    e.g.:
+    prober = PortProber(connect_timeout=2, banner=True)
+    state = prober.probe([('10.0.0.1', 22), ('10.0.0.2', 22)])
+    flipped = prober.wait([('10.0.0.1', 22)], up=True, timeout=200)
+    """
+    def __init__(self, connect_timeout=2.0, banner=False, banner_timeout=3.0,
+                 min_interval=0.25, max_interval=2.0, backoff=1.5,
+                 batch=256):
+        """With banner set, a port only counts as up once it sends an SSH
+        identification string. Between rounds the interval grows from
+        min_interval by the backoff factor up to max_interval.
+        """
+        self.connect_timeout = connect_timeout
+        self.banner = banner
+        self.banner_timeout = banner_timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.batch = batch
+        self.addresses = {}
+
+    def resolve(self, endpoint):
+        """Resolve once and remember the address
+        """
+        if endpoint not in self.addresses:
+            host, port = endpoint
+            info = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                                      socket.SOCK_STREAM)
+            family, socktype, proto, canonname, addr = info[0]
+            self.addresses[endpoint] = (family, addr)
+        return self.addresses[endpoint]
+
+    def probe(self, endpoints):
+        """Return {endpoint: True if reachable} for every endpoint
+        """
+        endpoints = list(endpoints)
+        state = {}
+        for i in range(0, len(endpoints), self.batch):
+            state.update(self.probe_batch(endpoints[i:i + self.batch]))
+        return state
+
+    def probe_batch(self, endpoints):
+        state = {}
+        connecting = {}
+        for endpoint in endpoints:
+            state[endpoint] = False
+            try:
+                family, addr = self.resolve(endpoint)
+            except socket.error as e:
+                logger.debug('probe: %s resolve: %r', endpoint, e)
+                continue
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            rc = sock.connect_ex(addr)
+            if rc == 0 or rc in IN_PROGRESS:
+                connecting[sock] = endpoint
+            else:
+                sock.close()
+
+        connected = self.wait_connected(connecting)
+        if self.banner:
+            connected = self.wait_banner(connected)
+        for sock, endpoint in connected.items():
+            state[endpoint] = True
+            sock.close()
+        logger.debug('probe: %r', state)
+        return state
+
+    def wait_connected(self, connecting):
+        """Wait for the connects in flight, return the ones that succeeded
+        """
+        connected = {}
+        deadline = time.time() + self.connect_timeout
+        while connecting:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            socks = list(connecting.keys())
+            r, w, x = select.select([], socks, socks, remaining)
+            for sock in set(w) | set(x):
+                endpoint = connecting.pop(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    connected[sock] = endpoint
+                else:
+                    sock.close()
+        for sock in connecting:
+            sock.close()
+        return connected
+
+    def wait_banner(self, connected):
+        """Keep only the sockets that send an SSH identification string
+        """
+        alive = {}
+        pending = dict(connected)
+        deadline = time.time() + self.banner_timeout
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            r, w, x = select.select(list(pending.keys()), [], [], remaining)
+            for sock in r:
+                endpoint = pending.pop(sock)
+                try:
+                    data = sock.recv(256)
+                except socket.error:
+                    data = ''
+                if data.startswith('SSH-'):
+                    alive[sock] = endpoint
+                else:
+                    sock.close()
+        for sock in pending:
+            sock.close()
+        return alive
+
+    def wait(self, endpoints, up=True, timeout=200):
+        """Wait until every endpoint is up, or down when up is False
+        Returns {endpoint: seconds until it flipped, None if it did not}
+        """
+        start = time.time()
+        deadline = start + timeout
+        pending = list(endpoints)
+        flipped = dict([(endpoint, None) for endpoint in pending])
+        interval = self.min_interval
+        while True:
+            state = self.probe(pending)
+            now = time.time()
+            still = []
+            for endpoint in pending:
+                if state[endpoint] == up:
+                    flipped[endpoint] = now - start
+                else:
+                    still.append(endpoint)
+            if len(still) < len(pending):
+                # Something changed, the rest may follow shortly
+                interval = self.min_interval
+            else:
+                interval = min(interval * self.backoff, self.max_interval)
+            pending = still
+            if not pending or now >= deadline:
+                break
+            time.sleep(max(0, min(interval, deadline - now)))
+        return flipped
+
+def wait_hosts(hosts, up, timeout, port, prober):
+    if prober is None:
+        prober = PortProber()
+    endpoints = dict([((h.target, port or h.port), h) for h in hosts])
+    flipped = prober.wait(endpoints.keys(), up, timeout)
+    return dict([(h, flipped[(h.target, port or h.port)]) for h in hosts])
+
+def wait_all_up(hosts, timeout=200, port=None, prober=None):
+    """Wait for a port to open on every Host
+    port defaults to each host's SSH port
+    Returns {host: seconds until it came up, None if it did not}
+    """
+    return wait_hosts(hosts, True, timeout, port, prober)
+
+def wait_all_down(hosts, timeout=240, port=None, prober=None):
+    """Wait for a port to close on every Host
+    Returns {host: seconds until it went down, None if it did not}
+    """
+    return wait_hosts(hosts, False, timeout, port, prober)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+#
+# Run Host operations across many targets from a pool of processes
+#
+#    paramiko does its key exchange and ciphers in Python under the GIL, so
+#    a thread per host stops scaling at about one core. ProcessHostGroup
+#    splits the targets into one shard per worker process. Each worker runs
+#    its shard with threads and keeps its own connection pool from run to
+#    run. Results stream back to the parent as each host completes.
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import time
+import Queue
+import pickle
+import signal
+import logging
+import threading
+import multiprocessing
+from zorilla.ssh_pool import SSHConnectionPool
+from zorilla.host_group import HostGroup, HostResult, GroupResult
+
+logger = logging.getLogger(__name__)
+
+class ProcessGroupException(Exception):
+    def __init__(self, value):
+        # args are set so the exception can be pickled
+        Exception.__init__(self, value)
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+# Operations sent to the workers, which must be module level functions so
+# they can be pickled. Each returns (rc, output, error).
+
+def op_sshcmd(host, command):
+    return host.sshcmd(command)
+
+def op_command(host, cmd):
+    rc, output = host.command(cmd)
+    return rc, output, None
+
+def op_scpfileto(host, local_pathname, remote_path):
+    host.scpfileto(local_pathname, remote_path)
+    return None, None, None
+
+def op_scpfile(host, remote_file, local_path):
+    path = os.path.join(local_path, host.target)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return None, host.scpfile(remote_file, path), None
+
+def pickle_result(result):
+    """Pickle a HostResult, replacing what can not be pickled or unpickled
+    with a description
+    """
+    try:
+        data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        pickle.loads(data)
+        return data
+    except Exception:
+        pass
+    e = result.exception
+    if e is not None:
+        result.exception = ProcessGroupException('%s: %s' %
+                                                 (type(e).__name__, e))
+    try:
+        return pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        result.output = repr(result.output)
+        result.error = repr(result.error)
+        return pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+
+def worker_main(worker, shard, group, tasks, results, stop):
+    """Run each task on a shard of (index, host) until given None
+    A result is sent for each host as it completes, then (index None) the
+    end of the shard.
+    """
+    # Ctrl-C reaches the whole process group, the parent stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The parent's pooled connections were copied by the fork and stay its
+    pool = SSHConnectionPool()
+    for index, host in shard:
+        if host.pool is not None:
+            host.pool = pool
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        run_id, payload = task
+        fn, args = pickle.loads(payload)
+        work = Queue.Queue()
+        for item in shard:
+            work.put(item)
+
+        def thread():
+            while True:
+                try:
+                    index, host = work.get_nowait()
+                except Queue.Empty:
+                    return
+                if stop.is_set():
+                    result = HostResult(host.target, skipped=True)
+                else:
+                    result = group.run_one(host, fn, args)
+                results.put((run_id, worker, index, pickle_result(result)))
+
+        threads = []
+        for i in range(min(group.workers, len(shard))):
+            t = threading.Thread(target=thread, name='hostgroup-%u' % i)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        results.put((run_id, worker, None, None))
+    pool.close_all()
+
+class ProcessHostGroup(HostGroup):
+    """HostGroup whose hosts are sharded across worker processes
+    fn for run and stream must be a module level function, it is pickled
+    to the workers. A target always goes to the same worker, which keeps
+    its connections open between runs.
+    e.g.:
+    group = ProcessHostGroup(targets, 'root', '', processes=8, workers=32)
+    for index, result in group.stream(op_sshcmd, 'uname -a'):
+        logger.error('%r', result)
+    results = group.sshcmd('uptime')
+    group.close()
+    """
+    def __init__(self, targets, username='root', password='', processes=None,
+                 workers=16, timeout=None, fail_fast=False, max_failures=None,
+                 connect_retries=None, connect_sleep=None):
+        """processes defaults to the number of CPUs, workers is the threads
+        in each process. The rest are as for HostGroup.
+        """
+        HostGroup.__init__(self, targets, username, password, workers,
+                           timeout, fail_fast, max_failures, connect_retries,
+                           connect_sleep)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = max(1, min(processes, len(self.hosts)))
+        self.procs = []
+        self.results = None
+        self.stop_event = None
+        self.run_id = 0
+        self.aborted = False
+
+    def start(self):
+        """Fork the workers, done by the first run
+        Forking before connections are opened in this process keeps the
+        workers small. Workers that exited are replaced.
+        """
+        if self.procs and all([p.is_alive() for p, t, s in self.procs]):
+            return self
+        self.terminate()
+        self.results = multiprocessing.Queue()
+        self.stop_event = multiprocessing.Event()
+        for worker in range(self.processes):
+            shard = [(index, host) for index, host in enumerate(self.hosts)
+                     if index % self.processes == worker]
+            tasks = multiprocessing.Queue()
+            p = multiprocessing.Process(target=worker_main,
+                                        name='hostgroup-worker-%u' % worker,
+                                        args=(worker, shard, self, tasks,
+                                              self.results, self.stop_event))
+            p.daemon = True
+            p.start()
+            self.procs.append((p, tasks, shard))
+        return self
+
+    def stream(self, fn, *args):
+        """Call fn(host, *args) on every host
+        Yields (index, HostResult) in the order the hosts complete
+        """
+        try:
+            payload = pickle.dumps((fn, args), pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            raise ProcessGroupException('stream: %r can not be sent to the '
+                                        'workers: %r' % (fn, e))
+        self.start()
+        self.run_id += 1
+        run_id = self.run_id
+        self.stop_event.clear()
+        self.aborted = False
+        pending = {}
+        for worker, (p, tasks, shard) in enumerate(self.procs):
+            tasks.put((run_id, payload))
+            pending[worker] = set([index for index, host in shard])
+        failures = 0
+        try:
+            while pending:
+                try:
+                    message = self.results.get(timeout=0.5)
+                except Queue.Empty:
+                    for index, result in self.lost_workers(pending):
+                        yield index, result
+                    continue
+                message_run, worker, index, data = message
+                if message_run != run_id:
+                    # Left over from a run that was abandoned
+                    continue
+                if index is None:
+                    del pending[worker]
+                    continue
+                pending[worker].discard(index)
+                result = pickle.loads(data)
+                if not result.ok and not result.skipped:
+                    failures += 1
+                    if (self.max_failures is not None and not self.aborted and
+                        failures >= self.max_failures):
+                        logger.error('stream: %u failures, stopping', failures)
+                        self.aborted = True
+                        self.stop_event.set()
+                yield index, result
+        except GeneratorExit:
+            # The caller stopped early, let the workers skip the rest
+            self.stop_event.set()
+            raise
+        except BaseException:
+            # Ctrl-C or sys.exit() from a sig_handler
+            self.terminate()
+            raise
+
+    def lost_workers(self, pending):
+        """Fail the hosts of workers that exited, they are replaced on the
+        next run
+        """
+        lost = []
+        for worker in pending.keys():
+            p, tasks, shard = self.procs[worker]
+            if p.is_alive():
+                continue
+            logger.error('lost_workers: worker %u exited with %r', worker,
+                         p.exitcode)
+            for index in sorted(pending.pop(worker)):
+                lost.append((index, HostResult(
+                    self.hosts[index].target,
+                    exception=ProcessGroupException('worker %u exited with %r'
+                                                    % (worker, p.exitcode)))))
+        return lost
+
+    def run(self, fn, *args):
+        """Call fn(host, *args) on every host
+        Returns the GroupResult once all have completed
+        """
+        results = GroupResult([h.target for h in self.hosts])
+        for index, result in self.stream(fn, *args):
+            results.add(index, result)
+        results.aborted = self.aborted
+        logger.debug('run: %s', results.summary())
+        return results
+
+    def sshcmd(self, command):
+        """Execute a command on every host using SSH
+        """
+        return self.run(op_sshcmd, command)
+
+    def command(self, cmd):
+        """Issue a command on every host, logging output as it arrives
+        """
+        return self.run(op_command, cmd)
+
+    def scpfileto(self, local_pathname, remote_path):
+        """Copy a local file to every host
+        """
+        return self.run(op_scpfileto, local_pathname, remote_path)
+
+    def scpfile(self, remote_file, local_path):
+        """Copy a file from every host into local_path/<target>/
+        The local pathname of each copy is returned as the output
+        """
+        return self.run(op_scpfile, remote_file, local_path)
+
+    def terminate(self):
+        """Kill the workers at once
+        """
+        for p, tasks, shard in self.procs:
+            if p.is_alive():
+                p.terminate()
+        for p, tasks, shard in self.procs:
+            p.join(1.0)
+        self.procs = []
+
+    def close(self):
+        """Stop the workers, closing their connections
+        """
+        for p, tasks, shard in self.procs:
+            tasks.put(None)
+        deadline = time.time() + self.cancel_grace
+        for p, tasks, shard in self.procs:
+            p.join(max(0.0, deadline - time.time()))
+        self.terminate()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+#
+# Cache of remote command results that do not change while a host is up
+#
+#    Results of commands such as 'uname -a' are kept per (target, port,
+#    username, command) until their TTL runs out, least recently used first
+#    out when full. The cache can be saved to disk and loaded by the next
+#    run. A host's entries are dropped when it is seen going down, or when
+#    its boot id shows it has booted since they were cached.
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import time
+import pickle
+import logging
+import threading
+from collections import OrderedDict
+from zorilla import metrics
+
+logger = logging.getLogger(__name__)
+
+class ResultCacheException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+def get_cache_path():
+    """Return the default pathname of the saved cache
+    """
+    home = os.path.expanduser("~")
+    return os.path.join(home, '.zorilla', 'cache', 'results.pickle')
+
+class ResultCache(object):
+    """LRU cache of command results with a TTL per entry
+    e.g.:
+    Host.result_cache = ResultCache(get_cache_path(), ttl=86400)
+    rc, output, error = host.cached_sshcmd('cat /proc/cpuinfo')
+    rc, output, error = host.cached_sshcmd('cat /etc/version', ttl=600)
+    logger.error(Host.result_cache.summary())
+    Host.result_cache.save()
+    """
+    def __init__(self, pathname=None, max_entries=1024, ttl=3600):
+        """ttl is the default lifetime of an entry in seconds. With a
+        pathname the entries saved there are loaded.
+        """
+        self.pathname = pathname
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # Boot id of each (target, port) its entries were cached under
+        self.boot_ids = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+        if pathname is not None and os.path.exists(pathname):
+            self.load(pathname)
+
+    def get(self, target, port, username, command):
+        """Return the cached result, None if there is none
+        """
+        key = (target, port, username, command)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] <= time.time():
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                metrics.count('zorilla_result_cache', result='miss')
+                return None
+            # Most recently used last
+            self.entries[key] = entry
+            self.hits += 1
+            metrics.count('zorilla_result_cache', result='hit')
+            return entry[1]
+
+    def put(self, target, port, username, command, result, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        key = (target, port, username, command)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, result)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, target, port=None):
+        """Drop the entries of a target, on every port if port is None
+        """
+        with self.lock:
+            keys = [key for key in self.entries
+                    if key[0] == target and port in (None, key[1])]
+            for key in keys:
+                del self.entries[key]
+            self.invalidations += len(keys)
+        if keys:
+            logger.debug('invalidate: %u entries for %s', len(keys), target)
+
+    def check_boot(self, target, port, boot_id):
+        """Drop a host's entries if it has booted since they were cached
+        A boot_id of None can not be compared, so they are dropped as well
+        """
+        with self.lock:
+            known = self.boot_ids.get((target, port))
+            self.boot_ids[(target, port)] = boot_id
+        if boot_id is None or boot_id != known:
+            if known is not None:
+                logger.debug('check_boot: %s:%s booted since it was cached',
+                             target, port)
+            self.invalidate(target, port)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.boot_ids.clear()
+
+    def load(self, pathname=None):
+        """Add the unexpired entries saved in pathname
+        """
+        pathname = pathname or self.pathname
+        try:
+            with open(pathname, 'rb') as f:
+                saved = pickle.load(f)
+        except Exception as e:
+            logger.error('load: %s is not a result cache: %r', pathname, e)
+            return
+        if not isinstance(saved, dict):
+            logger.error('load: %s has no boot ids, ignoring it', pathname)
+            return
+        now = time.time()
+        with self.lock:
+            self.boot_ids.update(saved['boot_ids'])
+            for key, entry in saved['entries']:
+                if entry[0] > now:
+                    self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def save(self, pathname=None):
+        """Write the unexpired entries, atomically
+        """
+        pathname = pathname or self.pathname
+        if pathname is None:
+            raise ResultCacheException('save: no pathname')
+        directory = os.path.dirname(pathname)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        now = time.time()
+        with self.lock:
+            saved = {'boot_ids': dict(self.boot_ids),
+                     'entries': [(key, entry) for key, entry
+                                 in self.entries.items() if entry[0] > now]}
+        with open(pathname + '.tmp', 'wb') as f:
+            pickle.dump(saved, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(pathname + '.tmp', pathname)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def stats(self):
+        """Return the hit and eviction counters
+        """
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'expired': self.expired,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'entries': len(self.entries),
+                    'hit_rate': self.hit_rate}
+
+    def summary(self):
+        stats = self.stats()
+        return ('result cache: %u hits %u misses (%.1f%%) %u expired '
+                '%u evicted %u invalidated %u entries' %
+                (stats['hits'], stats['misses'], 100 * stats['hit_rate'],
+                 stats['expired'], stats['evictions'], stats['invalidations'],
+                 stats['entries']))
@@ -5,8 +5,15 @@
 # mdeacon@zorillaeng.com
 #
 
+import os
+import errno
+import select
 import serial
 import logging
+from zorilla.matcher import expect_matcher, PatternSet
+from zorilla.deadline import Deadline, ExpectTimeout
+from zorilla import metrics
+from zorilla.transcript import TranscriptRecorder, RecordingPort, ReplayPort
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +29,12 @@ class SerialExpectException(Exception):
     def __str__(self):
         return str(self.value)
 
+class SerialExpectTimeout(SerialExpectException, ExpectTimeout):
+    """recv ran out of time or was cancelled, output holds what came in
+    """
+    def __init__(self, value, output='', reason=None):
+        ExpectTimeout.__init__(self, value, output, reason)
+
 class SerialExpect:
     """Platform independent expect-like behaviour over RS-232
     e.g.:
@@ -29,13 +42,44 @@ class SerialExpect:
     sexp.send('\n')
     sexp.recv(['~]$'])
     sexp.close()
+    Record a session and replay it without the board:
+    sexp = SerialExpect('/dev/ttyUSB0', record='console.ztr')
+    sexp = SerialExpect.replay('console.ztr')
     """
+    # Longest port read timeout in recv, for ports select can not wait on
+    read_slice = 0.1
 
-    def __init__(self, port, baudrate=115200, timeout=5):
+    def __init__(self, port, baudrate=115200, timeout=5, max_buffer=None,
+                 record=None):
         """Create a serial connection
-        The port is open if no exception occurs
+        The port is open if no exception occurs. port is a device name or an
+        open port object.
+        timeout is the default limit for recv, in seconds.
+        max_buffer bounds the output retained by recv, in bytes.
+        With record the session is written to that transcript pathname.
+        """
+        if isinstance(port, basestring):
+            self.s = serial.Serial(port = port, baudrate = baudrate, timeout = timeout)
+        else:
+            self.s = port
+        if record is not None:
+            self.s = RecordingPort(self.s, TranscriptRecorder(
+                record, {'kind': 'serial', 'target': str(port),
+                         'baudrate': baudrate}))
+        self.timeout = timeout
+        self.max_buffer = max_buffer
+        self.match = None
+        # Received output is also written here, e.g. a LogSession
+        self.log = None
+
+    @classmethod
+    def replay(cls, transcript, speed=None, strict=False, timeout=5,
+               max_buffer=None):
+        """A session served from a transcript pathname or Transcript
+        speed 1.0 keeps the recorded pacing, None replays as fast as it can
         """
-        self.s = serial.Serial(port = port, baudrate = baudrate, timeout = timeout)
+        return cls(ReplayPort(transcript, speed, strict, timeout),
+                   timeout=timeout, max_buffer=max_buffer)
 
     def send(self, cmd):
         """Send a character string to the port
@@ -43,38 +87,132 @@ class SerialExpect:
         logger.debug("send: [%s]", cmd);
         self.s.write(cmd)
 
-    def recv(self, resp=[]):
+    def in_waiting(self):
+        """Number of bytes held in the receive buffer
+        """
+        try:
+            return self.s.in_waiting
+        except AttributeError:
+            # pyserial 2.x
+            return self.s.inWaiting()
+
+    def read_available(self):
+        """Drain everything waiting in one read
+        If nothing is waiting, block for the first byte up to the port
+        timeout. Returns an empty string on timeout.
+        """
+        n = self.in_waiting()
+        if n:
+            return self.s.read(n)
+        data = self.s.read(1)
+        if len(data):
+            n = self.in_waiting()
+            if n:
+                data += self.s.read(n)
+        return data
+
+    def fileno(self):
+        """The port's descriptor, None where it can not be waited on with
+        select, e.g. on Windows or when replaying
+        """
+        if os.name == 'nt':
+            return None
+        try:
+            return self.s.fileno()
+        except Exception:
+            return None
+
+    def wait_read(self, fd, wait):
+        """Wait up to wait seconds for input on fd and drain it, leaving the
+        port timeout alone. Returns an empty string on timeout.
+        """
+        try:
+            ready, _, _ = select.select([fd], [], [], wait)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return ''
+            raise
+        if not ready:
+            return ''
+        # A hangup is readable with nothing waiting, the read raises for it
+        return self.s.read(max(1, self.in_waiting()))
+
+    def recv(self, resp=[], deadline=None):
         """Read lines with timeout
-        Match output to a list of response
+        Match output to a list of literals and compiled regexes, or a
+        PatternSet
+        deadline is a Deadline, by default the timeout given when opened.
+        Ports with a descriptor are waited on with select. Others have
+        their timeout set to read_slice for the duration of the call, once,
+        as setting it reconfigures the port.
+        Return the index of the matched response and the output, the
+        ExpectMatch is left in match. Raises SerialExpectTimeout with the
+        partial output when the deadline expires or is cancelled.
         """
-        output = ''
-        while True:
-            data = self.s.read(1)
-            if len(data) == 0:
-                logger.debug('recv: read: [%s]', output);
-                raise SerialExpectException('recv: Timed out before match for %r in recv' % resp);
-            output += data
-            # Look for match in output
-            i = 0
-            for r in resp:
-                if r in output:
-                    logger.debug('recv: read: [%s]', output);
-                    logger.debug('recv: idx %u match: [%s]', i, r);
-                    return i
-                i += 1
-
-        logger.debug('recv: read: [%s]', output);
-        raise SerialExpectException('recv: No match for %r in recv' % resp);
-
-    def send_recv(self, cmd, resp=[], timeout=10):
+        if deadline is None:
+            deadline = Deadline(self.timeout)
+        matcher = expect_matcher(resp, self.max_buffer)
+        self.match = None
+        timeout = self.s.timeout
+        fd = self.fileno()
+        if fd is None:
+            wait = deadline.wait()
+            if wait is None or wait > self.read_slice:
+                wait = self.read_slice
+            if wait != timeout:
+                self.s.timeout = wait
+        timer = metrics.recv_timer('serial')
+        try:
+            while True:
+                reason = deadline.expired()
+                if reason is not None:
+                    logger.debug('recv: read: [%s]', matcher.output);
+                    raise SerialExpectTimeout('recv: %s before match for %r' %
+                                              (deadline.describe(reason), resp),
+                                              matcher.output, reason)
+                if fd is not None:
+                    data = self.wait_read(fd, deadline.wait())
+                else:
+                    data = self.read_available()
+                if len(data) == 0:
+                    continue
+                deadline.touch()
+                if self.log is not None:
+                    self.log.write(data)
+                # Look for match in the new data
+                if timer is None:
+                    i = matcher.feed(data)
+                else:
+                    i = timer.feed(matcher, data)
+                if i >= 0:
+                    logger.debug('recv: read: [%s]', matcher.output);
+                    logger.debug('recv: idx %u match: [%s]', i, resp[i]);
+                    self.match = matcher.match
+                    return i, matcher.output
+        finally:
+            if self.s.timeout != timeout:
+                self.s.timeout = timeout
+            if timer is not None:
+                timer.done()
+
+    def send_recv(self, cmd, resp=[], timeout=10, inactivity=None,
+                  cancel=None):
         """Send a command and expect a response
+        timeout bounds the whole call and inactivity the gap between pieces
+        of output, in seconds. cancel is a CancelToken.
         """
-        self.s.timeout = timeout
+        deadline = Deadline(timeout, inactivity, cancel)
         logger.debug('send_recv: cmd: [%s]', cmd)
         logger.debug('send_recv: resp: [%r]', resp)
         self.send(cmd)
-        return self.recv(resp);
+        return self.recv(resp, deadline);
     
+    def expect(self, resp=[], timeout=10, inactivity=None, cancel=None):
+        """Read until a response matches and return the ExpectMatch
+        """
+        self.recv(resp, Deadline(timeout, inactivity, cancel))
+        return self.match
+
     def close(self):
         self.s.close()
 
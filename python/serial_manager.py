@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+#
+# Continuous capture of many serial consoles from one I/O thread
+#
+#    Every port is read as soon as output arrives, into a ring buffer and
+#    a rotated log file per port. Expect clients attach to a port and read
+#    its live stream, nothing is lost between their calls. Where there is
+#    no select.poll, e.g. Windows, each port is read by its own thread.
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import time
+import errno
+import select
+import serial
+import logging
+import threading
+from zorilla.matcher import expect_matcher
+from zorilla.deadline import Deadline
+from zorilla.serial_expect import SerialExpectException, SerialExpectTimeout
+
+logger = logging.getLogger(__name__)
+
+# Serial ports can be polled, otherwise each has a reader thread
+POLL = hasattr(select, 'poll')
+
+class SerialManagerException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+class RingBuffer(object):
+    """The last size bytes of a stream
+    Offsets count from the start of the stream and stay valid as the
+    oldest bytes are dropped.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.buf = bytearray()
+        self.start = 0
+
+    @property
+    def end(self):
+        return self.start + len(self.buf)
+
+    def append(self, data):
+        self.buf += data
+        excess = len(self.buf) - self.size
+        if excess > 0:
+            del self.buf[:excess]
+            self.start += excess
+
+    def read(self, offset):
+        """Bytes from offset to the end and the number dropped before them
+        """
+        lost = max(0, self.start - offset)
+        offset = max(offset, self.start)
+        return bytes(self.buf[offset - self.start:]), lost
+
+class RotatingLog(object):
+    """Raw byte log rotated to pathname.1 .. pathname.backup_count
+    """
+    def __init__(self, pathname, max_bytes=10485760, backup_count=5):
+        self.pathname = pathname
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.f = open(pathname, 'ab')
+        self.size = self.f.tell()
+
+    def write(self, data):
+        if self.max_bytes and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.f.write(data)
+        self.size += len(data)
+
+    def rotate(self):
+        self.f.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            source = '%s.%u' % (self.pathname, i)
+            if os.path.exists(source):
+                os.rename(source, '%s.%u' % (self.pathname, i + 1))
+        if self.backup_count:
+            os.rename(self.pathname, self.pathname + '.1')
+        self.f = open(self.pathname, 'wb')
+        self.size = 0
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+class ConsolePort(object):
+    """One captured serial port
+    Read by the manager's poll loop, or with poll False by a thread of its
+    own blocking up to read_timeout seconds in each read.
+    """
+    def __init__(self, name, device, baudrate, ring_size, log, session=None,
+                 poll=True, read_timeout=0.5):
+        self.name = name
+        self.device = device
+        self.poll = poll
+        if poll:
+            self.s = serial.Serial(port=device, baudrate=baudrate, timeout=0)
+            self.fd = self.s.fileno()
+        else:
+            self.s = serial.Serial(port=device, baudrate=baudrate,
+                                   timeout=read_timeout)
+            self.fd = None
+        self.ring = RingBuffer(ring_size)
+        self.log = log
+        self.session = session
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.closed = False
+        self.error = None
+        self.thread = None
+        if not poll:
+            self.thread = threading.Thread(target=self.reader,
+                                           name='serial-%s' % name)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def service(self):
+        """Read what is waiting, called on the I/O thread
+        Returns False once the port can not be read any more
+        """
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            self.error = e
+            data = ''
+        if len(data) == 0:
+            logger.error('service: %s closed: %r', self.name, self.error)
+            self.hangup()
+            return False
+        self.received(data)
+        return True
+
+    def reader(self):
+        """Read the port until it is closed, on its own thread
+        """
+        while not self.closed:
+            try:
+                try:
+                    n = self.s.in_waiting
+                except AttributeError:
+                    # pyserial 2.x
+                    n = self.s.inWaiting()
+                # Blocks for the first byte up to the read timeout
+                data = self.s.read(max(1, n))
+            except Exception as e:
+                if not self.closed:
+                    self.error = e
+                    logger.error('reader: %s closed: %r', self.name, e)
+                self.hangup()
+                return
+            if len(data):
+                self.received(data)
+
+    def received(self, data):
+        with self.cond:
+            self.ring.append(data)
+            self.cond.notify_all()
+        if self.log is not None:
+            self.log.write(data)
+        if self.session is not None:
+            self.session.write(data)
+
+    def hangup(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def write(self, data):
+        with self.write_lock:
+            self.s.write(data)
+
+    def close(self):
+        self.hangup()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.s.close()
+        if self.log is not None:
+            self.log.close()
+        if self.session is not None:
+            self.session.close()
+
+class ConsoleClient(object):
+    """Expect-like reader of a port's live stream
+    Has the send, recv, send_recv and expect calls of SerialExpect.
+    Output that has fallen out of the ring buffer before it was read is
+    counted in lost.
+    """
+    def __init__(self, port, offset, timeout=5, max_buffer=None):
+        self.port = port
+        self.offset = offset
+        self.timeout = timeout
+        self.max_buffer = max_buffer
+        self.match = None
+        self.lost = 0
+
+    def send(self, cmd):
+        logger.debug('send: %s [%s]', self.port.name, cmd)
+        self.port.write(cmd)
+
+    def read_available(self, timeout=None):
+        """Everything after the read position, waiting up to timeout
+        Returns an empty string on timeout
+        """
+        port = self.port
+        with port.cond:
+            if port.ring.end <= self.offset and not port.closed:
+                port.cond.wait(timeout)
+            data, lost = port.ring.read(self.offset)
+        if lost:
+            logger.error('read_available: %s lost %u bytes', port.name, lost)
+            self.lost += lost
+        self.offset += lost + len(data)
+        return data
+
+    def recv(self, resp=[], deadline=None):
+        """Read until a response matches
+        Returns the index and the output, the ExpectMatch is left in match
+        """
+        if deadline is None:
+            deadline = Deadline(self.timeout)
+        matcher = expect_matcher(resp, self.max_buffer)
+        self.match = None
+        while True:
+            reason = deadline.expired()
+            if reason is not None:
+                raise SerialExpectTimeout('recv: %s: %s before match for %r' %
+                                          (self.port.name,
+                                           deadline.describe(reason), resp),
+                                          matcher.output, reason)
+            data = self.read_available(deadline.wait())
+            if len(data) == 0:
+                if self.port.closed:
+                    logger.error(matcher.output)
+                    raise SerialExpectException('recv: %s closed' %
+                                                self.port.name)
+                continue
+            deadline.touch()
+            i = matcher.feed(data)
+            if i >= 0:
+                logger.debug('recv: %s idx %u match: [%s]', self.port.name,
+                             i, resp[i])
+                self.match = matcher.match
+                return i, matcher.output
+
+    def send_recv(self, cmd, resp=[], timeout=10, inactivity=None,
+                  cancel=None):
+        deadline = Deadline(timeout, inactivity, cancel)
+        self.send(cmd)
+        return self.recv(resp, deadline)
+
+    def expect(self, resp=[], timeout=10, inactivity=None, cancel=None):
+        self.recv(resp, Deadline(timeout, inactivity, cancel))
+        return self.match
+
+    def close(self):
+        pass
+
+class SerialManager(object):
+    """Capture many serial ports from one thread
+    e.g.:
+    manager = SerialManager(log_dir='/var/log/consoles')
+    manager.add('board1', '/dev/ttyUSB0')
+    manager.add('board2', '/dev/ttyUSB1', 9600)
+    manager.start()
+    sexp = manager.attach('board1')
+    sexp.send_recv('\n', ['login:'])
+    manager.stop()
+    """
+    def __init__(self, ring_size=1048576, log_dir=None, max_bytes=10485760,
+                 backup_count=5, flush_interval=1.0, log_store=None,
+                 poll=None):
+        """ring_size is the output kept per port in bytes. With log_dir each
+        port is also logged to log_dir/<name>.log, rotated at max_bytes.
+        With a LogStore each port is also captured there as a 'serial'
+        session for its name. poll defaults to True where select.poll is
+        available, with it False each port gets a reader thread.
+        """
+        if poll is None:
+            poll = POLL
+        if poll and not POLL:
+            raise SerialManagerException('__init__: select.poll is not '
+                                         'available on this platform')
+        self.poll = poll
+        self.log_store = log_store
+        self.ring_size = ring_size
+        self.log_dir = log_dir
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.ports = {}
+        self.lock = threading.Lock()
+        # Counts the I/O thread's passes, remove waits for the next one
+        self.passes = 0
+        self.passed = threading.Condition(self.lock)
+        self.thread = None
+        self.stopping = False
+        self.waker_r, self.waker_w = os.pipe()
+
+    def add(self, name, device, baudrate=115200):
+        """Open a port and start capturing it
+        """
+        log = None
+        if self.log_dir is not None:
+            if not os.path.exists(self.log_dir):
+                os.makedirs(self.log_dir)
+            log = RotatingLog(os.path.join(self.log_dir, name + '.log'),
+                              self.max_bytes, self.backup_count)
+        session = None
+        if self.log_store is not None:
+            session = self.log_store.session(name, 'serial', device)
+        port = ConsolePort(name, device, baudrate, self.ring_size, log,
+                           session, self.poll, self.flush_interval)
+        with self.lock:
+            if name in self.ports:
+                port.close()
+                raise SerialManagerException('add: %s already added' % name)
+            self.ports[name] = port
+        self.wake()
+        return port
+
+    def remove(self, name):
+        """Stop capturing a port and close it
+        The port is closed once the I/O thread has dropped it, so its
+        descriptor is never read after it is closed or reused.
+        """
+        with self.lock:
+            port = self.ports.pop(name)
+            seen = self.passes
+        self.wake()
+        if self.poll:
+            self.wait_pass(seen)
+        port.close()
+
+    def wait_pass(self, seen):
+        """Wait for the I/O thread to start a pass after seen, if it runs
+        """
+        thread = self.thread
+        if thread is None or thread is threading.current_thread():
+            return
+        with self.passed:
+            while self.passes == seen and thread.is_alive():
+                self.passed.wait(self.flush_interval)
+
+    def port(self, name):
+        try:
+            return self.ports[name]
+        except KeyError:
+            raise SerialManagerException('port: no port %s' % name)
+
+    def attach(self, name, from_start=False, timeout=5, max_buffer=None):
+        """Return a ConsoleClient reading name from now on, or from the
+        oldest output still held with from_start
+        """
+        port = self.port(name)
+        with port.cond:
+            offset = port.ring.start if from_start else port.ring.end
+        return ConsoleClient(port, offset, timeout, max_buffer)
+
+    def output(self, name):
+        """Output held in a port's ring buffer
+        """
+        port = self.port(name)
+        with port.cond:
+            return bytes(port.ring.buf)
+
+    def wake(self):
+        try:
+            os.write(self.waker_w, b'x')
+        except OSError:
+            pass
+
+    def start(self):
+        """Start the I/O thread
+        """
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name='serial-manager')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def run(self):
+        if not self.poll:
+            # The ports read themselves, only the logs are flushed here
+            while not self.stopping:
+                time.sleep(self.flush_interval)
+                self.flush()
+            return
+        poller = select.poll()
+        poller.register(self.waker_r, select.POLLIN)
+        registered = {}
+        flushed = time.time()
+        while not self.stopping:
+            with self.lock:
+                self.passes += 1
+                self.passed.notify_all()
+                ports = dict([(p.fd, p) for p in self.ports.values()
+                              if not p.closed])
+            for fd in set(registered) - set(ports):
+                poller.unregister(fd)
+                del registered[fd]
+            for fd in set(ports) - set(registered):
+                poller.register(fd, select.POLLIN)
+                registered[fd] = ports[fd]
+            try:
+                events = poller.poll(self.flush_interval * 1000)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self.waker_r:
+                    os.read(self.waker_r, 4096)
+                    continue
+                port = registered.get(fd)
+                if port is None:
+                    continue
+                if not port.service():
+                    poller.unregister(fd)
+                    del registered[fd]
+            if time.time() - flushed >= self.flush_interval:
+                self.flush()
+                flushed = time.time()
+
+    def flush(self):
+        with self.lock:
+            ports = self.ports.values()
+        for port in ports:
+            if port.log is not None:
+                port.log.flush()
+
+    def stop(self):
+        """Stop the I/O thread and close every port
+        """
+        self.stopping = True
+        self.wake()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            ports, self.ports = self.ports.values(), {}
+        for port in ports:
+            port.close()
+        os.close(self.waker_r)
+        os.close(self.waker_w)
@@ -100,6 +100,7 @@ setup(
     extras_require = {
         'dev': ['check-manifest'],
         'test': ['coverage'],
+        'zstd': ['zstandard'],
     },
 
     # If there are data files included in your packages that need to be
@@ -117,7 +118,13 @@ setup(
     data_files=[],
 
     scripts=['zorilla/example.py',
-             'zorilla/backtrace.py'],
+             'zorilla/backtrace.py',
+             'zorilla/async_bench.py',
+             'zorilla/sync_bench.py',
+             'zorilla/log_query.py',
+             'zorilla/bench.py',
+             'zorilla/ssh_broker.py',
+             'zorilla/fleet_bench.py'],
 
     # To provide executable scripts, use entry points in preference to the
     # "scripts" keyword. Entry points provide cross-platform support and allow
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+#
+# Persistent remote shell running many commands over one SSH channel
+#
+# mdeacon@zorillaeng.com
+#
+
+import re
+import uuid
+import select
+import logging
+import time
+from zorilla.deadline import current_cancel
+
+logger = logging.getLogger(__name__)
+
+class ShellSessionException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+class FramedOutput(object):
+    """One stream of a framed command, passed on as it arrives
+    Only the bytes that may be the start of the end sentinel are held back,
+    the rest goes to capture or a list of chunks, and to log if given.
+    """
+    def __init__(self, start, end, status, capture=None, log=None):
+        """status is set for stdout, whose end sentinel carries $?
+        """
+        self.start = start + '\n'
+        if status:
+            self.end = re.compile('\n%s (-?\\d+)\n' % re.escape(end))
+        else:
+            self.end = re.compile('\n%s\n' % re.escape(end))
+        # The longest tail that can be an end sentinel cut short
+        self.keep = len(end) + 16
+        self.capture = capture
+        self.log = log
+        self.chunks = []
+        self.started = False
+        self.done = False
+        self.rc = None
+
+    def feed(self, data):
+        """Consume data, return what belongs to the commands after this one
+        """
+        if self.done:
+            return data
+        if not self.started:
+            s = data.find(self.start)
+            if s < 0:
+                return data[-len(self.start):]
+            data = data[s + len(self.start):]
+            self.started = True
+        m = self.end.search(data)
+        if m is not None:
+            self.write(data[:m.start()])
+            if m.groups():
+                self.rc = int(m.group(1))
+            self.done = True
+            return data[m.end():]
+        if len(data) > self.keep:
+            self.write(data[:-self.keep])
+            data = data[-self.keep:]
+        return data
+
+    def flush(self, data):
+        """The shell exited, data is the last of the stream
+        """
+        if self.started and not self.done:
+            self.write(data)
+        self.done = True
+
+    def write(self, data):
+        if not data:
+            return
+        if self.log is not None:
+            self.log.write(data)
+        if self.capture is not None:
+            self.capture.write(data)
+        else:
+            self.chunks.append(data)
+
+    def result(self):
+        if self.capture is not None:
+            return self.capture
+        return ''.join(self.chunks).splitlines(True)
+
+class ShellSession(object):
+    """One long lived shell on an exec channel
+    Each command is framed by start and end sentinels written to both
+    stdout and stderr. The end sentinel on stdout carries the exit status.
+    A command costs one round trip and no channel setup.
+    e.g.:
+    session = ShellSession(sshclient.get_transport())
+    rc, output, error = session.run('uname -a')
+    results = session.run_batch(['hostname', 'uptime'])
+    session.close()
+    """
+    def __init__(self, transport, shell='/bin/sh', timeout=60):
+        """timeout is the default limit in seconds for each run, None for
+        no limit
+        """
+        self.timeout = timeout
+        self.token = uuid.uuid4().hex[:12]
+        self.count = 0
+        # Read but not yet framed, at most a sentinel's length between reads
+        self.out = ''
+        self.err = ''
+        self.closed = False
+        self.channel = transport.open_session()
+        self.channel.exec_command(shell)
+
+    def alive(self):
+        return not self.closed and not (self.channel.closed or
+                                        self.channel.exit_status_ready() or
+                                        self.channel.eof_received)
+
+    def sentinel(self, n, kind):
+        return '__ZS_%s_%u_%s' % (self.token, n, kind)
+
+    def frame(self, command):
+        """Return the id and shell text for one framed command
+        stdin is closed so a command cannot eat the commands after it
+        """
+        self.count += 1
+        n = self.count
+        start = self.sentinel(n, 'B')
+        end = self.sentinel(n, 'E')
+        text = ("printf '%%s\\n' '%s'; printf '%%s\\n' '%s' >&2\n"
+                "{ %s\n} </dev/null\n"
+                "printf '\\n%%s %%d\\n' '%s' $?; printf '\\n%%s\\n' '%s' >&2\n" %
+                (start, start, command, end, end))
+        return n, text
+
+    def run(self, command, timeout=None, capture=None, error_capture=None,
+            log=None):
+        """Run one command, return (rc, output, error) like Host.sshcmd
+        stdout and stderr go to capture and error_capture, OutputCapture
+        instances, when given and are returned in place of the line lists.
+        Both are also written to log, e.g. a LogSession, when given.
+        """
+        return self.run_batch([command], timeout,
+                              [(capture, error_capture, log)])[0]
+
+    def run_batch(self, commands, timeout=None, captures=None):
+        """Pipeline commands in a single write and demultiplex the results
+        Returns a list of (rc, output, error), one per command. captures is
+        an optional (capture, error_capture, log) per command, as for run.
+        A command that times out is still running, so the shell is closed
+        and raises ShellSessionException, as do all later calls.
+        """
+        if not self.alive():
+            raise ShellSessionException('run_batch: shell has exited')
+        if timeout is None:
+            timeout = self.timeout
+        if captures is None:
+            captures = [(None, None, None)] * len(commands)
+        framed = [self.frame(command) for command in commands]
+        logger.debug('run_batch: %r', commands)
+        results = []
+        try:
+            self.channel.sendall(''.join([text for n, text in framed]))
+            deadline = None
+            if timeout is not None:
+                deadline = time.time() + timeout * len(commands)
+            for (n, text), sinks in zip(framed, captures):
+                results.append(self.collect(n, deadline, *sinks))
+        except Exception:
+            self.close()
+            raise
+        return results
+
+    def collect(self, n, deadline, capture=None, error_capture=None,
+                log=None):
+        """Read until command n has finished on both streams
+        """
+        out = FramedOutput(self.sentinel(n, 'B'), self.sentinel(n, 'E'),
+                           True, capture, log)
+        err = FramedOutput(self.sentinel(n, 'B'), self.sentinel(n, 'E'),
+                           False, error_capture, log)
+        while True:
+            self.out = out.feed(self.out)
+            self.err = err.feed(self.err)
+            if out.done and err.done:
+                break
+            if not self.alive() and not (self.channel.recv_ready() or
+                                         self.channel.recv_stderr_ready()):
+                return self.exited(out, err)
+            self.fill(deadline)
+        rc = out.rc
+        output = out.result()
+        error = err.result()
+        logger.debug('rc: %r', rc)
+        logger.debug('output: %r', output)
+        logger.debug('error: %r', error)
+        return rc, output, error
+
+    def exited(self, out, err):
+        """The command ended the shell, e.g. with exit
+        Its exit status becomes the return code
+        """
+        if not out.started:
+            raise ShellSessionException('collect: shell has exited')
+        out.flush(self.out)
+        err.flush(self.err)
+        self.out = ''
+        self.err = ''
+        rc = self.channel.recv_exit_status()
+        logger.debug('exited: rc %r', rc)
+        return rc, out.result(), err.result()
+
+    def fill(self, deadline):
+        """Read whatever has arrived on stdout and stderr
+        deadline is a time, None to wait as long as it takes
+        """
+        remaining = 1.0
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ShellSessionException('collect: timed out')
+        token = current_cancel()
+        if token is not None and token.cancelled:
+            raise ShellSessionException('collect: cancelled')
+        if not (self.channel.recv_ready() or self.channel.recv_stderr_ready()):
+            if not self.alive():
+                raise ShellSessionException('collect: shell has exited')
+            select.select([self.channel], [], [], min(remaining, 1.0))
+        out = []
+        while self.channel.recv_ready():
+            out.append(self.channel.recv(32768))
+        err = []
+        while self.channel.recv_stderr_ready():
+            err.append(self.channel.recv_stderr(32768))
+        self.out += ''.join(out)
+        self.err += ''.join(err)
+
+    def close(self):
+        """Exit the shell and close the channel
+        """
+        if self.closed:
+            return
+        try:
+            if self.alive():
+                self.channel.sendall('exit\n')
+        except Exception as e:
+            logger.debug('close: Exception: %r', e)
+        self.closed = True
+        self.channel.close()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+# Run, query or stop the local SSH broker
+#
+#    While the broker runs, Host and SSHExpect in other processes open
+#    their channels on its authenticated connections instead of connecting
+#    themselves. Connections close after --idle seconds without channels.
+#
+# mdeacon@zorillaeng.com
+
+import os
+import sys
+import socket
+import logging
+import signal
+import traceback
+from zorilla.config import init_config, init_logging
+from zorilla.broker import SSHBroker, broker_request, get_broker_path
+
+logger = logging.getLogger()
+
+def sig_handler(signal, frame):
+    logger.error('Ctrl-c pressed...')
+    sys.exit()
+
+def daemonize():
+    """Detach from the terminal and the parent process
+    """
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in range(3):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+
+def control(path, kind):
+    """Send a status or stop request to the broker on path
+    """
+    try:
+        sock, reply, rest = broker_request(path, {'kind': kind})
+    except socket.error as e:
+        logger.error('No broker on %s: %s', path, e)
+        return 1
+    sock.close()
+    if kind == 'status':
+        logger.error('Broker pid %u on %s', reply['pid'], path)
+        for conn in reply['connections']:
+            logger.error('%s@%s:%s users %u channels %u handshakes %u '
+                         'idle %.0fs', conn['username'], conn['target'],
+                         conn['port'], conn['users'], conn['channels'],
+                         conn['handshakes'], conn['idle'])
+    else:
+        logger.error('Broker on %s stopping', path)
+    return 0
+
+def broker(args):
+    path = args.socket or get_broker_path()
+    if path is None:
+        logger.error('The broker is turned off by ZORILLA_BROKER')
+        return 1
+    if args.status:
+        return control(path, 'status')
+    if args.stop:
+        return control(path, 'stop')
+    exit_idle = None
+    if args.exit_idle:
+        exit_idle = float(args.exit_idle)
+    server = SSHBroker(path, float(args.idle), exit_idle)
+    # Bind before detaching so a second broker fails where it can be seen
+    server.listen()
+    if args.daemon:
+        daemonize()
+    server.serve()
+    return 0
+
+def main(argv=None):
+    # Do argv default this way, as doing it in the functional
+    # declaration sets it at compile time.
+    if argv is None:
+        argv = sys.argv
+
+    # Default configuration
+    defaults = {'loglevel':'ERROR',
+                'report':''}
+
+    # Initialize configuration
+    # This is common to all test utilities
+    parser, remaining_argv = init_config(defaults)
+
+    # Custom parameters
+    parser.add_argument("--socket", help="broker socket pathname, by default "
+                        "ZORILLA_BROKER or ~/.zorilla/broker.sock")
+    parser.add_argument("--idle", default='300',
+                        help="seconds a connection without channels is kept")
+    parser.add_argument("--exit_idle", help="exit after this many seconds "
+                        "without connections")
+    parser.add_argument("-d", "--daemon", action='store_true',
+                        help="run in the background")
+    parser.add_argument("--status", action='store_true',
+                        help="list the broker's connections")
+    parser.add_argument("--stop", action='store_true',
+                        help="stop the broker")
+    args = parser.parse_args(remaining_argv)
+
+    # Set up logging
+    # This is common to all test utilities
+    init_logging(argv, args, logger)
+
+    # Install Ctrl-C handling
+    signal.signal(signal.SIGINT, sig_handler)
+
+    try:
+        return broker(args)
+    except Exception as e:
+        logger.error('main: Exception: %r', e)
+        logger.error('Traceback:\n%s', traceback.format_exc())
+        return -1
+
+if __name__ == '__main__':
+    exit(main())
@@ -5,9 +5,16 @@
 # mdeacon@zorillaeng.com
 #
 
+import socket
 import paramiko
 from paramiko import SSHClient
 import logging
+from zorilla.matcher import expect_matcher, PatternSet
+from zorilla.deadline import Deadline, ExpectTimeout
+from zorilla import metrics
+from zorilla import broker
+from zorilla.transcript import TranscriptRecorder, RecordingChannel, \
+    ReplayChannel
 
 logger = logging.getLogger(__name__)
 
@@ -17,25 +24,74 @@ class SSHExpectException(Exception):
     def __str__(self):
         return repr(self.value)
 
+class SSHExpectTimeout(SSHExpectException, ExpectTimeout):
+    """recv ran out of time or was cancelled, output holds what came in
+    """
+    def __init__(self, value, output='', reason=None):
+        ExpectTimeout.__init__(self, value, output, reason)
+
 class SSHExpect:
     """Platform independent expect-like behaviour over SSH
     e.g.:
     sexp = SSHExpect(target, username, password)
     sexp.send('\n')
     sexp.recv(['~]$'])
+    sexp.send_recv('make\n', ['~]$'], timeout=3600, inactivity=300)
+    m = sexp.expect(PatternSet([re.compile(r'\[(\w+)@\S+ ~\]\$ $')]))
     sexp.close()
+    Record a session and replay it without the host:
+    sexp = SSHExpect(target, username, password, record='session.ztr')
+    sexp = SSHExpect.replay('session.ztr')
     """
-    def __init__(self, target, username, password, timeout=10):
-        """Open an interactive SSH channel to a host. timeout is in seconds.
+    # Use the connection of a running SSH broker, if there is one
+    use_broker = True
+
+    def __init__(self, target, username, password, timeout=10,
+                 max_buffer=None, record=None, channel=None):
+        """Open an interactive SSH channel to a host. timeout is in seconds,
+        the default limit for recv. max_buffer bounds the output retained by
+        recv, in bytes. With record the session is written to that
+        transcript pathname. A channel given is used instead of connecting.
+        A running SSH broker is used for the connection when use_broker is
+        set.
         """
-        self.client = SSHClient()
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.client.load_system_host_keys()
-        self.client.connect(target, username=username, password=password)
-        self.channel = self.client.invoke_shell()
+        self.timeout = timeout
+        self.max_buffer = max_buffer
+        self.match = None
+        # Received output is also written here, e.g. a LogSession
+        self.log = None
+        self.client = None
+        if channel is None and self.use_broker:
+            self.client = broker.connect(target, 22, username, password)
+            if self.client is not None:
+                channel = self.client.invoke_shell()
+        if channel is None:
+            self.client = SSHClient()
+            self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            self.client.load_system_host_keys()
+            metrics.ssh_connect(self.client, target, username=username,
+                                password=password, source='expect')
+            start = metrics.now()
+            channel = self.client.invoke_shell()
+            metrics.since('zorilla_ssh_phase_seconds', start,
+                          phase='channel_open', source='expect')
+        if record is not None:
+            channel = RecordingChannel(channel, TranscriptRecorder(
+                record, {'kind': 'ssh', 'target': target}))
+        self.channel = channel
         self.channel.setblocking(1)
         self.channel.settimeout(timeout)
 
+    @classmethod
+    def replay(cls, transcript, speed=None, strict=False, timeout=10,
+               max_buffer=None):
+        """A session served from a transcript pathname or Transcript
+        speed 1.0 keeps the recorded pacing, None replays as fast as it can
+        """
+        channel = ReplayChannel(transcript, speed, strict)
+        target = channel.stream.transcript.meta.get('target')
+        return cls(target, None, None, timeout, max_buffer, channel=channel)
+
     def send(self, s):
         """Send on channel
         """
@@ -45,36 +101,71 @@ class SSHExpect:
             raise SSHExpectException('bytes_sent: %u != len(s): %u',
                                 bytes_sent, len(s))
 
-    def recv(self, resp=[]):
+    def recv(self, resp=[], deadline=None):
         """Receive from channel
-        Return the index of the matched response if any
+        resp is a list of literals and compiled regexes, or a PatternSet
+        deadline is a Deadline, by default the timeout given when opened
+        Return the index of the matched response if any, the ExpectMatch is
+        left in match. Raises SSHExpectTimeout with the partial output when
+        the deadline expires or is cancelled.
         """
         logger.debug('recv: exp resp: [%r]', resp)
-        i = 0
-        output = ''
-        while True:
-            s = self.channel.recv(nbytes=4096)
-            if len(s) == 0:
-                break
-            logger.debug('recv: got resp: [%s]', s)
-            output += s
-            i = 0
-            for r in resp:
-                if r in output:
-                    logger.debug('recv: match resp: [%s]' % r)
-                    return i, output
-                i += 1
-        logger.error(output)
+        if deadline is None:
+            deadline = Deadline(self.timeout)
+        matcher = expect_matcher(resp, self.max_buffer)
+        self.match = None
+        timer = metrics.recv_timer('ssh')
+        try:
+            while True:
+                reason = deadline.expired()
+                if reason is not None:
+                    logger.error(matcher.output)
+                    raise SSHExpectTimeout('recv: %s' %
+                                           deadline.describe(reason),
+                                           matcher.output, reason)
+                self.channel.settimeout(deadline.wait())
+                try:
+                    s = self.channel.recv(nbytes=4096)
+                except socket.timeout:
+                    continue
+                if len(s) == 0:
+                    break
+                deadline.touch()
+                logger.debug('recv: got resp: [%s]', s)
+                if self.log is not None:
+                    self.log.write(s)
+                if timer is None:
+                    i = matcher.feed(s)
+                else:
+                    i = timer.feed(matcher, s)
+                if i >= 0:
+                    logger.debug('recv: match resp: [%s]' % resp[i])
+                    self.match = matcher.match
+                    return i, matcher.output
+        finally:
+            self.channel.settimeout(self.timeout)
+            if timer is not None:
+                timer.done()
+        logger.error(matcher.output)
         raise SSHExpectException('recv: no match')
 
-    def send_recv(self, cmd, resp=[], timeout=10):
+    def send_recv(self, cmd, resp=[], timeout=10, inactivity=None,
+                  cancel=None):
         """Combine send and receive in a single call
+        timeout bounds the whole call and inactivity the gap between pieces
+        of output, in seconds. cancel is a CancelToken.
         """
-        self.channel.settimeout(timeout)
+        deadline = Deadline(timeout, inactivity, cancel)
         logger.debug('send_recv: cmd [%s]' % cmd)
         logger.debug('send_recv: resp [%r]', resp)
         self.send(cmd)
-        return self.recv(resp)
+        return self.recv(resp, deadline)
+
+    def expect(self, resp=[], timeout=10, inactivity=None, cancel=None):
+        """Receive until a response matches and return the ExpectMatch
+        """
+        self.recv(resp, Deadline(timeout, inactivity, cancel))
+        return self.match
 
     def close(self):
         """Close the channel and SSH client
@@ -85,4 +176,5 @@ class SSHExpect:
         else:
             logger.debug('channel.exit_status_ready() returned False')
         self.channel.close()
-        self.client.close()
+        if self.client is not None:
+            self.client.close()
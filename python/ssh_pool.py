@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#
+# Pool of reusable, authenticated SSH connections
+#
+# mdeacon@zorillaeng.com
+#
+
+import threading
+import logging
+import atexit
+import time
+
+logger = logging.getLogger(__name__)
+
+class SSHPoolException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+class PooledConnection(object):
+    """An SSH client held open by the pool
+    """
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.created = time.time()
+        self.last_used = self.created
+        self.users = 0
+
+    def is_alive(self, probe=False):
+        """Check the transport is still up and authenticated
+        When probe is set, push an SSH_MSG_IGNORE to detect a dead peer
+        """
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        if not transport.is_authenticated():
+            return False
+        if probe:
+            try:
+                transport.send_ignore()
+            except Exception as e:
+                logger.debug('is_alive: %s send_ignore: %r', self.key, e)
+                return False
+        return True
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception as e:
+            logger.debug('close: %s Exception: %r', self.key, e)
+
+class SSHConnectionPool(object):
+    """Keep one open SSH transport per (target, username)
+    Callers get the same SSHClient back on each acquire and open new
+    channels on it, so only the first call pays for the TCP connect,
+    key exchange and authentication.
+    e.g.:
+    pool = SSHConnectionPool(idle_timeout=300)
+    client = pool.acquire(('10.0.0.1', 'root'), connect)
+    client.exec_command('uptime')
+    pool.release(('10.0.0.1', 'root'))
+    """
+    def __init__(self, idle_timeout=300, probe_after=30):
+        """idle_timeout is in seconds. Connections idle for probe_after
+        seconds are probed before being handed out again.
+        """
+        self.idle_timeout = idle_timeout
+        self.probe_after = probe_after
+        self.lock = threading.RLock()
+        self.connections = {}
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.reaper = None
+
+    def acquire(self, key, connect):
+        """Return a live SSHClient for key
+        connect() is called to create a new client on a miss
+        """
+        with self.lock:
+            self.close_idle()
+            conn = self.connections.get(key)
+            if conn is not None:
+                idle = time.time() - conn.last_used
+                if conn.is_alive(probe=idle > self.probe_after):
+                    self.hits += 1
+                    conn.users += 1
+                    conn.last_used = time.time()
+                    logger.debug('acquire: hit %s', key)
+                    return conn.client
+                logger.debug('acquire: %s is dead, reconnecting', key)
+                self.reconnects += 1
+                del self.connections[key]
+                conn.close()
+            self.misses += 1
+        # Connect outside the lock so one slow host does not stall others
+        client = connect()
+        with self.lock:
+            existing = self.connections.get(key)
+            if existing is not None and existing.is_alive():
+                # Another thread connected first, use its transport
+                client.close()
+                existing.users += 1
+                existing.last_used = time.time()
+                return existing.client
+            conn = PooledConnection(key, client)
+            conn.users = 1
+            self.connections[key] = conn
+            logger.debug('acquire: miss %s', key)
+            return client
+
+    def release(self, key):
+        """Hand a connection back to the pool
+        """
+        with self.lock:
+            conn = self.connections.get(key)
+            if conn is None:
+                return
+            conn.users = max(0, conn.users - 1)
+            conn.last_used = time.time()
+
+    def discard(self, key):
+        """Close and forget a connection, e.g. after a protocol error
+        """
+        with self.lock:
+            conn = self.connections.pop(key, None)
+        if conn is not None:
+            logger.debug('discard: %s', key)
+            conn.close()
+
+    def close_idle(self, now=None):
+        """Close connections unused for longer than idle_timeout
+        """
+        if now is None:
+            now = time.time()
+        idle = []
+        with self.lock:
+            for key, conn in list(self.connections.items()):
+                if conn.users == 0 and now - conn.last_used > self.idle_timeout:
+                    idle.append(self.connections.pop(key))
+        for conn in idle:
+            logger.debug('close_idle: closing %s', conn.key)
+            conn.close()
+        return len(idle)
+
+    def close_all(self):
+        """Close every pooled connection
+        """
+        with self.lock:
+            conns = list(self.connections.values())
+            self.connections.clear()
+        for conn in conns:
+            conn.close()
+
+    def start_reaper(self, interval=None):
+        """Close idle connections from a background thread
+        Without the reaper, idle connections are closed on the next acquire
+        """
+        if self.reaper is not None:
+            return
+        if interval is None:
+            interval = max(1, self.idle_timeout / 2)
+
+        def reap():
+            while True:
+                time.sleep(interval)
+                self.close_idle()
+
+        self.reaper = threading.Thread(target=reap, name='ssh-pool-reaper')
+        self.reaper.daemon = True
+        self.reaper.start()
+
+    def stats(self):
+        """Return reuse counters
+        """
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'reconnects': self.reconnects,
+                    'open': len(self.connections)}
+
+default_pool = SSHConnectionPool()
+atexit.register(default_pool.close_all)
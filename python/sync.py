@@ -0,0 +1,559 @@
+#!/usr/bin/env python
+#
+# Block-hash delta sync of a local directory to a host
+#
+#    A small python helper runs on the host. It lists the remote tree,
+#    returns adler32/md5 sums for each block of a file and rebuilds files
+#    from a delta of block copies and literal data.
+#    New files are staged beside their destination and renamed into place
+#    together once everything has arrived.
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import stat
+import json
+import zlib
+import pipes
+import hashlib
+import posixpath
+import logging
+from paramiko import SFTPClient
+
+logger = logging.getLogger(__name__)
+
+# Runs on the host under python 2 or 3
+# Requests and replies are JSON lines, file data follows a header raw
+HELPER = r'''
+import sys, os, stat, json, zlib, hashlib
+inp = getattr(sys.stdin, 'buffer', sys.stdin)
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+root = sys.argv[1]
+staged = []
+
+def reply(obj):
+    out.write(json.dumps(obj).encode() + b'\n')
+    out.flush()
+
+def request():
+    line = inp.readline()
+    if not line:
+        return None
+    return json.loads(line.decode())
+
+def read_exact(n):
+    parts = []
+    while n > 0:
+        data = inp.read(n)
+        if not data:
+            raise IOError('short read')
+        parts.append(data)
+        n -= len(data)
+    return b''.join(parts)
+
+def staging(path):
+    return os.path.join(os.path.dirname(path),
+                        '.%s.zsync' % os.path.basename(path))
+
+def do_list(req):
+    files = {}
+    dirs = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        if rel != '.':
+            dirs.append(rel)
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                files[os.path.relpath(path, root)] = [st.st_size,
+                                                      int(st.st_mtime),
+                                                      stat.S_IMODE(st.st_mode)]
+    reply({'files': files, 'dirs': dirs})
+
+def do_sums(req):
+    sums = []
+    with open(os.path.join(root, req['path']), 'rb') as f:
+        while True:
+            block = f.read(req['block'])
+            if not block:
+                break
+            sums.append([zlib.adler32(block) & 0xffffffff,
+                         hashlib.md5(block).hexdigest()])
+    reply({'sums': sums})
+
+def do_patch(req):
+    path = os.path.join(root, req['path'])
+    tmp = staging(path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    old = None
+    if os.path.isfile(path):
+        old = open(path, 'rb')
+    md5 = hashlib.md5()
+    staged.append((tmp, path))
+    with open(tmp, 'wb') as f:
+        while True:
+            op = request()
+            if op is None:
+                raise IOError('patch: input ended')
+            if 'end' in op:
+                break
+            if 'copy' in op:
+                old.seek(op['copy'] * req['block'])
+                data = old.read(op['count'] * req['block'])
+            else:
+                data = read_exact(op['data'])
+            md5.update(data)
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    if old is not None:
+        old.close()
+    if md5.hexdigest() != req['md5']:
+        raise IOError('patch: %s md5 mismatch' % req['path'])
+    os.chmod(tmp, req['mode'])
+    os.utime(tmp, (req['mtime'], req['mtime']))
+    reply({'ok': True})
+
+def do_commit(req):
+    for rel in req['dirs']:
+        path = os.path.join(root, rel)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    while staged:
+        tmp, path = staged.pop(0)
+        os.rename(tmp, path)
+    for rel in req['delete']:
+        os.remove(os.path.join(root, rel))
+    reply({'ok': True})
+
+def main():
+    try:
+        while True:
+            req = request()
+            if req is None:
+                break
+            try:
+                globals()['do_' + req['op']](req)
+            except Exception as e:
+                reply({'error': '%s: %s' % (req['op'], e)})
+                break
+    finally:
+        for tmp, path in staged:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+main()
+'''
+
+# adler32 modulus
+ADLER = 65521
+
+class SyncException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+class SyncStats(object):
+    """What a sync moved and what it saved over copying whole files
+    """
+    def __init__(self):
+        self.files = 0
+        self.unchanged = 0
+        self.created = 0
+        self.updated = 0
+        self.deleted = 0
+        self.bytes_total = 0
+        self.bytes_sent = 0
+        self.bytes_matched = 0
+
+    @property
+    def bytes_saved(self):
+        """Bytes not sent compared with copying every file
+        """
+        return self.bytes_total - self.bytes_sent
+
+    def __str__(self):
+        return ('%u files: %u unchanged %u created %u updated %u deleted, '
+                '%u of %u bytes sent, %u saved' %
+                (self.files, self.unchanged, self.created, self.updated,
+                 self.deleted, self.bytes_sent, self.bytes_total,
+                 self.bytes_saved))
+
+def weak_sum(data):
+    """adler32 of data split into its two 16 bit halves
+    """
+    value = zlib.adler32(bytes(data)) & 0xffffffff
+    return value & 0xffff, value >> 16
+
+class DirSync(object):
+    """Push a local directory to a host, sending only what changed
+    Files whose size and mtime match are skipped. The rest are compared by
+    block sums from the host and rebuilt there from the blocks it already
+    has plus the literal data that differs. Nothing is renamed into place
+    until every file has been staged.
+    e.g.:
+    sync = DirSync(sshclient.get_transport())
+    stats = sync.sync('overlay', '/opt/overlay', dry_run=True)
+    logger.error('%s', stats)
+    """
+    # Files up to this size are searched for moved blocks at every offset,
+    # larger ones are only compared block by block in place
+    rolling_limit = 4194304
+    # Literal data is sent in pieces of at most this many bytes
+    literal_size = 1048576
+
+    def __init__(self, transport, block_size=65536, delete=False,
+                 checksum=False):
+        """With delete set remote files missing locally are removed. With
+        checksum set files are compared even if size and mtime match.
+        """
+        self.transport = transport
+        self.block_size = block_size
+        self.delete = delete
+        self.checksum = checksum
+        self.channel = None
+        self.reader = None
+
+    def start_helper(self, remote_dir):
+        """Start the helper on the host and return its listing of the
+        remote tree, None if the host has no python
+        """
+        command = ('P=$(command -v python3 || command -v python) || exit 127; '
+                   'exec "$P" -c %s %s' % (pipes.quote(HELPER),
+                                            pipes.quote(remote_dir)))
+        self.channel = self.transport.open_session()
+        self.channel.exec_command(command)
+        self.reader = self.channel.makefile('rb')
+        try:
+            return self.call({'op': 'list'})
+        except SyncException:
+            if self.channel.eof_received:
+                rc = self.channel.recv_exit_status()
+                if rc == 127:
+                    self.stop_helper()
+                    return None
+            raise
+
+    def stop_helper(self):
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+            self.reader = None
+
+    def send(self, obj, data=''):
+        self.channel.sendall(json.dumps(obj) + '\n' + data)
+
+    def call(self, obj):
+        self.send(obj)
+        return self.receive()
+
+    def receive(self):
+        line = self.reader.readline()
+        if not line:
+            raise SyncException('receive: helper exited')
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise SyncException('receive: %s' % reply['error'])
+        return reply
+
+    def local_tree(self, local_dir):
+        """Return ({relpath: (size, mtime, mode)}, [relative dirs])
+        """
+        files = {}
+        dirs = []
+        for dirpath, dirnames, filenames in os.walk(local_dir):
+            rel = os.path.relpath(dirpath, local_dir)
+            if rel != '.':
+                dirs.append(rel.replace(os.sep, '/'))
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode):
+                    rel = os.path.relpath(path, local_dir).replace(os.sep, '/')
+                    files[rel] = (st.st_size, int(st.st_mtime),
+                                  stat.S_IMODE(st.st_mode))
+        return files, dirs
+
+    def sync(self, local_dir, remote_dir, dry_run=False):
+        """Make remote_dir match local_dir, returns SyncStats
+        With dry_run set nothing on the host is changed
+        """
+        stats = SyncStats()
+        local, dirs = self.local_tree(local_dir)
+        try:
+            listing = self.start_helper(remote_dir)
+            if listing is None:
+                logger.error('sync: no python on the host, '
+                             'comparing whole files')
+                return self.sync_files(local_dir, remote_dir, local, dirs,
+                                       stats, dry_run)
+            remote = listing['files']
+            for rel in sorted(local):
+                size, mtime, mode = local[rel]
+                stats.files += 1
+                stats.bytes_total += size
+                have = remote.get(rel)
+                if (have is not None and not self.checksum and
+                    have[0] == size and have[1] == mtime):
+                    stats.unchanged += 1
+                    stats.bytes_matched += size
+                    continue
+                self.push(os.path.join(local_dir, rel), rel, have, mode,
+                          mtime, stats, dry_run)
+            missing = [d for d in dirs if d not in listing['dirs']]
+            delete = []
+            if self.delete:
+                delete = [rel for rel in remote if rel not in local]
+                stats.deleted = len(delete)
+            if not dry_run:
+                self.call({'op': 'commit', 'dirs': missing,
+                           'delete': delete})
+        finally:
+            self.stop_helper()
+        logger.debug('sync: %s', stats)
+        return stats
+
+    def push(self, local_pathname, rel, have, mode, mtime, stats, dry_run):
+        """Send one file as a delta against the copy on the host
+        """
+        sums = []
+        if have is not None:
+            sums = self.call({'op': 'sums', 'path': rel,
+                              'block': self.block_size})['sums']
+        if not dry_run:
+            self.send({'op': 'patch', 'path': rel, 'block': self.block_size,
+                       'mode': mode, 'mtime': mtime,
+                       'md5': self.file_md5(local_pathname)})
+        sent = 0
+        matched = 0
+        for op, value in self.delta(local_pathname, sums):
+            if op == 'copy':
+                index, count = value
+                matched += count * self.block_size
+                if not dry_run:
+                    self.send({'copy': index, 'count': count})
+            else:
+                sent += len(value)
+                if not dry_run:
+                    self.send({'data': len(value)}, value)
+        if not dry_run:
+            self.send({'end': True})
+            self.receive()
+        size = os.path.getsize(local_pathname)
+        matched = min(matched, size)
+        if have is None:
+            stats.created += 1
+        elif sent == 0 and matched == size == have[0]:
+            stats.unchanged += 1
+        else:
+            stats.updated += 1
+        stats.bytes_sent += sent
+        stats.bytes_matched += matched
+        logger.debug('push: %s %u bytes sent %u matched', rel, sent, matched)
+
+    def file_md5(self, pathname):
+        md5 = hashlib.md5()
+        with open(pathname, 'rb') as f:
+            while True:
+                data = f.read(self.literal_size)
+                if len(data) == 0:
+                    break
+                md5.update(data)
+        return md5.hexdigest()
+
+    def delta(self, pathname, sums):
+        """Yield ('copy', (index, count)) and ('data', bytes) rebuilding
+        the file from the host's blocks
+        """
+        if len(sums) and os.path.getsize(pathname) <= self.rolling_limit:
+            ops = self.rolling_delta(pathname, sums)
+        else:
+            ops = self.aligned_delta(pathname, sums)
+        return self.coalesce(ops)
+
+    def coalesce(self, ops):
+        """Merge runs of consecutive block copies and small literals
+        """
+        copy = None
+        literal = []
+        size = 0
+        for op, value in ops:
+            if op == 'copy':
+                if literal:
+                    yield 'data', ''.join(literal)
+                    literal = []
+                    size = 0
+                if copy is not None and copy[0] + copy[1] == value:
+                    copy = (copy[0], copy[1] + 1)
+                    continue
+                if copy is not None:
+                    yield 'copy', copy
+                copy = (value, 1)
+            else:
+                if copy is not None:
+                    yield 'copy', copy
+                    copy = None
+                literal.append(value)
+                size += len(value)
+                if size >= self.literal_size:
+                    yield 'data', ''.join(literal)
+                    literal = []
+                    size = 0
+        if copy is not None:
+            yield 'copy', copy
+        if literal:
+            yield 'data', ''.join(literal)
+
+    def aligned_delta(self, pathname, sums):
+        """Compare each block with the host's block at the same offset
+        """
+        with open(pathname, 'rb') as f:
+            index = 0
+            while True:
+                block = f.read(self.block_size)
+                if len(block) == 0:
+                    break
+                if index < len(sums) and self.same(block, sums[index]):
+                    yield 'copy', index
+                else:
+                    yield 'data', block
+                index += 1
+
+    def same(self, block, remote):
+        weak = zlib.adler32(block) & 0xffffffff
+        return weak == remote[0] and hashlib.md5(block).hexdigest() == remote[1]
+
+    def rolling_delta(self, pathname, sums):
+        """Find the host's blocks at any offset with a rolling adler32
+        """
+        n = self.block_size
+        table = {}
+        for index, (weak, strong) in enumerate(sums):
+            table.setdefault(weak, []).append((index, strong))
+        with open(pathname, 'rb') as f:
+            data = bytearray(f.read())
+        size = len(data)
+        pos = 0
+        literal = 0
+        a, b = weak_sum(data[0:n])
+        while pos + n <= size:
+            index = self.lookup(table, (b << 16) | a, data, pos, n)
+            if index is not None:
+                if literal < pos:
+                    yield 'data', bytes(data[literal:pos])
+                yield 'copy', index
+                pos += n
+                literal = pos
+                a, b = weak_sum(data[pos:pos + n])
+                continue
+            if pos + n < size:
+                out = data[pos]
+                a = (a - out + data[pos + n]) % ADLER
+                b = (b - n * out + a - 1) % ADLER
+            pos += 1
+        # A short last block can only match the host's short last block
+        tail = bytes(data[literal:])
+        if (len(tail) and len(tail) < n and
+            self.same(tail, sums[-1])):
+            yield 'copy', len(sums) - 1
+        elif len(tail):
+            yield 'data', tail
+
+    def lookup(self, table, weak, data, pos, n):
+        candidates = table.get(weak)
+        if candidates is None:
+            return None
+        strong = hashlib.md5(bytes(data[pos:pos + n])).hexdigest()
+        for index, remote in candidates:
+            if remote == strong:
+                return index
+        return None
+
+    def sync_files(self, local_dir, remote_dir, local, dirs, stats, dry_run):
+        """Whole file sync over SFTP for hosts without python
+        Files that differ in size or mtime are compared by md5sum
+        """
+        sftp = SFTPClient.from_transport(self.transport)
+        try:
+            remote = {}
+            self.remote_tree(sftp, remote_dir, '', remote)
+            staged = []
+            for rel in sorted(local):
+                size, mtime, mode = local[rel]
+                local_pathname = os.path.join(local_dir, rel)
+                remote_pathname = posixpath.join(remote_dir, rel)
+                stats.files += 1
+                stats.bytes_total += size
+                have = remote.get(rel)
+                if have is not None and have[0] == size:
+                    if ((have[1] == mtime and not self.checksum) or
+                        self.remote_md5(remote_pathname) ==
+                        self.file_md5(local_pathname)):
+                        stats.unchanged += 1
+                        stats.bytes_matched += size
+                        if have[1] != mtime and not dry_run:
+                            sftp.utime(remote_pathname, (mtime, mtime))
+                        continue
+                if have is None:
+                    stats.created += 1
+                else:
+                    stats.updated += 1
+                stats.bytes_sent += size
+                if dry_run:
+                    continue
+                tmp = posixpath.join(posixpath.dirname(remote_pathname),
+                                     '.%s.zsync' %
+                                     posixpath.basename(remote_pathname))
+                self.remote_makedirs(sftp, posixpath.dirname(remote_pathname))
+                sftp.put(local_pathname, tmp)
+                sftp.chmod(tmp, mode)
+                sftp.utime(tmp, (mtime, mtime))
+                staged.append((tmp, remote_pathname))
+            if self.delete:
+                delete = [rel for rel in remote if rel not in local]
+                stats.deleted = len(delete)
+            if not dry_run:
+                for rel in dirs:
+                    self.remote_makedirs(sftp, posixpath.join(remote_dir, rel))
+                for tmp, remote_pathname in staged:
+                    sftp.posix_rename(tmp, remote_pathname)
+                if self.delete:
+                    for rel in delete:
+                        sftp.remove(posixpath.join(remote_dir, rel))
+        finally:
+            sftp.close()
+        logger.debug('sync_files: %s', stats)
+        return stats
+
+    def remote_tree(self, sftp, remote_dir, rel, files):
+        try:
+            entries = sftp.listdir_attr(posixpath.join(remote_dir, rel))
+        except IOError:
+            return
+        for attr in entries:
+            path = posixpath.join(rel, attr.filename)
+            if stat.S_ISDIR(attr.st_mode):
+                self.remote_tree(sftp, remote_dir, path, files)
+            elif stat.S_ISREG(attr.st_mode):
+                files[path] = (attr.st_size, int(attr.st_mtime))
+
+    def remote_makedirs(self, sftp, path):
+        try:
+            sftp.stat(path)
+        except IOError:
+            self.remote_makedirs(sftp, posixpath.dirname(path))
+            sftp.mkdir(path)
+
+    def remote_md5(self, remote_pathname):
+        channel = self.transport.open_session()
+        try:
+            channel.exec_command('md5sum %s' % pipes.quote(remote_pathname))
+            output = channel.makefile('rb').read()
+        finally:
+            channel.close()
+        return (output.split() or [None])[0]
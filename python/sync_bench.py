@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+# Compare Host.sync with scpfileto on a directory where a little changed
+#
+#    A tree of random files is pushed once, then a percentage of the files
+#    get a block overwritten. The tree is pushed again with scpfileto, file
+#    by file, and with sync.
+#
+# mdeacon@zorillaeng.com
+
+import os
+import sys
+import time
+import shutil
+import random
+import logging
+import signal
+import tempfile
+import traceback
+from zorilla.config import init_config, init_logging
+from zorilla.host import Host
+from zorilla.local_server import LocalSSHServer
+
+logger = logging.getLogger()
+
+def sig_handler(signal, frame):
+    logger.error('Ctrl-c pressed...')
+    sys.exit()
+
+def make_tree(local_dir, files, size):
+    """Write files of random data spread over a few directories
+    """
+    for i in range(files):
+        path = os.path.join(local_dir, 'd%02u' % (i % 10))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(os.path.join(path, 'f%05u' % i), 'wb') as f:
+            f.write(os.urandom(size))
+
+def change_tree(local_dir, percent):
+    """Overwrite a small block in percent of the files
+    Returns the number of files changed
+    """
+    pathnames = []
+    for dirpath, dirnames, filenames in os.walk(local_dir):
+        pathnames += [os.path.join(dirpath, name) for name in filenames]
+    pathnames.sort()
+    count = max(1, len(pathnames) * percent // 100)
+    for pathname in random.sample(pathnames, count):
+        size = os.path.getsize(pathname)
+        with open(pathname, 'r+b') as f:
+            f.seek(random.randint(0, max(0, size - 4096)))
+            f.write(os.urandom(min(4096, size)))
+        # Make sure the mtime moves even on coarse filesystems
+        st = os.stat(pathname)
+        os.utime(pathname, (st.st_atime, st.st_mtime + 2))
+    return count
+
+def push_scp(host, local_dir, remote_dir):
+    """Copy every file with scpfileto
+    """
+    for dirpath, dirnames, filenames in os.walk(local_dir):
+        rel = os.path.relpath(dirpath, local_dir)
+        path = remote_dir if rel == '.' else remote_dir + '/' + rel
+        host.sshcmd('mkdir -p %s' % path)
+        for name in filenames:
+            host.scpfileto(os.path.join(dirpath, name), path + '/' + name)
+
+def bench(args):
+    server = None
+    target = args.ip_eth0
+    port = 22
+    if args.local_server:
+        server = LocalSSHServer().start()
+        target = '127.0.0.1'
+        port = server.port
+    local_dir = tempfile.mkdtemp(prefix='sync_bench')
+    try:
+        host = Host(target, args.username, args.password, port=port)
+        host.progress_cb = lambda filename, size, sent, stats=None: None
+        files = int(args.files)
+        size = int(args.size)
+        make_tree(local_dir, files, size)
+        host.sshcmd('rm -rf %s' % args.remote_dir)
+        stats = host.sync(local_dir, args.remote_dir)
+        logger.error('initial push: %s', stats)
+        changed = change_tree(local_dir, int(args.changed))
+        logger.error('changed %u of %u files', changed, files)
+
+        stats = host.sync(local_dir, args.remote_dir, dry_run=True)
+        logger.error('dry run: %s', stats)
+
+        start = time.time()
+        push_scp(host, local_dir, args.remote_dir + '.scp')
+        scp_time = time.time() - start
+        logger.error('scpfileto: %u bytes in %.2f s', files * size, scp_time)
+
+        start = time.time()
+        stats = host.sync(local_dir, args.remote_dir)
+        sync_time = time.time() - start
+        logger.error('sync: %s in %.2f s', stats, sync_time)
+        logger.error('sync took %.1f%% of the scpfileto time and sent %.1f%% '
+                     'of the bytes', 100.0 * sync_time / scp_time,
+                     100.0 * stats.bytes_sent / max(1, stats.bytes_total))
+        host.sshcmd('rm -rf %s %s.scp' % (args.remote_dir, args.remote_dir))
+    finally:
+        shutil.rmtree(local_dir, True)
+        if server is not None:
+            server.stop()
+
+def main(argv=None):
+    # Do argv default this way, as doing it in the functional
+    # declaration sets it at compile time.
+    if argv is None:
+        argv = sys.argv
+
+    # Default configuration
+    defaults = {'ip_eth0':'192.168.2.68',
+                'username':'root',
+                'password':'',
+                'loglevel':'ERROR',
+                'report':''}
+
+    # Initialize configuration
+    # This is common to all test utilities
+    parser, remaining_argv = init_config(defaults)
+
+    # Custom parameters
+    parser.add_argument("-a", "--ip_eth0", help="IP address for eth0")
+    parser.add_argument("-u", "--username", help="username")
+    parser.add_argument("-p", "--password", help="password")
+    parser.add_argument("-n", "--files", default='200', help="number of files")
+    parser.add_argument("-s", "--size", default='1048576',
+                        help="bytes per file")
+    parser.add_argument("--changed", default='1',
+                        help="percentage of files changed")
+    parser.add_argument("--remote_dir", default='/tmp/sync_bench',
+                        help="remote directory, removed afterwards")
+    parser.add_argument("-L", "--local_server", action='store_true',
+                        help="run against a local SSH server")
+    args = parser.parse_args(remaining_argv)
+
+    # Set up logging
+    # This is common to all test utilities
+    init_logging(argv, args, logger)
+
+    # Install Ctrl-C handling
+    signal.signal(signal.SIGINT, sig_handler)
+
+    try:
+        bench(args)
+    except Exception as e:
+        logger.error('main: Exception: %r', e)
+        logger.error('Traceback:\n%s', traceback.format_exc())
+        return -1
+
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
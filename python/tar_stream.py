@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+#
+# Bulk transfer of many small files as one tar stream over one channel
+#
+#    put packs the selected files into a tar stream piped into tar x on the
+#    host, get unpacks the output of tar c run on the host. The stream can
+#    be gzip or zstd compressed.
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import socket
+import gzip
+import pipes
+import fnmatch
+import tarfile
+import logging
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+class TarStreamException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+class TarEntry(object):
+    """One file in a tar stream
+    """
+    def __init__(self, name, size, mode, mtime, linkname=None):
+        self.name = name
+        self.size = size
+        self.mode = mode
+        self.mtime = mtime
+        self.linkname = linkname
+
+    def __repr__(self):
+        return 'TarEntry(%s %u %o)' % (self.name, self.size, self.mode)
+
+class TarResult(object):
+    """Manifest and byte counts of one tar stream transfer
+    """
+    def __init__(self):
+        self.manifest = []
+        self.rc = None
+        self.error = []
+        self.wire_bytes = 0
+
+    @property
+    def bytes(self):
+        """Size of the file data moved, before compression
+        """
+        return sum([entry.size for entry in self.manifest])
+
+    def __repr__(self):
+        return ('TarResult(%u files %u bytes %u on the wire rc %r)' %
+                (len(self.manifest), self.bytes, self.wire_bytes, self.rc))
+
+class ChannelWriter(object):
+    """Write side of an exec channel as a file object
+    Once the far end has gone away the rest of the stream is dropped and
+    the error kept, so the remote side's reason can be reported instead.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.count = 0
+        self.error = None
+
+    def write(self, data):
+        if self.error is not None:
+            return
+        try:
+            self.channel.sendall(data)
+        except socket.error as e:
+            self.error = e
+            return
+        self.count += len(data)
+
+    def flush(self):
+        pass
+
+class ChannelReader(object):
+    """Read side of an exec channel as a file object
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.count = 0
+
+    def read(self, size=32768):
+        data = self.channel.recv(size)
+        self.count += len(data)
+        return data
+
+class TarStream(object):
+    """Move a tree of files as a single tar stream
+    include and exclude are lists of glob patterns matched against the
+    path relative to the top of the tree, '*' also matches '/'.
+    e.g.:
+    stream = TarStream(sshclient.get_transport(), compression='gz',
+                       exclude=['*.pyc', '.git/*'])
+    result = stream.put('harness', '/opt/harness')
+    result = stream.get('/var/log', 'logs')
+    """
+    compressions = (None, 'gz', 'zstd')
+
+    def __init__(self, transport, compression=None, include=None,
+                 exclude=None, level=6):
+        """compression is None, 'gz' or 'zstd'. zstd needs the zstandard
+        module here and the zstd command on the host.
+        """
+        if compression not in self.compressions:
+            raise TarStreamException('compression %r not one of %r' %
+                                     (compression, self.compressions))
+        if compression == 'zstd' and zstandard is None:
+            raise TarStreamException('zstd compression needs the zstandard '
+                                     'module')
+        self.transport = transport
+        self.compression = compression
+        self.include = include
+        self.exclude = exclude
+        self.level = level
+
+    def selected(self, name):
+        """True if a relative path passes the include and exclude globs
+        """
+        if self.include and not any([fnmatch.fnmatch(name, p)
+                                     for p in self.include]):
+            return False
+        if self.exclude and any([fnmatch.fnmatch(name, p)
+                                 for p in self.exclude]):
+            return False
+        return True
+
+    def find_command(self):
+        """find listing the selected files on the host, None for all
+        find -path matches like fnmatch, '*' also matches '/'
+        """
+        if not self.include and not self.exclude:
+            return None
+        command = ['find', '.', '!', '-type', 'd']
+        if self.include:
+            paths = []
+            for p in self.include:
+                paths.append('-path %s' % pipes.quote('./' + p))
+            command.append('\\( %s \\)' % ' -o '.join(paths))
+        for p in self.exclude or []:
+            command.append('! -path %s' % pipes.quote('./' + p))
+        return ' '.join(command)
+
+    def files(self, local_dir):
+        """Relative paths of the selected files below local_dir
+        """
+        names = []
+        for dirpath, dirnames, filenames in os.walk(local_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, local_dir).replace(os.sep, '/')
+                if self.selected(name):
+                    names.append(name)
+        return names
+
+    def exec_command(self, command):
+        logger.debug('exec_command: %s', command)
+        channel = self.transport.open_session()
+        channel.exec_command(command)
+        return channel
+
+    def finish(self, channel, result):
+        """Collect stderr and the exit status of the remote tar
+        """
+        error = []
+        while True:
+            data = channel.recv_stderr(32768)
+            if len(data) == 0:
+                break
+            error.append(data)
+        result.error = ''.join(error).splitlines(True)
+        result.rc = channel.recv_exit_status()
+        channel.close()
+        if result.rc != 0:
+            raise TarStreamException('remote tar returned %r: %s' %
+                                     (result.rc, ''.join(result.error)))
+
+    def put(self, local_dir, remote_dir):
+        """Copy the selected files below local_dir into remote_dir
+        Returns a TarResult
+        """
+        result = TarResult()
+        names = self.files(local_dir)
+        remote_dir = pipes.quote(remote_dir)
+        extract = 'tar xf - -C %s' % remote_dir
+        if self.compression == 'gz':
+            extract = 'tar xzf - -C %s' % remote_dir
+        elif self.compression == 'zstd':
+            extract = 'zstd -dc | tar xf - -C %s' % remote_dir
+        channel = self.exec_command('mkdir -p %s && %s' % (remote_dir, extract))
+        try:
+            writer = ChannelWriter(channel)
+            out = writer
+            if self.compression == 'gz':
+                out = gzip.GzipFile(fileobj=writer, mode='wb',
+                                    compresslevel=self.level)
+            elif self.compression == 'zstd':
+                out = zstandard.ZstdCompressor(
+                    level=self.level).stream_writer(writer)
+            tar = tarfile.open(fileobj=out, mode='w|')
+            for name in names:
+                info = tar.gettarinfo(os.path.join(local_dir, name), name)
+                if info.isreg():
+                    with open(os.path.join(local_dir, name), 'rb') as f:
+                        tar.addfile(info, f)
+                else:
+                    tar.addfile(info)
+                result.manifest.append(TarEntry(name, info.size, info.mode,
+                                                info.mtime,
+                                                info.linkname or None))
+            tar.close()
+            if out is not writer:
+                out.close()
+            result.wire_bytes = writer.count
+            if writer.error is None:
+                channel.shutdown_write()
+            self.finish(channel, result)
+            if writer.error is not None:
+                raise TarStreamException('put: %r' % writer.error)
+        finally:
+            channel.close()
+        logger.debug('put: %r', result)
+        return result
+
+    def get(self, remote_dir, local_dir):
+        """Copy the selected files below remote_dir into local_dir
+        The host's find selects the files, so excluded files do not cross
+        the wire. They are checked again here.
+        Returns a TarResult
+        """
+        result = TarResult()
+        files = '.'
+        find = self.find_command()
+        if find is not None:
+            files = '-T -'
+        create = 'tar cf - %s' % files
+        mode = 'r|'
+        if self.compression == 'gz':
+            create = 'tar czf - %s' % files
+            mode = 'r|gz'
+        elif self.compression == 'zstd':
+            create = 'tar cf - %s | zstd -c' % files
+        if find is not None:
+            create = '%s | %s' % (find, create)
+        channel = self.exec_command('cd %s && %s' % (pipes.quote(remote_dir),
+                                                     create))
+        try:
+            reader = ChannelReader(channel)
+            source = reader
+            if self.compression == 'zstd':
+                source = zstandard.ZstdDecompressor().stream_reader(reader)
+            tar = tarfile.open(fileobj=source, mode=mode)
+            for info in tar:
+                name = os.path.normpath(info.name).replace(os.sep, '/')
+                if info.isdir() or name == '.':
+                    continue
+                if name.startswith('../') or os.path.isabs(name):
+                    logger.error('get: skipping %s outside %s', info.name,
+                                 remote_dir)
+                    continue
+                if not self.selected(name):
+                    continue
+                if info.issym() or info.islnk():
+                    link = info.linkname
+                    if info.issym():
+                        link = os.path.join(os.path.dirname(name), link)
+                    if (os.path.isabs(info.linkname) or
+                        os.path.normpath(link).startswith('..')):
+                        logger.error('get: skipping link %s -> %s', name,
+                                     info.linkname)
+                        continue
+                info.name = name
+                tar.extract(info, local_dir)
+                result.manifest.append(TarEntry(name, info.size, info.mode,
+                                                info.mtime,
+                                                info.linkname or None))
+            tar.close()
+            # Drain whatever tar did not read, e.g. the end of archive padding
+            while len(reader.read()):
+                pass
+            result.wire_bytes = reader.count
+            self.finish(channel, result)
+        finally:
+            channel.close()
+        logger.debug('get: %r', result)
+        return result
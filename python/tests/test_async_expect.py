@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# AsyncSSHExpect sessions against a LocalSSHServer driven from one loop
+#
+# mdeacon@zorillaeng.com
+#
+
+import unittest
+
+import paramiko
+from zorilla.async_expect import ExpectLoop, AsyncSSHExpect, Return
+from zorilla.local_server import LocalSSHServer
+
+class AsyncSSHExpectTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalSSHServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.loop = ExpectLoop()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.loop.close()
+
+    def session(self):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect('127.0.0.1', port=self.server.port, username='root',
+                       password='', look_for_keys=False, allow_agent=False)
+        self.clients.append(client)
+        sexp = AsyncSSHExpect(self.loop, '127.0.0.1', 'root', '')
+        sexp.attach(client.invoke_shell())
+        return sexp
+
+    def test_sessions(self):
+        def board(sexp, n):
+            i, output = yield sexp.send_recv('echo board=$((%u * 2))\n' % n,
+                                             ['board=%u\n' % (n * 2)])
+            raise Return(i)
+
+        tasks = [self.loop.spawn(board(self.session(), n)) for n in range(5)]
+        self.loop.run_until_complete(tasks, timeout=20)
+        self.assertEqual([t.result() for t in tasks], [0] * 5)
+
+    def test_send_past_window(self):
+        size = 8 * 1024 * 1024
+        sexp = self.session()
+
+        def bulk():
+            # Far more than the channel window, the loop must not block
+            sexp.send('sleep 1; head -c %u > /dev/null; echo done\n' % size)
+            sent = yield sexp.send('x' * size)
+            i, output = yield sexp.expect(['done\n'], timeout=30)
+            raise Return(sent)
+
+        task = self.loop.spawn(bulk())
+        self.loop.run_until_complete(task, timeout=60)
+        self.assertEqual(task.result(), size)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# SSHBroker against a LocalSSHServer: hosts share its connection
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from zorilla import broker
+from zorilla.broker import SSHBroker, SharedConnection, BrokerException
+from zorilla.host import Host
+from zorilla.local_server import LocalSSHServer
+
+class BrokerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalSSHServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'broker.sock')
+        self.broker = SSHBroker(self.path).start()
+        os.environ['ZORILLA_BROKER'] = self.path
+
+    def tearDown(self):
+        os.environ['ZORILLA_BROKER'] = 'off'
+        self.broker.stop()
+        shutil.rmtree(self.dir)
+
+    def host(self):
+        host = Host('127.0.0.1', port=self.server.port, use_pool=False)
+        host.connect_retries = 0
+        return host
+
+    def test_shared_connection(self):
+        connections = self.server.connections
+        for i in range(3):
+            self.assertEqual(self.host().sshcmd('echo %u; exit 2' % i),
+                             (2, ['%u\n' % i], []))
+        self.assertEqual(self.server.connections, connections + 1)
+        status = self.broker.status()
+        self.assertEqual([(c['handshakes'], c['channels']) for c in status],
+                         [(1, 3)])
+
+    def test_session_through_broker(self):
+        host = self.host()
+        host.persistent = True
+        self.assertEqual(host.sshcmd('echo one'), (0, ['one\n'], []))
+        self.assertEqual(host.sshcmd('echo two; false'), (1, ['two\n'], []))
+        host.close_session()
+
+    def test_failed_open_keeps_connection(self):
+        self.assertEqual(self.host().sshcmd('echo up'), (0, ['up\n'], []))
+        client = broker.connect('127.0.0.1', self.server.port,
+                                password='', path=self.path)
+        channel = client.get_transport().open_session()
+        self.assertRaises(BrokerException, channel.invoke_subsystem,
+                          'nosuch')
+        self.assertEqual(self.host().sshcmd('echo still'),
+                         (0, ['still\n'], []))
+        # Handlers free their channel just after the client is done
+        end = time.time() + 5
+        while self.broker.status()[0]['open'] and time.time() < end:
+            time.sleep(0.05)
+        status = self.broker.status()
+        self.assertEqual([(c['handshakes'], c['open']) for c in status],
+                         [(1, 0)])
+
+    def test_channels_capped(self):
+        max_channels = SharedConnection.max_channels
+        SharedConnection.max_channels = 1
+        try:
+            results = []
+            def run(i):
+                results.append(self.host().sshcmd('sleep 0.5; echo %u' % i))
+            threads = [threading.Thread(target=run, args=(i,))
+                       for i in range(2)]
+            start = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertTrue(time.time() - start >= 1.0)
+        finally:
+            SharedConnection.max_channels = max_channels
+        self.assertEqual(sorted(results), [(0, ['0\n'], []),
+                                           (0, ['1\n'], [])])
+
+    def test_no_broker(self):
+        self.assertTrue(broker.connect('127.0.0.1', self.server.port,
+                                       path=self.path + '.missing') is None)
+        os.environ['ZORILLA_BROKER'] = 'off'
+        self.assertTrue(broker.connect('127.0.0.1', self.server.port) is None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+#
+# MultiCapture job scheduling
+#
+# mdeacon@zorillaeng.com
+#
+
+import time
+import unittest
+
+from zorilla.gdbtrace import MultiCapture
+
+class ParallelTest(unittest.TestCase):
+    def test_no_jobs_started_after_deadline(self):
+        multi = MultiCapture(['127.0.0.1'], ['/bin/sleep'], workers=2)
+        started = []
+
+        def job(n):
+            started.append(n)
+            time.sleep(0.3)
+            return n
+
+        done = multi.parallel(range(20), job, time.time() + 0.5)
+        self.assertEqual(sorted(done.keys()), [0, 1])
+        count = len(started)
+        self.assertTrue(count <= 4)
+        time.sleep(1)
+        self.assertEqual(len(started), count)
+
+if __name__ == '__main__':
+    unittest.main()
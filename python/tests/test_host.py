@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+# Host against a LocalSSHServer
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import time
+import unittest
+
+# Tests must not share the connections of a broker the user is running
+os.environ['ZORILLA_BROKER'] = 'off'
+
+import paramiko
+from zorilla.host import Host
+from zorilla.ssh_pool import SSHConnectionPool
+from zorilla.local_server import LocalSSHServer
+from zorilla.output_capture import OutputCapture
+from zorilla.result_cache import ResultCache
+from zorilla.shell_session import ShellSessionException
+
+class HostTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalSSHServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.pool = SSHConnectionPool()
+        self.host = Host('127.0.0.1', 'root', '', pool=self.pool,
+                         port=self.server.port)
+
+    def tearDown(self):
+        self.host.close_session()
+        self.pool.close_all()
+
+    def test_sshcmd_exit_status(self):
+        rc, output, error = self.host.sshcmd('echo out; echo err >&2; exit 3')
+        self.assertEqual(rc, 3)
+        self.assertEqual(output, ['out\n'])
+        self.assertEqual(error, ['err\n'])
+
+    def test_failed_open_discards_connection(self):
+        self.host.sshcmd('true')
+        connections = self.server.connections
+        client = self.host.ssh_connect()
+        self.host.ssh_close(client)
+
+        def refused(*args, **kwargs):
+            raise paramiko.SSHException('open_session refused')
+
+        client.get_transport().open_session = refused
+        self.assertRaises(paramiko.SSHException, self.host.sshcmd, 'true')
+        self.assertEqual(self.host.sshcmd('echo new')[1], ['new\n'])
+        self.assertEqual(self.server.connections, connections + 1)
+
+    def test_command_exit_status(self):
+        rc, output = self.host.command('echo one; echo two; exit 4',
+                                       echo=False)
+        self.assertEqual(rc, 4)
+        self.assertEqual(output, ['one\n', 'two\n'])
+        self.assertEqual(self.host.command('true', echo=False)[0], 0)
+
+    def test_stream_rc(self):
+        stream = self.host.stream('printf abc; exit 5')
+        data = ''.join([d for name, d in stream if name == 'stdout'])
+        self.assertEqual(data, 'abc')
+        self.assertEqual(stream.rc, 5)
+
+    def test_capture_is_bounded(self):
+        capture = OutputCapture(head=100, tail=100, spool=False)
+        rc, output, error = self.host.sshcmd('seq 1 200000', capture=capture)
+        self.assertEqual(rc, 0)
+        self.assertTrue(output is capture)
+        self.assertTrue(capture.truncated)
+        self.assertEqual(len(capture.head) + len(capture.tail), 200)
+        self.assertEqual(capture.lines()[-1], '200000\n')
+
+    def test_pool_reuses_connection(self):
+        connections = self.server.connections
+        for i in range(5):
+            self.assertEqual(self.host.sshcmd('echo %u' % i)[1],
+                             ['%u\n' % i])
+        self.assertEqual(self.server.connections, connections + 1)
+        self.assertEqual(self.pool.stats()['hits'], 4)
+
+    def test_session_framing(self):
+        self.host.persistent = True
+        self.assertEqual(self.host.sshcmd('printf partial; echo e >&2; false'),
+                         (1, ['partial'], ['e\n']))
+        results = self.host.session_batch(['echo 1', 'echo 2 >&2', 'exit 7'])
+        self.assertEqual(results, [(0, ['1\n'], []), (0, [], ['2\n']),
+                                   (7, [], [])])
+        # The shell exited, the next command starts another
+        self.assertEqual(self.host.sshcmd('echo again'),
+                         (0, ['again\n'], []))
+
+    def test_session_capture(self):
+        self.host.persistent = True
+        capture = OutputCapture(head=64, tail=64, spool=False)
+        rc, output, error = self.host.sshcmd('seq 1 100000', capture=capture)
+        self.assertEqual(rc, 0)
+        self.assertTrue(capture.truncated)
+        self.assertEqual(capture.lines()[-1], '100000\n')
+
+    def test_session_no_timeout(self):
+        self.host.persistent = True
+        self.assertTrue(self.host.open_session().timeout is None)
+        self.assertEqual(self.host.sshcmd('sleep 1.5; echo slept'),
+                         (0, ['slept\n'], []))
+
+    def test_session_timeout_recovery(self):
+        self.host.persistent = True
+        self.host.session_timeout = 1
+        start = time.time()
+        self.assertRaises(ShellSessionException, self.host.sshcmd, 'sleep 30')
+        self.assertTrue(time.time() - start < 5)
+        self.assertTrue(self.host.session is None)
+        self.assertEqual(self.host.sshcmd('echo fresh'), (0, ['fresh\n'], []))
+
+class CachedSSHCmdTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalSSHServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.pool = SSHConnectionPool()
+        self.cache = ResultCache()
+        self.boot = ['boot-1']
+
+    def tearDown(self):
+        self.pool.close_all()
+
+    def host(self, username='root'):
+        host = Host('127.0.0.1', username, '', pool=self.pool,
+                    port=self.server.port)
+        host.result_cache = self.cache
+        host.boot_id = lambda: self.boot[0]
+        return host
+
+    def test_hit(self):
+        host = self.host()
+        first = host.cached_sshcmd('date +%N')
+        self.assertEqual(host.cached_sshcmd('date +%N'), first)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_failures_are_not_cached(self):
+        host = self.host()
+        host.cached_sshcmd('false')
+        host.cached_sshcmd('false')
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_username_in_key(self):
+        first = self.host('root').cached_sshcmd('date +%N')
+        self.assertNotEqual(self.host('other').cached_sshcmd('date +%N'),
+                            first)
+
+    def test_reboot_between_runs(self):
+        first = self.host().cached_sshcmd('date +%N')
+        self.assertEqual(self.host().cached_sshcmd('date +%N'), first)
+        self.boot[0] = 'boot-2'
+        self.assertNotEqual(self.host().cached_sshcmd('date +%N'), first)
+
+    def test_unknown_boot_id(self):
+        first = self.host().cached_sshcmd('date +%N')
+        self.boot[0] = None
+        self.assertNotEqual(self.host().cached_sshcmd('date +%N'), first)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# HostGroup and ProcessHostGroup against a LocalSSHServer
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import time
+import socket
+import threading
+import unittest
+
+os.environ['ZORILLA_BROKER'] = 'off'
+
+from zorilla.host import Host
+from zorilla.host_group import HostGroup, HostGroupException, quiet_progress
+from zorilla.process_group import ProcessHostGroup, ProcessGroupException
+from zorilla.ssh_pool import SSHConnectionPool
+from zorilla.local_server import LocalSSHServer
+
+def closed_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def hostgroup_threads():
+    return [t for t in threading.enumerate()
+            if t.name.startswith('hostgroup-')]
+
+class HostGroupTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalSSHServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.pool = SSHConnectionPool()
+
+    def tearDown(self):
+        self.pool.close_all()
+
+    def hosts(self, n, **kwargs):
+        return [Host('127.0.0.1', pool=self.pool, port=self.server.port,
+                     **kwargs) for i in range(n)]
+
+    def test_sshcmd(self):
+        results = HostGroup(self.hosts(4), workers=2).sshcmd('echo hi; exit 2')
+        self.assertEqual([r.rc for r in results], [2] * 4)
+        self.assertEqual([r.output for r in results], [['hi\n']] * 4)
+        self.assertFalse(results.ok)
+
+    def test_command_fail_fast(self):
+        group = HostGroup(self.hosts(3), workers=1, fail_fast=True)
+        results = group.command('exit 2')
+        self.assertTrue(results.aborted)
+        self.assertEqual([r.rc for r in results.failed()], [2])
+        self.assertEqual(len(results.skipped()), 2)
+
+    def test_timeout(self):
+        hosts = (self.hosts(1) + self.hosts(1, persistent=True, use_pool=False)
+                 + [Host('127.0.0.1', pool=self.pool, port=closed_port())])
+        group = HostGroup(hosts, workers=3, timeout=1, connect_sleep=10)
+        start = time.time()
+        results = group.sshcmd('sleep 20')
+        self.assertTrue(time.time() - start < 4)
+        self.assertEqual([r.timed_out for r in results], [True] * 3)
+        time.sleep(0.5)
+        self.assertEqual(hostgroup_threads(), [])
+        hosts[1].close_session()
+        # The hosts are usable after being cancelled
+        results = HostGroup(hosts[:2], timeout=10).sshcmd('echo back')
+        self.assertEqual([r.output for r in results], [['back\n']] * 2)
+    def test_uncancellable_call_is_abandoned(self):
+        release = threading.Event()
+
+        def stuck(host):
+            # Ignores the cancel, like a read with no timeout
+            release.wait(20)
+            return 0, [], []
+
+        hosts = self.hosts(2)
+        group = HostGroup(hosts, workers=2, timeout=0.5)
+        group.cancel_grace = 0.2
+        try:
+            start = time.time()
+            results = group.run(stuck)
+            self.assertTrue(time.time() - start < 2)
+            self.assertEqual([r.timed_out for r in results], [True] * 2)
+            self.assertEqual(len(group.abandoned), 2)
+            # Not run again while the abandoned calls are still going
+            results = group.sshcmd('true')
+            self.assertEqual([type(r.exception) for r in results],
+                             [HostGroupException] * 2)
+        finally:
+            release.set()
+        time.sleep(0.3)
+        self.assertEqual([r.rc for r in group.sshcmd('true')], [0] * 2)
+        self.assertEqual(group.abandoned, {})
+
+    def test_given_hosts_unchanged(self):
+        host = self.hosts(1)[0]
+        host.connect_timeout = 30
+        progress_cb = host.progress_cb
+        group = HostGroup([host, '127.0.0.1'], timeout=5)
+        self.assertEqual(host.connect_timeout, 30)
+        self.assertEqual(host.progress_cb, progress_cb)
+        self.assertEqual(group.hosts[1].connect_timeout, 5)
+        self.assertEqual(group.hosts[1].progress_cb, quiet_progress)
+
+class ProcessHostGroupTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalSSHServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        hosts = [Host('127.0.0.1', port=self.server.port) for i in range(3)]
+        self.group = ProcessHostGroup(hosts, processes=2, workers=2)
+
+    def tearDown(self):
+        self.group.close()
+
+    def test_exit_status(self):
+        results = self.group.sshcmd('echo $((1 + 1)); exit 3')
+        self.assertEqual([(r.rc, r.output) for r in results],
+                         [(3, ['2\n'])] * 3)
+        results = self.group.command('exit 4')
+        self.assertEqual([r.rc for r in results], [4] * 3)
+
+    def test_lambda_refused(self):
+        self.assertRaises(ProcessGroupException, self.group.run,
+                          lambda host: host.sshcmd('true'))
+
+if __name__ == '__main__':
+    unittest.main()
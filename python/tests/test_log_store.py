@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# LogStore: append and query, reopening, sharing between stores and the
+# timed flush
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+from zorilla.log_store import LogStore
+
+def write_sessions(path):
+    """Sessions written by another process, returning their ids
+    """
+    store = LogStore(path, segment_bytes=20000, block_bytes=4096)
+    ids = []
+    for i in range(50):
+        session = store.session('h%u' % os.getpid(), 'command', 'c%u' % i)
+        session.write(os.urandom(300).encode('hex') + '\n')
+        ids.append(session.id)
+    store.close()
+    return ids
+
+class LogStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_query(self):
+        store = LogStore(self.dir, block_bytes=256)
+        console = store.session('board1', 'serial', '/dev/ttyUSB0')
+        command = store.session('board2', 'command', 'uname')
+        console.write('login: ')
+        command.write('Linux\n')
+        console.write('root\r\nPassword: ')
+        self.assertEqual(''.join([r.data for r in
+                                  store.query(host='board1')]),
+                         'login: root\r\nPassword: ')
+        self.assertEqual([r.data for r in store.query(kind='command')],
+                         ['Linux\n'])
+        self.assertEqual([line for when, session, line in
+                          store.lines(session=console.id)],
+                         ['login: root', 'Password: '])
+        self.assertEqual(store.query(start=time.time() + 60), [])
+        store.close()
+
+    def test_reopen(self):
+        store = LogStore(self.dir, block_bytes=1024)
+        session = store.session('board1', 'serial')
+        for i in range(100):
+            session.write('line %u\n' % i)
+        store.close()
+        store = LogStore(self.dir)
+        records = store.query(host='board1')
+        self.assertEqual(''.join([r.data for r in records]),
+                         ''.join(['line %u\n' % i for i in range(100)]))
+        self.assertEqual(records[0].session.kind, 'serial')
+        self.assertTrue(store.session('board1', 'serial').id > session.id)
+        store.close()
+
+    def test_processes(self):
+        pool = multiprocessing.Pool(3)
+        try:
+            ids = sum(pool.map(write_sessions, [self.dir] * 3), [])
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(len(set(ids)), 150)
+        store = LogStore(self.dir)
+        self.assertEqual(len(store.query(kind='command')), 150)
+        store.close()
+
+    def test_flush_interval(self):
+        store = LogStore(self.dir, flush_interval=0.2)
+        store.session('board1', 'serial').write('last words\n')
+        time.sleep(1)
+        # Another store sees the output without a close or a full block
+        reader = LogStore(self.dir)
+        self.assertEqual([r.data for r in reader.query(host='board1')],
+                         ['last words\n'])
+        reader.close()
+        store.close()
+
+    def test_retain(self):
+        store = LogStore(self.dir, max_bytes=30000, segment_bytes=10000,
+                         block_bytes=1024, level=0)
+        session = store.session('board1', 'serial')
+        for i in range(100):
+            session.write(os.urandom(500).encode('hex'))
+        store.flush()
+        self.assertTrue(store.size() <= 30000 + 10000)
+        store.close()
+
+if __name__ == '__main__':
+    unittest.main()
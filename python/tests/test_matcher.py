@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+#
+# Incremental pattern matching of the expect receive loops
+#
+# mdeacon@zorillaeng.com
+#
+
+import re
+import unittest
+
+from zorilla.matcher import ExpectMatcher, PatternSet
+
+class MatcherTest(unittest.TestCase):
+    def test_split_across_feeds(self):
+        matcher = ExpectMatcher(['login:', '~]$'])
+        self.assertEqual(matcher.feed('boot\r\nlog'), -1)
+        self.assertEqual(matcher.feed('in: '), 0)
+        self.assertEqual(matcher.output, 'boot\r\nlogin: ')
+        self.assertEqual(matcher.match.span(), (6, 12))
+
+    def test_lowest_index_wins(self):
+        matcher = ExpectMatcher(['b', 'a'])
+        self.assertEqual(matcher.feed('ab'), 0)
+
+    def test_max_buffer(self):
+        matcher = ExpectMatcher(['end'], max_buffer=100)
+        for i in range(100):
+            self.assertEqual(matcher.feed('x' * 100), -1)
+        self.assertEqual(matcher.feed('end'), 0)
+        self.assertTrue(len(matcher.output) <= 103)
+
+    def test_pattern_set(self):
+        prompt = PatternSet([re.compile(r'\[(\w+)@\S+ ~\]\$ $'), 'login:'])
+        matcher = prompt.matcher()
+        self.assertEqual(matcher.feed('output\r\n[ro'), -1)
+        self.assertEqual(matcher.feed('ot@localhost ~]$ '), 0)
+        self.assertEqual(matcher.match.group(1), 'root')
+
+if __name__ == '__main__':
+    unittest.main()
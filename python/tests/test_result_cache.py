@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# ResultCache: TTL, LRU eviction, boot ids and saving
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from zorilla.result_cache import ResultCache
+
+RESULT = (0, ['Linux\n'], [])
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get_put(self):
+        cache = ResultCache()
+        self.assertTrue(cache.get('h', 22, 'root', 'uname') is None)
+        cache.put('h', 22, 'root', 'uname', RESULT)
+        self.assertEqual(cache.get('h', 22, 'root', 'uname'), RESULT)
+        self.assertTrue(cache.get('h', 22, 'user', 'uname') is None)
+        self.assertTrue(cache.get('h', 2222, 'root', 'uname') is None)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_ttl(self):
+        cache = ResultCache(ttl=0.2)
+        cache.put('h', 22, 'root', 'uname', RESULT)
+        cache.put('h', 22, 'root', 'hostname', RESULT, ttl=60)
+        time.sleep(0.3)
+        self.assertTrue(cache.get('h', 22, 'root', 'uname') is None)
+        self.assertEqual(cache.get('h', 22, 'root', 'hostname'), RESULT)
+        self.assertEqual(cache.expired, 1)
+
+    def test_lru(self):
+        cache = ResultCache(max_entries=2)
+        cache.put('h', 22, 'root', 'a', RESULT)
+        cache.put('h', 22, 'root', 'b', RESULT)
+        cache.get('h', 22, 'root', 'a')
+        cache.put('h', 22, 'root', 'c', RESULT)
+        self.assertTrue(cache.get('h', 22, 'root', 'b') is None)
+        self.assertEqual(cache.get('h', 22, 'root', 'a'), RESULT)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_check_boot(self):
+        cache = ResultCache()
+        cache.check_boot('h', 22, 'boot-1')
+        cache.put('h', 22, 'root', 'uname', RESULT)
+        cache.put('g', 22, 'root', 'uname', RESULT)
+        cache.check_boot('h', 22, 'boot-1')
+        self.assertEqual(cache.get('h', 22, 'root', 'uname'), RESULT)
+        cache.check_boot('h', 22, 'boot-2')
+        self.assertTrue(cache.get('h', 22, 'root', 'uname') is None)
+        self.assertEqual(cache.get('g', 22, 'root', 'uname'), RESULT)
+        cache.put('h', 22, 'root', 'uname', RESULT)
+        cache.check_boot('h', 22, None)
+        self.assertTrue(cache.get('h', 22, 'root', 'uname') is None)
+
+    def test_save_load(self):
+        pathname = os.path.join(self.dir, 'cache', 'results.pickle')
+        cache = ResultCache(pathname)
+        cache.check_boot('h', 22, 'boot-1')
+        cache.put('h', 22, 'root', 'uname', RESULT)
+        cache.put('h', 22, 'root', 'date', RESULT, ttl=0)
+        cache.save()
+        cache = ResultCache(pathname)
+        self.assertEqual(cache.stats()['entries'], 1)
+        # Still valid in the next run while the host has not booted
+        cache.check_boot('h', 22, 'boot-1')
+        self.assertEqual(cache.get('h', 22, 'root', 'uname'), RESULT)
+        cache.check_boot('h', 22, 'boot-2')
+        self.assertTrue(cache.get('h', 22, 'root', 'uname') is None)
+
+    def test_invalidate(self):
+        cache = ResultCache()
+        cache.put('h', 22, 'root', 'uname', RESULT)
+        cache.put('h', 2222, 'root', 'uname', RESULT)
+        cache.invalidate('h', 22)
+        self.assertTrue(cache.get('h', 22, 'root', 'uname') is None)
+        self.assertEqual(cache.get('h', 2222, 'root', 'uname'), RESULT)
+        cache.invalidate('h')
+        self.assertEqual(cache.stats()['entries'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
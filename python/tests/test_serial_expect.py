@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# SerialExpect against a FakeSerialDevice, recorded and replayed
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import re
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import serial
+
+from zorilla.fake_serial import FakeSerialDevice
+from zorilla.serial_expect import SerialExpect, SerialExpectTimeout
+from zorilla.deadline import CancelToken, CANCELLED, DEADLINE
+
+PROMPT = '~]$ '
+
+class SerialExpectTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.device = FakeSerialDevice().start()
+
+    def tearDown(self):
+        self.device.stop()
+        shutil.rmtree(self.dir)
+
+    def test_send_recv(self):
+        sexp = SerialExpect(self.device.device)
+        i, output = sexp.send_recv('out 10000\n', ['login:', PROMPT])
+        self.assertEqual(i, 1)
+        self.assertEqual(len(output), 10000 + len(self.device.prompt))
+        self.assertEqual(sexp.send_recv('echo more\n', ['more\r\n'])[0], 0)
+        sexp.close()
+
+    def test_port_timeout_left_alone(self):
+        sets = []
+        class CountingSerial(serial.Serial):
+            @serial.Serial.timeout.setter
+            def timeout(self, timeout):
+                sets.append(timeout)
+                serial.Serial.timeout.fset(self, timeout)
+        port = CountingSerial(self.device.device, timeout=5)
+        del sets[:]
+        sexp = SerialExpect(port)
+        sexp.send_recv('out 100000\n', [PROMPT])
+        self.assertEqual(sets, [])
+        self.assertEqual(port.timeout, 5)
+        sexp.close()
+
+    def test_regex(self):
+        sexp = SerialExpect(self.device.device)
+        sexp.send_recv('echo answer=42\n',
+                       [re.compile(r'answer=(\d+)\r\n')])
+        self.assertEqual(sexp.match.group(1), '42')
+        sexp.close()
+
+    def test_timeout(self):
+        sexp = SerialExpect(self.device.device)
+        try:
+            sexp.send_recv('echo partial\n', ['never'], timeout=0.5)
+            self.fail('no timeout')
+        except SerialExpectTimeout as e:
+            self.assertEqual(e.reason, DEADLINE)
+            self.assertTrue(e.output.startswith('partial'))
+        # The port is still usable
+        self.assertEqual(sexp.send_recv('echo more\n', ['more'])[0], 0)
+        sexp.close()
+
+    def test_cancel(self):
+        sexp = SerialExpect(self.device.device)
+        token = CancelToken()
+        threading.Timer(0.3, token.cancel).start()
+        start = time.time()
+        try:
+            sexp.send_recv('\n', ['never'], timeout=5, cancel=token)
+            self.fail('not cancelled')
+        except SerialExpectTimeout as e:
+            self.assertEqual(e.reason, CANCELLED)
+        self.assertTrue(time.time() - start < 2)
+        sexp.close()
+
+    def test_record_replay(self):
+        pathname = os.path.join(self.dir, 'console.ztr')
+        sexp = SerialExpect(self.device.device, record=pathname)
+        recorded = sexp.send_recv('echo recorded\n', [PROMPT])
+        sexp.close()
+        replay = SerialExpect.replay(pathname)
+        self.assertEqual(replay.send_recv('echo recorded\n', [PROMPT]),
+                         recorded)
+        replay.close()
+
+if __name__ == '__main__':
+    unittest.main()
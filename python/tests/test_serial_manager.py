@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+# SerialManager against FakeSerialDevices, polled and with reader threads
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from zorilla.fake_serial import FakeSerialDevice
+from zorilla.serial_manager import SerialManager, SerialManagerException, POLL
+
+PROMPT = '~]$ '
+
+class SerialManagerTest(unittest.TestCase):
+    poll = POLL
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.devices = [FakeSerialDevice().start() for i in range(3)]
+        self.manager = SerialManager(ring_size=4096, log_dir=self.dir,
+                                     flush_interval=0.1, poll=self.poll)
+        for i, device in enumerate(self.devices):
+            self.manager.add('b%u' % i, device.device)
+        self.manager.start()
+
+    def tearDown(self):
+        self.manager.stop()
+        for device in self.devices:
+            device.stop()
+        shutil.rmtree(self.dir)
+
+    def test_attach(self):
+        for n in range(3):
+            client = self.manager.attach('b%u' % n)
+            i, output = client.send_recv('echo board %u\n' % n, [PROMPT])
+            self.assertEqual(output, 'board %u\r\n%s' %
+                             (n, self.devices[n].prompt))
+
+    def test_output_before_attach(self):
+        self.manager.port('b1').write('echo early\n')
+        time.sleep(0.3)
+        client = self.manager.attach('b1', from_start=True)
+        self.assertEqual(client.recv(['early'])[0], 0)
+        self.assertTrue('early' in self.manager.output('b1'))
+
+    def test_ring_and_log(self):
+        client = self.manager.attach('b0')
+        client.send_recv('out 20000\n', [PROMPT])
+        self.assertEqual(len(self.manager.output('b0')), 4096)
+        time.sleep(0.3)
+        self.assertTrue(os.path.getsize(os.path.join(self.dir, 'b0.log'))
+                        >= 20000)
+
+    def test_lost(self):
+        client = self.manager.attach('b2')
+        self.manager.attach('b2').send_recv('out 20000\n', [PROMPT])
+        client.recv([PROMPT])
+        self.assertTrue(client.lost > 0)
+
+    def test_remove_waits_for_io_thread(self):
+        if not self.poll:
+            # The port's close joins its reader thread
+            return
+        port = self.manager.port('b1')
+        busy = threading.Event()
+        open_after = []
+        service = port.service
+        def slow_service():
+            busy.set()
+            time.sleep(0.3)
+            open_after.append(port.s.isOpen())
+            return service()
+        port.service = slow_service
+        port.write('echo slow\n')
+        self.assertTrue(busy.wait(5))
+        self.manager.remove('b1')
+        self.assertEqual(open_after, [True])
+        self.assertTrue(port.error is None)
+
+    def test_duplicate(self):
+        self.assertRaises(SerialManagerException, self.manager.add, 'b0',
+                          self.devices[0].device)
+
+class ThreadSerialManagerTest(SerialManagerTest):
+    """Each port read on its own thread, as where select.poll is missing
+    """
+    poll = False
+
+if __name__ == '__main__':
+    unittest.main()
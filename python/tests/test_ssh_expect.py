@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# SSHExpect against a LocalSSHServer, recorded and replayed
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import re
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+os.environ['ZORILLA_BROKER'] = 'off'
+
+import paramiko
+from zorilla.matcher import PatternSet
+from zorilla.deadline import CancelToken, CANCELLED, DEADLINE, INACTIVITY
+from zorilla.ssh_expect import SSHExpect, SSHExpectTimeout
+from zorilla.local_server import LocalSSHServer
+
+class SSHExpectTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalSSHServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.client = paramiko.SSHClient()
+        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.client.connect('127.0.0.1', port=self.server.port,
+                            username='root', password='', look_for_keys=False,
+                            allow_agent=False)
+
+    def tearDown(self):
+        self.client.close()
+        shutil.rmtree(self.dir)
+
+    def expect(self, **kwargs):
+        return SSHExpect('127.0.0.1', 'root', '',
+                         channel=self.client.invoke_shell(), **kwargs)
+
+    def test_send_recv(self):
+        sexp = self.expect()
+        i, output = sexp.send_recv('echo $((6 * 7))\n', ['x', '42\n'])
+        self.assertEqual(i, 1)
+        answer = PatternSet([re.compile(r'answer=(\d+)'), 'error'])
+        i, output = sexp.send_recv('echo answer=$((6 * 7))\n', answer)
+        self.assertEqual((i, sexp.match.group(1)), (0, '42'))
+
+    def test_timeout(self):
+        sexp = self.expect()
+        try:
+            sexp.send_recv('sleep 5\n', ['never'], timeout=0.5)
+            self.fail('no timeout')
+        except SSHExpectTimeout as e:
+            self.assertEqual(e.reason, DEADLINE)
+
+    def test_output_does_not_extend_timeout(self):
+        sexp = self.expect()
+        try:
+            sexp.send_recv('while true; do echo tick; sleep 0.1; done\n',
+                           ['never'], timeout=1.5, inactivity=1)
+            self.fail('no timeout')
+        except SSHExpectTimeout as e:
+            self.assertEqual(e.reason, DEADLINE)
+            self.assertTrue('tick' in e.output)
+
+    def test_inactivity_expires(self):
+        sexp = self.expect()
+        try:
+            sexp.send_recv('sleep 5\n', ['never'], timeout=5, inactivity=0.5)
+            self.fail('no timeout')
+        except SSHExpectTimeout as e:
+            self.assertEqual(e.reason, INACTIVITY)
+
+    def test_cancel(self):
+        sexp = self.expect()
+        token = CancelToken()
+        threading.Timer(0.3, token.cancel).start()
+        start = time.time()
+        try:
+            sexp.send_recv('sleep 5\n', ['never'], timeout=5, cancel=token)
+            self.fail('not cancelled')
+        except SSHExpectTimeout as e:
+            self.assertEqual(e.reason, CANCELLED)
+        self.assertTrue(time.time() - start < 2)
+
+    def test_record_replay(self):
+        pathname = os.path.join(self.dir, 'session.ztr')
+        sexp = self.expect(record=pathname)
+        i, output = sexp.send_recv('echo recorded\n', ['recorded\n'])
+        sexp.channel.close()
+        replay = SSHExpect.replay(pathname)
+        self.assertEqual(replay.send_recv('echo recorded\n',
+                                          ['recorded\n']), (i, output))
+
+if __name__ == '__main__':
+    unittest.main()
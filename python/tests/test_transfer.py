@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+# File and tree transfers against a LocalSSHServer
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+os.environ['ZORILLA_BROKER'] = 'off'
+
+from zorilla.host import Host
+from zorilla.ssh_pool import SSHConnectionPool
+from zorilla.local_server import LocalSSHServer
+
+def md5(pathname):
+    with open(pathname, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+def write(pathname, data):
+    directory = os.path.dirname(pathname)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(pathname, 'wb') as f:
+        f.write(data)
+
+def tree(top):
+    """{relative path: md5} of the files under top
+    """
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(top):
+        for name in filenames:
+            pathname = os.path.join(dirpath, name)
+            files[os.path.relpath(pathname, top)] = md5(pathname)
+    return files
+
+class TransferTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalSSHServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.pool = SSHConnectionPool()
+        self.host = Host('127.0.0.1', 'root', '', pool=self.pool,
+                         port=self.server.port)
+        self.host.progress_cb = lambda *args, **kwargs: None
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, 'src')
+        self.dst = os.path.join(self.dir, 'dst')
+        os.makedirs(self.dst)
+
+    def tearDown(self):
+        self.pool.close_all()
+        shutil.rmtree(self.dir)
+
+    def test_scp_round_trip(self):
+        pathname = os.path.join(self.src, 'file.bin')
+        write(pathname, os.urandom(300000))
+        self.host.scpfileto(pathname, self.dst)
+        back = os.path.join(self.dir, 'back')
+        os.makedirs(back)
+        copy = self.host.scpfile(os.path.join(self.dst, 'file.bin'), back)
+        self.assertEqual(copy, os.path.join(back, 'file.bin'))
+        self.assertEqual(md5(copy), md5(pathname))
+
+    def test_chunked_round_trip(self):
+        self.host.transfer_chunk_size = 256 * 1024
+        pathname = os.path.join(self.src, 'big.bin')
+        write(pathname, os.urandom(5 * 256 * 1024 + 123))
+        remote = self.host.sftpfileto(pathname, self.dst)
+        self.assertEqual(md5(remote), md5(pathname))
+        back = os.path.join(self.dir, 'back')
+        os.makedirs(back)
+        copy = self.host.scpfile(remote, back, chunked=True)
+        self.assertEqual(md5(copy), md5(pathname))
+
+    def test_sync(self):
+        write(os.path.join(self.src, 'a'), os.urandom(200000))
+        write(os.path.join(self.src, 'sub', 'b'), 'b' * 1000)
+        write(os.path.join(self.src, 'c'), 'c')
+        stats = self.host.sync(self.src, self.dst)
+        self.assertEqual(stats.created, 3)
+        self.assertEqual(tree(self.dst), tree(self.src))
+
+        stats = self.host.sync(self.src, self.dst)
+        self.assertEqual((stats.unchanged, stats.bytes_sent), (3, 0))
+
+        # A small change to a large file sends about one block. Files of the
+        # same size and mtime are taken as unchanged, so move the mtime on
+        # as an edit a second later would.
+        pathname = os.path.join(self.src, 'a')
+        with open(pathname, 'r+b') as f:
+            f.seek(100000)
+            f.write('changed')
+        mtime = os.stat(pathname).st_mtime + 2
+        os.utime(pathname, (mtime, mtime))
+        os.remove(os.path.join(self.src, 'c'))
+        stats = self.host.sync(self.src, self.dst, dry_run=True)
+        self.assertEqual(stats.updated, 1)
+        self.assertNotEqual(tree(self.dst), tree(self.src))
+        stats = self.host.sync(self.src, self.dst, delete=True)
+        self.assertEqual((stats.updated, stats.deleted), (1, 1))
+        self.assertTrue(stats.bytes_sent < 100000)
+        self.assertEqual(tree(self.dst), tree(self.src))
+
+    def make_tree(self):
+        for d in ['a', 'b', 'a/.git']:
+            for i in range(8):
+                name = 'f%u.%s' % (i, 'py' if i % 4 == 0 else 'bin')
+                write(os.path.join(self.src, d, name), os.urandom(20000))
+
+    def test_tar_round_trip(self):
+        self.make_tree()
+        for compression in [None, 'gz']:
+            remote = os.path.join(self.dst, str(compression))
+            os.makedirs(remote)
+            result = self.host.put_tree(self.src, remote, compression)
+            self.assertEqual(result.rc, 0)
+            self.assertEqual(len(result.manifest), 24)
+            self.assertEqual(tree(remote), tree(self.src))
+            back = os.path.join(self.dir, 'back-%s' % compression)
+            os.makedirs(back)
+            result = self.host.get_tree(remote, back, compression)
+            self.assertEqual(len(result.manifest), 24)
+            self.assertEqual(tree(back), tree(self.src))
+
+    def test_tar_selection(self):
+        self.make_tree()
+        back = os.path.join(self.dir, 'back')
+        os.makedirs(back)
+        result = self.host.get_tree(self.src, back, include=['*.py'],
+                                    exclude=['*/.git/*'])
+        self.assertEqual(sorted(tree(back).keys()),
+                         ['a/f0.py', 'a/f4.py', 'b/f0.py', 'b/f4.py'])
+        # Only the selected files cross the wire
+        self.assertTrue(result.wire_bytes < 2 * result.bytes)
+        self.assertEqual(result.bytes, 4 * 20000)
+
+if __name__ == '__main__':
+    unittest.main()
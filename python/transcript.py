@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+#
+# Record and replay the traffic of an expect session
+#
+#    A transcript holds every send and receive of a channel or serial port
+#    with its time. A replay channel or port serves it back to SSHExpect or
+#    SerialExpect in place of the real one, at the recorded pacing or as
+#    fast as possible, so scripts run without targets.
+#
+# mdeacon@zorillaeng.com
+#
+
+import time
+import gzip
+import json
+import bisect
+import socket
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'ZTRANS1\n'
+# Event header: kind, seconds since the start, data length
+EVENT = struct.Struct('>cdI')
+SEND = b's'
+RECV = b'r'
+
+class TranscriptException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+def open_transcript(pathname, mode):
+    """gzip compressed when the name ends in .gz
+    """
+    if pathname.endswith('.gz'):
+        return gzip.open(pathname, mode)
+    return open(pathname, mode)
+
+class TranscriptRecorder(object):
+    """Append the sends and receives of one session to a file
+    """
+    def __init__(self, pathname, meta=None):
+        self.pathname = pathname
+        self.start = time.time()
+        meta = dict(meta or {})
+        meta['start'] = self.start
+        self.f = open_transcript(pathname, 'wb')
+        self.f.write(MAGIC)
+        self.f.write(json.dumps(meta) + '\n')
+
+    def event(self, kind, data):
+        if self.f is None or len(data) == 0:
+            return
+        self.f.write(EVENT.pack(kind, time.time() - self.start, len(data)))
+        self.f.write(data)
+
+    def send(self, data):
+        self.event(SEND, data)
+
+    def recv(self, data):
+        self.event(RECV, data)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+class Transcript(object):
+    """A loaded transcript
+    sends is the sent stream. Each received chunk is kept with the number
+    of bytes sent before it arrived and its delay after whichever came last
+    of the previous chunk and that send.
+    """
+    def __init__(self, meta, events):
+        self.meta = meta
+        self.events = events
+        self.sends = b''.join([data for t, kind, data in events
+                               if kind == SEND])
+        self.chunks = []
+        sent = 0
+        last_send = 0.0
+        last_chunk = 0.0
+        for t, kind, data in events:
+            if kind == SEND:
+                sent += len(data)
+                last_send = t
+            else:
+                self.chunks.append((sent, t - max(last_send, last_chunk),
+                                    data))
+                last_chunk = t
+
+    @classmethod
+    def load(cls, pathname):
+        with open_transcript(pathname, 'rb') as f:
+            data = f.read()
+        if not data.startswith(MAGIC):
+            raise TranscriptException('load: %s is not a transcript' %
+                                      pathname)
+        pos = data.index(b'\n', len(MAGIC)) + 1
+        meta = json.loads(data[len(MAGIC):pos])
+        events = []
+        while pos + EVENT.size <= len(data):
+            kind, t, size = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+            events.append((t, kind, data[pos:pos + size]))
+            pos += size
+        return cls(meta, events)
+
+    @property
+    def received(self):
+        return b''.join([data for sent, delay, data in self.chunks])
+
+    def __repr__(self):
+        return 'Transcript(%r %u sent %u received)' % (
+            self.meta.get('target'), len(self.sends), len(self.received))
+
+def as_transcript(transcript):
+    if isinstance(transcript, Transcript):
+        return transcript
+    return Transcript.load(transcript)
+
+class ReplayStream(object):
+    """Serve the received chunks of a transcript in order
+    A chunk is held back until the sends recorded before it have been
+    made. With speed, e.g. 1.0 for the recorded pacing, it is also held
+    for its recorded delay. Without, output the caller waits for that is
+    not in the transcript ends the replay at once. With strict, sends that
+    differ from the recording raise TranscriptException.
+    """
+    def __init__(self, transcript, speed=None, strict=False):
+        self.transcript = as_transcript(transcript)
+        self.speed = speed
+        self.strict = strict
+        self.sent = 0
+        self.send_times = []
+        self.send_counts = []
+        self.next = 0
+        self.partial = b''
+        self.released = time.time()
+        self.release_at = None
+        self.diverged = False
+
+    def send(self, data):
+        expected = self.transcript.sends[self.sent:self.sent + len(data)]
+        if expected != data and not self.diverged:
+            self.diverged = True
+            if self.strict:
+                raise TranscriptException('send: sent %r, recorded %r' %
+                                          (data, expected))
+            logger.debug('send: sent %r, recorded %r', data, expected)
+        self.sent += len(data)
+        self.send_counts.append(self.sent)
+        self.send_times.append(time.time())
+        return len(data)
+
+    def waiting_on_send(self):
+        return (self.next < len(self.transcript.chunks) and
+                self.transcript.chunks[self.next][0] > self.sent)
+
+    def due(self):
+        """When the next chunk may be served, None if it can not be yet
+        """
+        if self.next >= len(self.transcript.chunks) or self.waiting_on_send():
+            return None
+        if self.speed is None:
+            return 0
+        if self.release_at is None:
+            sent, delay, data = self.transcript.chunks[self.next]
+            base = self.released
+            i = bisect.bisect_left(self.send_counts, sent)
+            if sent and i < len(self.send_times):
+                base = max(base, self.send_times[i])
+            self.release_at = base + delay / self.speed
+        return self.release_at
+
+    def take(self, size):
+        """Up to size bytes that are due now, '' if none are
+        """
+        if not self.partial:
+            due = self.due()
+            if due is None or due > time.time():
+                return b''
+            self.partial = self.transcript.chunks[self.next][2]
+            self.next += 1
+            self.released = max(time.time(), self.release_at or 0)
+            self.release_at = None
+        data, self.partial = self.partial[:size], self.partial[size:]
+        return data
+
+    def available(self):
+        """Bytes that could be taken now
+        """
+        if self.partial:
+            return len(self.partial)
+        due = self.due()
+        if due is None or due > time.time():
+            return 0
+        return len(self.transcript.chunks[self.next][2])
+
+    @property
+    def finished(self):
+        return not self.partial and self.next >= len(self.transcript.chunks)
+
+    def wait(self, timeout):
+        """Block until data is due or timeout, False if it never will be
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.available():
+            due = self.due()
+            if due is None:
+                if self.speed is None or self.finished:
+                    return False
+                due = deadline
+            if due is None:
+                # Waiting forever on a send that can not come
+                return False
+            if deadline is not None:
+                due = min(due, deadline)
+            pause = due - time.time()
+            if pause > 0:
+                time.sleep(pause)
+            if deadline is not None and time.time() >= deadline:
+                return self.available() > 0
+        return True
+
+class RecordingChannel(object):
+    """Paramiko channel that also records to a TranscriptRecorder
+    """
+    def __init__(self, channel, recorder):
+        self.channel = channel
+        self.recorder = recorder
+
+    def send(self, s):
+        n = self.channel.send(s)
+        self.recorder.send(s[:n])
+        return n
+
+    def sendall(self, s):
+        self.channel.sendall(s)
+        self.recorder.send(s)
+
+    def recv(self, nbytes):
+        data = self.channel.recv(nbytes)
+        self.recorder.recv(data)
+        return data
+
+    def close(self):
+        self.recorder.close()
+        self.channel.close()
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
+
+class ReplayChannel(object):
+    """Stand in for a paramiko shell channel serving a transcript
+    recv returns '' at the end of the transcript, or as soon as the caller
+    waits for output that would only follow a send it has not made.
+    """
+    def __init__(self, transcript, speed=None, strict=False):
+        self.stream = ReplayStream(transcript, speed, strict)
+        self.timeout = None
+        self.closed = False
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def setblocking(self, blocking):
+        self.timeout = None if blocking else 0.0
+
+    def send(self, s):
+        return self.stream.send(s)
+
+    def sendall(self, s):
+        self.stream.send(s)
+
+    def recv_ready(self):
+        return self.stream.available() > 0
+
+    def recv(self, nbytes):
+        if self.stream.wait(self.timeout):
+            return self.stream.take(nbytes)
+        if self.stream.speed is None or self.stream.finished:
+            return b''
+        raise socket.timeout()
+
+    def exit_status_ready(self):
+        return self.stream.finished
+
+    def recv_exit_status(self):
+        return 0
+
+    def close(self):
+        self.closed = True
+
+class RecordingPort(object):
+    """pyserial port that also records to a TranscriptRecorder
+    """
+    def __init__(self, port, recorder):
+        self.port = port
+        self.recorder = recorder
+
+    @property
+    def timeout(self):
+        return self.port.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.port.timeout = value
+
+    def write(self, data):
+        n = self.port.write(data)
+        self.recorder.send(data)
+        return n
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        self.recorder.recv(data)
+        return data
+
+    def close(self):
+        self.recorder.close()
+        self.port.close()
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+class ReplayPort(object):
+    """Stand in for a pyserial port serving a transcript
+    """
+    def __init__(self, transcript, speed=None, strict=False, timeout=5):
+        self.stream = ReplayStream(transcript, speed, strict)
+        self.timeout = timeout
+
+    @property
+    def in_waiting(self):
+        return self.stream.available()
+
+    def inWaiting(self):
+        return self.stream.available()
+
+    def write(self, data):
+        return self.stream.send(data)
+
+    def read(self, size=1):
+        if not self.stream.wait(self.timeout):
+            if self.stream.speed is None or self.stream.finished:
+                raise TranscriptException('read: replay has no more output '
+                                          'for this point of the session')
+            return b''
+        return self.stream.take(size)
+
+    def close(self):
+        pass
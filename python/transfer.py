@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+#
+# Parallel, chunked, resumable file transfer over SFTP
+#
+#    A file is split into fixed size chunks moved over several SFTP
+#    channels at once. Each finished chunk is checksummed against the far
+#    end and recorded in a manifest so an interrupted transfer resumes.
+#
+# mdeacon@zorillaeng.com
+#
+
+import os
+import posixpath
+import stat
+import json
+import time
+import pipes
+import hashlib
+import logging
+import threading
+import Queue
+from paramiko import SFTPClient
+
+logger = logging.getLogger(__name__)
+
+class TransferException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+class TransferStats(object):
+    """Bytes moved, throughput and ETA of one transfer
+    Bytes skipped by a resume do not count towards the rate.
+    """
+    def __init__(self, filename, size, done=0):
+        self.filename = filename
+        self.size = size
+        self.done = done
+        self.resumed = done
+        self.start = time.time()
+
+    def add(self, count):
+        self.done += count
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    @property
+    def rate(self):
+        """Bytes per second moved by this run
+        """
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return 0.0
+        return (self.done - self.resumed) / elapsed
+
+    @property
+    def eta(self):
+        """Seconds until done at the current rate, None if unknown
+        """
+        rate = self.rate
+        if rate <= 0:
+            return None
+        return (self.size - self.done) / rate
+
+    def __str__(self):
+        eta = self.eta
+        if eta is None:
+            eta = '--:--:--'
+        else:
+            eta = time.strftime('%H:%M:%S', time.gmtime(eta))
+        return '%.1f MB/s ETA %s' % (self.rate / 1048576.0, eta)
+
+class StatsWidget(object):
+    """ProgressBar widget showing the rate and ETA of a TransferStats
+    """
+    def __init__(self, stats):
+        self.stats = stats
+
+    def update(self, pbar):
+        return str(self.stats)
+
+class TransferManifest(object):
+    """Record of the chunks of a transfer that are done and verified
+    The manifest only applies while the source size, mtime and chunk size
+    are unchanged.
+    """
+    def __init__(self, pathname, size, mtime, chunk_size):
+        self.pathname = pathname
+        self.identity = {'size': size, 'mtime': mtime,
+                         'chunk_size': chunk_size}
+        self.done = set()
+
+    def load(self):
+        """Return the chunks already done, empty if the source changed
+        """
+        try:
+            with open(self.pathname) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return self.done
+        if all([saved.get(k) == v for k, v in self.identity.items()]):
+            self.done = set(saved.get('done', []))
+        logger.debug('load: %s %u chunks done', self.pathname, len(self.done))
+        return self.done
+
+    def reset(self):
+        self.done = set()
+        self.save()
+
+    def mark(self, index):
+        self.done.add(index)
+        self.save()
+
+    def save(self):
+        saved = dict(self.identity)
+        saved['done'] = sorted(self.done)
+        path = os.path.dirname(self.pathname)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        # Write then rename so a crash cannot leave half a manifest
+        tmp = self.pathname + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(saved, f)
+        if os.name == 'nt' and os.path.exists(self.pathname):
+            os.remove(self.pathname)
+        os.rename(tmp, self.pathname)
+
+    def remove(self):
+        if os.path.exists(self.pathname):
+            os.remove(self.pathname)
+
+def get_manifest_path():
+    """Return a path where transfer manifests go
+    """
+    home = os.path.expanduser("~")
+    return os.path.join(home, '.zorilla', 'transfer')
+
+class ChunkedTransfer(object):
+    """Move one large file over several SFTP channels at once
+    Data lands in a .part file that is renamed into place once every chunk
+    has been verified. Call put or get again after a failure to resume.
+    e.g.:
+    transfer = ChunkedTransfer(sshclient.get_transport(), channels=4)
+    transfer.put('image.bin', '/tmp')
+    transfer.get('/var/log/messages', '.')
+    logger.error('%s', transfer.stats)
+    """
+    # Bytes per SFTP read or write request
+    block_size = 32768
+    # SSH channel window, large enough to keep a long fat pipe full
+    window_size = 16777216
+
+    def __init__(self, transport, chunk_size=8388608, channels=4, verify=True,
+                 manifest_dir=None, progress=None, chunk_retries=2):
+        """progress is called as progress(filename, size, sent, stats).
+        With verify set each chunk's md5 is compared with the far end's,
+        a chunk that does not match is sent again up to chunk_retries times.
+        """
+        self.transport = transport
+        self.chunk_size = chunk_size
+        self.channels = channels
+        self.verify = verify
+        if manifest_dir is None:
+            manifest_dir = get_manifest_path()
+        self.manifest_dir = manifest_dir
+        self.progress = progress
+        self.chunk_retries = chunk_retries
+        self.lock = threading.Lock()
+        self.stats = None
+
+    def manifest(self, direction, source, destination, size, mtime):
+        key = '%s:%s:%s:%s' % (direction, self.transport.getpeername(),
+                               source, destination)
+        name = hashlib.md5(key).hexdigest() + '.json'
+        return TransferManifest(os.path.join(self.manifest_dir, name),
+                                size, mtime, self.chunk_size)
+
+    def chunks(self, size):
+        count = (size + self.chunk_size - 1) // self.chunk_size
+        return [(i, i * self.chunk_size,
+                 min(self.chunk_size, size - i * self.chunk_size))
+                for i in range(count)]
+
+    def put(self, local_pathname, remote_path):
+        """Copy a local file to the host, remote_path may be a directory
+        Returns the remote pathname, throughput is in stats
+        """
+        sftp = SFTPClient.from_transport(self.transport)
+        try:
+            remote_pathname = remote_path
+            try:
+                if stat.S_ISDIR(sftp.stat(remote_path).st_mode):
+                    remote_pathname = posixpath.join(
+                        remote_path, os.path.basename(local_pathname))
+            except IOError:
+                pass
+            st = os.stat(local_pathname)
+            size = st.st_size
+            part = remote_pathname + '.part'
+            manifest = self.manifest('put', os.path.abspath(local_pathname),
+                                     remote_pathname, size, int(st.st_mtime))
+            done = manifest.load()
+            try:
+                resumable = sftp.stat(part).st_size == size
+            except IOError:
+                resumable = False
+            if not (done and resumable):
+                manifest.reset()
+                with sftp.open(part, 'w') as f:
+                    f.truncate(size)
+
+            def chunk(channel, index, offset, length):
+                return self.put_chunk(channel, local_pathname, part,
+                                      index, offset, length)
+
+            self.run(os.path.basename(local_pathname), size, manifest, chunk)
+            sftp.chmod(part, stat.S_IMODE(st.st_mode))
+            sftp.utime(part, (st.st_atime, st.st_mtime))
+            self.rename(sftp, part, remote_pathname)
+            manifest.remove()
+        finally:
+            sftp.close()
+        return remote_pathname
+
+    def get(self, remote_file, local_path):
+        """Copy a file from the host, local_path may be a directory
+        Returns the local pathname, throughput is in stats
+        """
+        sftp = SFTPClient.from_transport(self.transport)
+        try:
+            local_pathname = local_path
+            if os.path.isdir(local_path):
+                local_pathname = os.path.join(local_path,
+                                              posixpath.basename(remote_file))
+            st = sftp.stat(remote_file)
+            size = st.st_size
+            part = local_pathname + '.part'
+            manifest = self.manifest('get', remote_file,
+                                     os.path.abspath(local_pathname),
+                                     size, st.st_mtime)
+            done = manifest.load()
+            resumable = (os.path.exists(part) and
+                         os.path.getsize(part) == size)
+            if not (done and resumable):
+                manifest.reset()
+                with open(part, 'wb') as f:
+                    f.truncate(size)
+
+            def chunk(channel, index, offset, length):
+                return self.get_chunk(channel, remote_file, part,
+                                      index, offset, length)
+
+            self.run(posixpath.basename(remote_file), size, manifest, chunk)
+            os.utime(part, (st.st_atime, st.st_mtime))
+            if os.name == 'nt' and os.path.exists(local_pathname):
+                os.remove(local_pathname)
+            os.rename(part, local_pathname)
+            manifest.remove()
+        finally:
+            sftp.close()
+        return local_pathname
+
+    def rename(self, sftp, oldpath, newpath):
+        """Rename over an existing file where the server allows it
+        """
+        try:
+            sftp.posix_rename(oldpath, newpath)
+            return
+        except (IOError, AttributeError) as e:
+            logger.debug('rename: posix_rename: %r', e)
+        try:
+            sftp.remove(newpath)
+        except IOError:
+            pass
+        sftp.rename(oldpath, newpath)
+
+    def run(self, filename, size, manifest, chunk):
+        """Move the chunks that are not done yet, channels at a time
+        """
+        todo = [c for c in self.chunks(size) if c[0] not in manifest.done]
+        done = size - sum([length for index, offset, length in todo])
+        self.stats = TransferStats(filename, size, done)
+        logger.debug('run: %s %u bytes, %u of %u chunks to go', filename,
+                     size, len(todo), len(self.chunks(size)))
+        self.report()
+        work = Queue.Queue()
+        for c in todo:
+            work.put(c)
+        errors = []
+
+        def worker():
+            channel = None
+            try:
+                channel = SFTPClient.from_transport(
+                    self.transport, window_size=self.window_size)
+                while not errors:
+                    try:
+                        index, offset, length = work.get_nowait()
+                    except Queue.Empty:
+                        return
+                    self.retry(chunk, channel, index, offset, length)
+                    with self.lock:
+                        manifest.mark(index)
+            except Exception as e:
+                logger.error('run: Exception: %r', e)
+                errors.append(e)
+            finally:
+                if channel is not None:
+                    channel.close()
+
+        threads = []
+        for i in range(min(self.channels, len(todo))):
+            t = threading.Thread(target=worker, name='transfer-%u' % i)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        if errors:
+            raise TransferException('run: %s: %r, %u of %u chunks done' %
+                                    (filename, errors[0], len(manifest.done),
+                                     len(self.chunks(size))))
+        logger.debug('run: %s done, %s', filename, self.stats)
+
+    def retry(self, chunk, channel, index, offset, length):
+        for attempt in range(self.chunk_retries + 1):
+            if chunk(channel, index, offset, length):
+                return
+            logger.error('retry: chunk %u checksum mismatch, attempt %u of %u',
+                         index, attempt + 1, self.chunk_retries + 1)
+            with self.lock:
+                self.stats.add(-length)
+        raise TransferException('retry: chunk %u failed verification' % index)
+
+    def report(self, count=0):
+        with self.lock:
+            self.stats.add(count)
+            if self.progress is not None:
+                self.progress(self.stats.filename, self.stats.size,
+                              self.stats.done, self.stats)
+
+    def put_chunk(self, sftp, local_pathname, remote_pathname, index,
+                  offset, length):
+        """Write one chunk with pipelined requests
+        Returns False if it fails verification
+        """
+        md5 = hashlib.md5()
+        with open(local_pathname, 'rb') as lf:
+            lf.seek(offset)
+            rf = sftp.open(remote_pathname, 'r+')
+            try:
+                rf.set_pipelined(True)
+                rf.seek(offset)
+                remaining = length
+                while remaining > 0:
+                    data = lf.read(min(self.block_size * 8, remaining))
+                    if len(data) == 0:
+                        raise TransferException('put_chunk: %s shrank' %
+                                                local_pathname)
+                    md5.update(data)
+                    rf.write(data)
+                    remaining -= len(data)
+                    self.report(len(data))
+            finally:
+                # Waits for every write to be acknowledged
+                rf.close()
+        if not self.verify:
+            return True
+        return self.remote_md5(remote_pathname, index) == md5.hexdigest()
+
+    def get_chunk(self, sftp, remote_file, local_pathname, index,
+                  offset, length):
+        """Read one chunk with its read requests all in flight at once
+        Returns False if it fails verification
+        """
+        md5 = hashlib.md5()
+        ranges = [(o, min(self.block_size, offset + length - o))
+                  for o in range(offset, offset + length, self.block_size)]
+        rf = sftp.open(remote_file, 'r')
+        try:
+            with open(local_pathname, 'r+b') as lf:
+                lf.seek(offset)
+                for data in rf.readv(ranges):
+                    md5.update(data)
+                    lf.write(data)
+                    self.report(len(data))
+        finally:
+            rf.close()
+        if not self.verify:
+            return True
+        return self.remote_md5(remote_file, index) == md5.hexdigest()
+
+    def remote_md5(self, remote_pathname, index):
+        """md5 of one chunk computed on the host
+        """
+        command = ('dd if=%s bs=%u skip=%u count=1 2>/dev/null | md5sum' %
+                   (pipes.quote(remote_pathname), self.chunk_size, index))
+        channel = self.transport.open_session()
+        try:
+            channel.exec_command(command)
+            output = channel.makefile('rb').read()
+            rc = channel.recv_exit_status()
+        finally:
+            channel.close()
+        if rc != 0 or len(output.split()) == 0:
+            raise TransferException('remote_md5: %r returned %r' %
+                                    (command, rc))
+        return output.split()[0]